@@ -1,16 +1,37 @@
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
 
-from database import create_db_and_tables
-from routes import chat, sessions
+from backend.database import create_db_and_tables, close_connections
+from backend.routes import admin, chat, search, sessions
+from backend.services.archive import session_archiver
+from backend.services.broadcast import broadcaster
+from backend.services.generation_worker import generation_manager
+from backend.services.metrics import CONTENT_TYPE_LATEST, render
+from backend.services.openai_service import init_openai_service, close_openai_service
+from backend.services.redis_lifecycle import state_sweeper
+from backend.services.search import message_search
+from backend.services.write_behind import write_behind
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    create_db_and_tables()
+    await create_db_and_tables()
+    await message_search.setup()
+    init_openai_service()
+    await write_behind.start()
+    await state_sweeper.start()
+    await session_archiver.start()
     yield
+    await session_archiver.close()
+    await state_sweeper.close()
+    await generation_manager.shutdown()
+    # 生成任务保存的部分内容也要写完
+    await write_behind.close()
+    await broadcaster.close()
+    await close_openai_service()
+    await close_connections()
 
 
 app = FastAPI(title="StreamChat API", lifespan=lifespan)
@@ -25,6 +46,14 @@ app.add_middleware(
 
 app.include_router(chat.router, prefix="/api")
 app.include_router(sessions.router, prefix="/api")
+app.include_router(search.router, prefix="/api")
+app.include_router(admin.router, prefix="/api")
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus 指标"""
+    return Response(render(), media_type=CONTENT_TYPE_LATEST)
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,10 +1,16 @@
 import uuid
 from datetime import datetime
 from enum import Enum
-from typing import Optional
+from typing import List, Optional
 
 from sqlmodel import SQLModel, Field
-from sqlalchemy import Text
+from sqlalchemy import Column, DateTime, Index, LargeBinary, Text
+from sqlalchemy.dialects import mysql
+
+# MySQL 的 DATETIME 默认只精确到秒，分页游标需要微秒精度
+PreciseDateTime = DateTime().with_variant(mysql.DATETIME(fsp=6), "mysql")
+# MySQL 的 BLOB 上限为 64KB
+LongBinary = LargeBinary().with_variant(mysql.LONGBLOB(), "mysql")
 
 
 class SessionStatus(str, Enum):
@@ -14,26 +20,117 @@ class SessionStatus(str, Enum):
 
 
 class ChatSession(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_chatsession_updated_at_id", "updated_at", "id"),
+    )
+
     id: str = Field(default_factory=lambda: str(uuid.uuid4()), primary_key=True)
     title: Optional[str] = None
     status: SessionStatus = Field(default=SessionStatus.ACTIVE)
-    created_at: datetime = Field(default_factory=datetime.utcnow)
-    updated_at: datetime = Field(default_factory=datetime.utcnow)
+    created_at: datetime = Field(default_factory=datetime.utcnow, sa_type=PreciseDateTime)
+    updated_at: datetime = Field(default_factory=datetime.utcnow, sa_type=PreciseDateTime)
     last_message_id: Optional[str] = None
+    # 已进入对话历史的消息数，用于校验历史缓存
+    history_version: int = Field(default=0)
+    # 滚动摘要，覆盖历史中的前 summarized_count 条消息
+    summary: Optional[str] = Field(default=None, sa_column=Column(Text))
+    summarized_count: int = Field(default=0)
+    # 会话列表使用的摘要字段，随消息写入在同一事务中更新（见 services/session_summary.py）
+    message_count: int = Field(default=0)
+    last_message_preview: Optional[str] = Field(default=None, max_length=255)
+    last_role: Optional[str] = None
+    # 各次回复的提示token与估算的回复token之和
+    total_tokens: int = Field(default=0)
+    # 消息已移入归档表（SessionArchive）的时间，未归档为空
+    archived_at: Optional[datetime] = Field(default=None, sa_type=PreciseDateTime)
 
 
 class Message(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_message_session_id_created_at_id", "session_id", "created_at", "id"),
+        # 全文检索：MySQL 使用 ngram 分词以支持中文，SQLite 使用 FTS5 表（见 services/search.py）
+        Index(
+            "ft_message_content", "content", mysql_prefix="FULLTEXT", mysql_with_parser="ngram"
+        ).ddl_if(dialect="mysql"),
+    )
+
     id: str = Field(default_factory=lambda: str(uuid.uuid4()), primary_key=True)
     session_id: str = Field(foreign_key="chatsession.id")
     role: str  # "user" or "assistant"
-    content: str = Field(sa_column=Text)
+    content: str = Field(sa_type=Text)
     is_streaming: bool = Field(default=False)
-    created_at: datetime = Field(default_factory=datetime.utcnow)
+    # 生成该回复时发送给模型的提示token数
+    prompt_tokens: Optional[int] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow, sa_type=PreciseDateTime)
+
+
+class SessionArchive(SQLModel, table=True):
+    """冷会话的全部消息，按时间顺序序列化后压缩为一个数据块"""
+    session_id: str = Field(foreign_key="chatsession.id", primary_key=True)
+    # zstd 或 zlib
+    codec: str
+    message_count: int
+    # 压缩前后的字节数，用于统计节省的空间
+    raw_bytes: int
+    compressed_bytes: int
+    data: bytes = Field(sa_type=LongBinary)
+    archived_at: datetime = Field(default_factory=datetime.utcnow, sa_type=PreciseDateTime)
 
 
 class MessageCreate(SQLModel):
     content: str
+    # 是否使用回复缓存，不指定时按 COMPLETION_CACHE_MODE 决定
+    cache: Optional[bool] = None
 
 
 class SessionCreate(SQLModel):
     title: Optional[str] = None
+
+
+class BatchItem(SQLModel):
+    # 调用方指定的条目ID，结果按此标记
+    id: str
+    # 为空时为该条目新建会话
+    session_id: Optional[str] = None
+    title: Optional[str] = None
+    content: str
+    cache: Optional[bool] = None
+
+
+class BatchCreate(SQLModel):
+    items: List[BatchItem]
+    # 以相同 job_id 重新提交时跳过已成功的条目
+    job_id: Optional[str] = None
+    # 同时生成的条目数，不指定时为 BATCH_CONCURRENCY
+    concurrency: Optional[int] = None
+
+
+class MessagePage(SQLModel):
+    items: List[Message]
+    # 加载更早/更新一页时传给 before/after 的游标，没有更多数据时为空
+    before_cursor: Optional[str] = None
+    after_cursor: Optional[str] = None
+
+
+class SessionPage(SQLModel):
+    items: List[ChatSession]
+    before_cursor: Optional[str] = None
+    after_cursor: Optional[str] = None
+
+
+class SearchHit(SQLModel):
+    message_id: str
+    session_id: str
+    session_title: Optional[str] = None
+    role: str
+    # 命中位置附近的片段，命中词用 <mark></mark> 标出
+    snippet: str
+    score: float
+    created_at: datetime
+
+
+class SearchPage(SQLModel):
+    items: List[SearchHit]
+    # 获取下一页时传给 cursor，没有更多结果时为空
+    next_cursor: Optional[str] = None
+    took_ms: float
@@ -0,0 +1,37 @@
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Query
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from backend.database import get_session
+from backend.services.archive import session_archiver
+from backend.services.redis_lifecycle import memory_report, state_sweeper
+
+router = APIRouter(prefix="/admin", tags=["admin"])
+
+
+@router.get("/redis-memory")
+async def get_redis_memory(sample: int = Query(default=100, ge=0, le=10000)):
+    """按键类别统计Redis中的键数量与内存占用"""
+    return await memory_report(sample)
+
+
+@router.post("/sweep")
+async def run_sweep():
+    """立即执行一次流式状态清理"""
+    return await state_sweeper.sweep()
+
+
+@router.get("/archive")
+async def get_archive_report(db: AsyncSession = Depends(get_session)):
+    """已归档的会话数、消息数，以及压缩前后的字节数"""
+    return await session_archiver.report(db)
+
+
+@router.post("/archive")
+async def run_archive(
+        limit: Optional[int] = Query(default=None, ge=1),
+        older_than_days: Optional[float] = Query(default=None, ge=0)
+):
+    """立即归档一批最后一条消息早于 older_than_days 天（默认 ARCHIVE_AFTER_DAYS）的会话"""
+    return await session_archiver.run(limit, older_than_days)
@@ -1,88 +1,125 @@
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, Query, Request, WebSocket
 from fastapi.responses import StreamingResponse
-from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from backend.database import get_session, get_redis
-from backend.models import ChatSession, Message, MessageCreate, SessionStatus
-from backend.services.chat_service import ChatService
+from backend.models import BatchCreate, MessageCreate
+from backend.services.admission import admission_controller
+from backend.services.batch import batch_runner
+from backend.services.chat_service import ChatService, SSE_PROTOCOL_VERSION
+from backend.services.completion_cache import completion_cache
+from backend.services.generation_worker import generation_manager
+from backend.services.openai_service import get_openai_service
+from backend.services.ws_mux import StreamMultiplexer
 
 router = APIRouter(prefix="/chat", tags=["chat"])
 
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+}
+
+
+def parse_last_event_id(last_event_id: Optional[str]) -> Optional[int]:
+    """Last-Event-ID 为客户端已收到的字符偏移，非法值按未提供处理"""
+    if last_event_id is None:
+        return None
+    try:
+        return int(last_event_id)
+    except ValueError:
+        return None
+
+
+@router.get("/cache-stats")
+async def get_cache_stats():
+    """回复缓存的命中统计"""
+    return await completion_cache.stats()
+
+
+@router.get("/rate-limit-stats")
+async def get_rate_limit_stats():
+    """默认上游（首个上游）限流器的额度、排队深度和平均等待时间"""
+    return await get_openai_service().rate_limiter.stats()
+
+
+@router.get("/upstream-stats")
+async def get_upstream_stats():
+    """各上游的首token时间均值、错误率、熔断状态和限流状态（延迟与熔断为本进程的统计）"""
+    return await get_openai_service().router.stats()
+
+
+@router.get("/admission-stats")
+async def get_admission_stats():
+    """本进程及全局正在运行的生成任务数和排队数"""
+    return await admission_controller.stats()
+
+
+@router.get("/generation-stats")
+async def get_generation_stats():
+    """运行中的生成任务数，以及因客户端断开而取消的次数和节省的token"""
+    return await generation_manager.stats()
+
+
+@router.post("/batch")
+async def batch_completions(batch: BatchCreate, db: AsyncSession = Depends(get_session)):
+    """批量生成，按完成顺序以 NDJSON 逐行返回各条目的结果；以相同 job_id 重新提交可续跑"""
+    job = await batch_runner.prepare(db, batch)
+    await db.close()
+    return StreamingResponse(batch_runner.run(job), media_type="application/x-ndjson", headers=SSE_HEADERS)
+
+
+@router.get("/batch/{job_id}")
+async def get_batch_status(job_id: str):
+    """批量任务的进度和各条目的结果（不含回复内容）"""
+    return await batch_runner.status(job_id)
+
 
 @router.post("/{session_id}/completions")
 async def start_completion(
         session_id: str,
         message: MessageCreate,
-        db: Session = Depends(get_session),
+        request: Request,
+        protocol: int = Query(default=SSE_PROTOCOL_VERSION),
+        idempotency_key: Optional[str] = Header(default=None),
+        db: AsyncSession = Depends(get_session),
         redis_client=Depends(get_redis)
 ):
-    # 验证会话存在
-    session = db.get(ChatSession, session_id)
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
-
-    # 保存用户消息
-    user_message = Message(
-        session_id=session_id,
-        role="user",
-        content=message.content
-    )
-    db.add(user_message)
-
-    # 创建AI消息占位符
-    ai_message = Message(
-        session_id=session_id,
-        role="assistant",
-        content="",
-        is_streaming=True
-    )
-    db.add(ai_message)
-    db.commit()
-    db.refresh(ai_message)
-
-    # 更新会话状态
-    session.last_message_id = ai_message.id
-    session.status = SessionStatus.ACTIVE
-    db.commit()
-
-    # 在Redis中存储流式状态
-    redis_client.hset(f"session:{session_id}", mapping={
-        "current_message_id": ai_message.id,
-        "status": "streaming",
-        "last_user_message": message.content
-    })
-
-    chat_service = ChatService(db, redis_client)
-    return StreamingResponse(
-        chat_service.stream_response(session_id, ai_message.id, message.content),
-        media_type="text/plain"
-    )
+    chat_service = ChatService(db, redis_client, protocol, request)
+    frames = await chat_service.open_completion(session_id, message, idempotency_key)
+    return StreamingResponse(frames, media_type="text/event-stream", headers=SSE_HEADERS)
 
 
 @router.post("/{session_id}/completions-continue")
 async def continue_completion(
         session_id: str,
-        db: Session = Depends(get_session),
+        request: Request,
+        protocol: int = Query(default=SSE_PROTOCOL_VERSION),
+        last_event_id: Optional[str] = Header(default=None),
+        db: AsyncSession = Depends(get_session),
+        redis_client=Depends(get_redis)
+):
+    chat_service = ChatService(db, redis_client, protocol, request)
+    frames = await chat_service.open_continue(session_id, parse_last_event_id(last_event_id))
+    return StreamingResponse(frames, media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@router.get("/{session_id}/stream")
+async def watch_session(
+        session_id: str,
+        request: Request,
+        protocol: int = Query(default=SSE_PROTOCOL_VERSION),
+        db: AsyncSession = Depends(get_session),
         redis_client=Depends(get_redis)
 ):
-    # 检查会话状态
-    session = db.get(ChatSession, session_id)
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
-
-    # 从Redis获取中断的流式状态
-    session_data = redis_client.hgetall(f"session:{session_id}")
-    if not session_data or session_data.get("status") != "streaming":
-        raise HTTPException(status_code=400, detail="No active streaming to continue")
-
-    message_id = session_data.get("current_message_id")
-    last_user_message = session_data.get("last_user_message")
-
-    if not message_id or not last_user_message:
-        raise HTTPException(status_code=400, detail="Invalid session state")
-
-    chat_service = ChatService(db, redis_client)
-    return StreamingResponse(
-        chat_service.continue_stream_response(session_id, message_id, last_user_message),
-        media_type="text/plain"
-    )
+    """只读订阅会话的流式输出（多标签页、客服旁观），不发起生成"""
+    chat_service = ChatService(db, redis_client, protocol, request)
+    frames = await chat_service.open_watch(session_id)
+    return StreamingResponse(frames, media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@router.websocket("/ws")
+async def multiplexed_streams(websocket: WebSocket, redis_client=Depends(get_redis)):
+    """在一个WebSocket连接上对任意多个会话发起、续传、取消和订阅流式输出，命令格式见 README"""
+    await StreamMultiplexer(websocket, redis_client).run()
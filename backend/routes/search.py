@@ -0,0 +1,23 @@
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Query
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from backend.database import get_session
+from backend.models import SearchPage
+from backend.services.pagination import MAX_PAGE_SIZE
+from backend.services.search import message_search
+
+router = APIRouter(prefix="/search", tags=["search"])
+
+
+@router.get("", response_model=SearchPage)
+async def search_messages(
+        q: str = Query(..., min_length=1, max_length=200),
+        session_id: Optional[str] = Query(default=None),
+        limit: int = Query(default=20, ge=1, le=MAX_PAGE_SIZE),
+        cursor: Optional[str] = Query(default=None),
+        db: AsyncSession = Depends(get_session)
+):
+    """全文检索所有会话中已完成的消息，按相关度排序，用 next_cursor 获取下一页"""
+    return await message_search.search(db, q, limit, cursor, session_id)
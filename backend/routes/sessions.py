@@ -1,60 +1,91 @@
-from typing import List
+from typing import Optional
 
-from fastapi import APIRouter, Depends, HTTPException
-from sqlmodel import Session, select
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from backend.database import get_session, get_redis
-from backend.models import SessionCreate, ChatSession, Message
+from backend.database import get_session
+from backend.models import SessionCreate, ChatSession, Message, MessagePage, SessionPage
+from backend.services.archive import session_archiver
+from backend.services.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, keyset_page, keyset_page_items
 
 router = APIRouter(prefix="/sessions", tags=["sessions"])
 
 
 @router.post("/", response_model=ChatSession)
-def create_session(
+async def create_session(
         session_data: SessionCreate,
-        db: Session = Depends(get_session),
-        redis_client=Depends(get_redis)
+        db: AsyncSession = Depends(get_session)
 ):
     session = ChatSession(title=session_data.title)
     db.add(session)
-    db.commit()
-    db.refresh(session)
-
-    # 在Redis中初始化会话状态
-    redis_client.hset(f"session:{session.id}", mapping={
-        "status": session.status,
-        "created_at": session.created_at.isoformat(),
-        "message_count": "0"
-    })
-
+    await db.commit()
+    await db.refresh(session)
+    # Redis中的流式状态在开始生成时才创建
     return session
 
 
 @router.get("/{session_id}", response_model=ChatSession)
-def get_session_info(
+async def get_session_info(
         session_id: str,
-        db: Session = Depends(get_session)
+        db: AsyncSession = Depends(get_session)
 ):
-    session = db.get(ChatSession, session_id)
+    session = await db.get(ChatSession, session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     return session
 
 
-@router.get("/{session_id}/messages", response_model=List[Message])
-def get_session_messages(
+@router.get("/{session_id}/messages", response_model=MessagePage)
+async def get_session_messages(
         session_id: str,
-        db: Session = Depends(get_session)
+        limit: int = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        all: bool = Query(default=False, description="一次返回全部消息（不分页）"),
+        db: AsyncSession = Depends(get_session)
 ):
-    messages = db.exec(
-        select(Message).where(Message.session_id == session_id).order_by(Message.created_at)
-    ).all()
-    return messages
+    """按时间正序返回消息；默认返回最新的 limit 条，用 before/after 游标翻页"""
+    # 已归档的会话从压缩的归档数据中读取
+    session = await db.get(ChatSession, session_id)
+    if session and session.archived_at:
+        archived = await session_archiver.load(db, session)
+        if archived is not None:
+            if all:
+                return MessagePage(items=archived)
+            items, before_cursor, after_cursor = keyset_page_items(
+                archived, "created_at", "id", limit, before, after
+            )
+            return MessagePage(items=items, before_cursor=before_cursor, after_cursor=after_cursor)
+
+    statement = select(Message).where(Message.session_id == session_id)
+
+    if all:
+        result = await db.exec(statement.order_by(Message.created_at, Message.id))
+        return MessagePage(items=result.all())
 
+    items, before_cursor, after_cursor = await keyset_page(
+        db, statement, Message.created_at, Message.id, limit, before, after
+    )
+    return MessagePage(items=items, before_cursor=before_cursor, after_cursor=after_cursor)
 
-@router.get("/", response_model=List[ChatSession])
-def get_sessions(
-        db: Session = Depends(get_session)
+
+@router.get("/", response_model=SessionPage)
+async def get_sessions(
+        limit: int = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        all: bool = Query(default=False, description="一次返回全部会话（不分页）"),
+        db: AsyncSession = Depends(get_session)
 ):
-    sessions = db.exec(select(ChatSession).order_by(ChatSession.updated_at.desc())).all()
-    return sessions
+    """按更新时间倒序返回会话；before 取更早更新的一页，after 取更新的一页"""
+    statement = select(ChatSession)
+
+    if all:
+        result = await db.exec(statement.order_by(ChatSession.updated_at.desc(), ChatSession.id.desc()))
+        return SessionPage(items=result.all())
+
+    items, before_cursor, after_cursor = await keyset_page(
+        db, statement, ChatSession.updated_at, ChatSession.id, limit, before, after, newest_first=True
+    )
+    return SessionPage(items=items, before_cursor=before_cursor, after_cursor=after_cursor)
@@ -0,0 +1,187 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import uuid
+from enum import IntEnum
+from typing import Dict, List, Optional
+
+from fastapi import HTTPException
+
+from backend.database import redis_client
+
+logger = logging.getLogger(__name__)
+
+# 单进程/全局同时运行的生成任务数，全局上限为0表示不限制
+ADMISSION_LOCAL_LIMIT = int(os.getenv("ADMISSION_LOCAL_LIMIT", "32"))
+ADMISSION_GLOBAL_LIMIT = int(os.getenv("ADMISSION_GLOBAL_LIMIT", "0"))
+# 每个进程最多排队的请求数，以及排队的最长秒数
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "64"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))
+# 拒绝时建议客户端等待的秒数
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "5"))
+
+# 全局名额的租约，由生成任务的心跳续期；进程崩溃后自动释放
+ADMISSION_SLOT_TTL = 15
+GLOBAL_POLL_INTERVAL = 0.2
+
+_CLOCK = """
+if redis.replicate_commands then redis.replicate_commands() end
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+"""
+
+# ARGV: 名额ID、全局上限、租约秒数
+ACQUIRE_SCRIPT = _CLOCK + """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if tonumber(ARGV[2]) > 0 and redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[1])
+return 1
+"""
+
+RENEW_SCRIPT = _CLOCK + """
+return redis.call('ZADD', KEYS[1], 'XX', now + tonumber(ARGV[2]), ARGV[1])
+"""
+
+SLOTS_KEY = "admission:slots"
+
+
+class Priority(IntEnum):
+    """数值越小越优先：续写的前缀已经付过费，优先于新的对话；离线批量任务最后"""
+    CONTINUE = 0
+    NEW = 1
+    BATCH = 2
+
+
+class AdmissionSlot:
+    """一个生成名额，由生成任务持有并在结束时释放"""
+
+    def __init__(self, controller: "AdmissionController", slot_id: str):
+        self.controller = controller
+        self.slot_id = slot_id
+        self.released = False
+
+    async def renew(self):
+        await self.controller.renew(self)
+
+    async def release(self):
+        if not self.released:
+            self.released = True
+            await self.controller.release(self)
+
+
+class AdmissionController:
+    """限制同时运行的生成任务数
+
+    名额先在本进程内计数，再在Redis中占用全局名额。名额不足时按优先级排队，
+    队列已满或等待超时则立即以503拒绝，避免过载时所有请求一起变慢。
+    """
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self._acquire_script = redis_client.register_script(ACQUIRE_SCRIPT)
+        self._renew_script = redis_client.register_script(RENEW_SCRIPT)
+        self._active = 0
+        self._waiters: List = []
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+
+    async def admit(self, priority: Priority = Priority.NEW) -> AdmissionSlot:
+        """获取生成名额，排队超时或队列已满时抛出503"""
+        slot = AdmissionSlot(self, uuid.uuid4().hex)
+        if not self._waiters and self._active < ADMISSION_LOCAL_LIMIT and await self._reserve(slot):
+            return slot
+
+        if len(self._waiters) >= ADMISSION_QUEUE_SIZE:
+            self._reject("queue full")
+
+        entry = [priority, next(self._sequence), slot]
+        heapq.heappush(self._waiters, entry)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + ADMISSION_QUEUE_TIMEOUT
+
+        try:
+            while True:
+                wakeup = self._wakeup
+                if self._waiters[0] is entry and self._active < ADMISSION_LOCAL_LIMIT:
+                    if await self._reserve(slot):
+                        heapq.heappop(self._waiters)
+                        self._notify()
+                        return slot
+
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    self._reject("queue timeout")
+                try:
+                    await asyncio.wait_for(wakeup.wait(), min(remaining, GLOBAL_POLL_INTERVAL))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._notify()
+
+    async def renew(self, slot: AdmissionSlot):
+        if ADMISSION_GLOBAL_LIMIT > 0:
+            await self._renew_script(keys=[SLOTS_KEY], args=[slot.slot_id, ADMISSION_SLOT_TTL])
+
+    async def release(self, slot: AdmissionSlot):
+        self._active -= 1
+        self._notify()
+        if ADMISSION_GLOBAL_LIMIT > 0:
+            await self.redis.zrem(SLOTS_KEY, slot.slot_id)
+
+    async def stats(self) -> Dict:
+        global_active: Optional[int] = None
+        if ADMISSION_GLOBAL_LIMIT > 0:
+            global_active = await self.redis.zcard(SLOTS_KEY)
+        return {
+            "local_active": self._active,
+            "local_limit": ADMISSION_LOCAL_LIMIT,
+            "local_queued": len(self._waiters),
+            "queue_size": ADMISSION_QUEUE_SIZE,
+            "global_active": global_active,
+            "global_limit": ADMISSION_GLOBAL_LIMIT or None
+        }
+
+    async def _reserve(self, slot: AdmissionSlot) -> bool:
+        """先占用本地名额再获取全局名额，等待Redis期间其他请求不会越过本地上限；失败时归还本地名额"""
+        self._active += 1
+        try:
+            acquired = await self._acquire_global(slot)
+        except BaseException:
+            self._active -= 1
+            self._notify()
+            raise
+        if not acquired:
+            self._active -= 1
+            self._notify()
+        return acquired
+
+    async def _acquire_global(self, slot: AdmissionSlot) -> bool:
+        if ADMISSION_GLOBAL_LIMIT <= 0:
+            return True
+        acquired = await self._acquire_script(
+            keys=[SLOTS_KEY], args=[slot.slot_id, ADMISSION_GLOBAL_LIMIT, ADMISSION_SLOT_TTL]
+        )
+        return bool(acquired)
+
+    def _notify(self):
+        self._wakeup.set()
+        self._wakeup = asyncio.Event()
+
+    @staticmethod
+    def _reject(reason: str):
+        logger.warning(f"Generation rejected: {reason}")
+        raise HTTPException(
+            status_code=503,
+            detail="Server is busy, please retry later",
+            headers={"Retry-After": str(ADMISSION_RETRY_AFTER)}
+        )
+
+
+admission_controller = AdmissionController(redis_client)
@@ -0,0 +1,314 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, func, select, text, tuple_
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from backend.database import async_engine, close_connections, redis_client
+from backend.models import ChatSession, Message, SessionArchive
+from .generation_worker import generation_manager
+from .metrics import ARCHIVE_HYDRATIONS
+from .session_state import session_state
+from .write_behind import write_behind
+
+logger = logging.getLogger(__name__)
+
+# 最后一条消息早于该天数的会话可以归档
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+# 后台归档任务的运行间隔（秒），0 为关闭，只通过管理接口或命令行执行
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", "0"))
+# 每批选取的会话数，批次之间暂停的毫秒数，避免长时间占用数据库
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "50"))
+ARCHIVE_BATCH_PAUSE_MS = int(os.getenv("ARCHIVE_BATCH_PAUSE_MS", "200"))
+# auto（已安装 zstandard 时使用 zstd，否则 zlib）/ zstd / zlib；压缩级别为空时按算法取默认值
+ARCHIVE_CODEC = os.getenv("ARCHIVE_CODEC", "auto")
+ARCHIVE_LEVEL = os.getenv("ARCHIVE_LEVEL", "")
+# 本进程缓存的已解压会话数
+ARCHIVE_CACHE_SESSIONS = int(os.getenv("ARCHIVE_CACHE_SESSIONS", "256"))
+ARCHIVE_LOCK_KEY = "archiver:lock"
+
+# 归档只在冷数据上执行一次，取较高的压缩级别
+DEFAULT_LEVELS = {"zstd": 10, "zlib": 9}
+MESSAGE_FIELDS = [column.name for column in Message.__table__.columns if column.name != "session_id"]
+
+
+def resolve_codec(name: str) -> str:
+    if name in ("auto", "zstd"):
+        try:
+            import zstandard  # noqa: F401
+            return "zstd"
+        except ImportError:
+            if name == "zstd":
+                logger.warning("zstandard is not installed, archiving with zlib")
+    return "zlib"
+
+
+def compress(data: bytes, codec: str) -> bytes:
+    level = int(ARCHIVE_LEVEL) if ARCHIVE_LEVEL else DEFAULT_LEVELS[codec]
+    if codec == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return zlib.compress(data, level)
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def encode_messages(messages: List[Message]) -> bytes:
+    """按时间顺序序列化为JSON数组，字段随消息表的列变化"""
+    rows = []
+    for message in messages:
+        row = {}
+        for name in MESSAGE_FIELDS:
+            value = getattr(message, name)
+            row[name] = value.isoformat() if isinstance(value, datetime) else value
+        rows.append(row)
+    return json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def decode_messages(session_id: str, data: bytes) -> List[Message]:
+    messages = []
+    for row in json.loads(data):
+        values = {name: row[name] for name in MESSAGE_FIELDS if name in row}
+        values["created_at"] = datetime.fromisoformat(values["created_at"])
+        messages.append(Message(session_id=session_id, **values))
+    return messages
+
+
+class SessionArchiver:
+    """把长期不活跃的会话移入归档表
+
+    会话的全部消息按时间顺序序列化、压缩为 SessionArchive 中的一个数据块，再从消息表删除，
+    消息表及其索引只保留活跃会话。读取归档会话时解压，最近读取的会话缓存在本进程中；
+    归档会话再次开始生成前，消息先写回消息表。归档时占用会话的生成租约，与生成任务互斥。
+    """
+
+    def __init__(self, engine, redis_client):
+        self.engine = engine
+        self.redis = redis_client
+        self.codec = resolve_codec(ARCHIVE_CODEC)
+        # session_id -> (归档时间, 消息列表)，按最近使用排序
+        self._cache: "OrderedDict[str, Tuple[datetime, List[Message]]]" = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if ARCHIVE_INTERVAL <= 0 or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(ARCHIVE_INTERVAL)
+            try:
+                if await self.redis.set(ARCHIVE_LOCK_KEY, "1", nx=True, ex=ARCHIVE_INTERVAL):
+                    await self.run()
+            except Exception as e:
+                logger.error(f"Archive run failed: {e}")
+
+    @staticmethod
+    def _candidates(cutoff: datetime, last: Optional[Tuple[datetime, str]]):
+        """未归档、有消息且最后一条消息早于 cutoff 的会话，按创建时间分批选取"""
+        recent = select(Message.id).where(Message.session_id == ChatSession.id, Message.created_at >= cutoff)
+        any_message = select(Message.id).where(Message.session_id == ChatSession.id)
+        statement = select(ChatSession.id, ChatSession.created_at).where(
+            ChatSession.archived_at == None,
+            ChatSession.created_at < cutoff,
+            ~recent.exists(),
+            any_message.exists()
+        )
+        if last:
+            statement = statement.where(tuple_(ChatSession.created_at, ChatSession.id) > tuple_(*last))
+        return statement.order_by(ChatSession.created_at, ChatSession.id).limit(ARCHIVE_BATCH_SIZE)
+
+    async def run(self, limit: Optional[int] = None, older_than_days: Optional[float] = None) -> Dict:
+        """归档一遍冷会话，返回本次归档的会话数、消息数和节省的字节数"""
+        days = ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        report = {"sessions": 0, "messages": 0, "skipped": 0, "raw_bytes": 0, "compressed_bytes": 0}
+        started = time.perf_counter()
+        last = None
+
+        while limit is None or report["sessions"] < limit:
+            async with AsyncSession(self.engine) as db:
+                rows = (await db.execute(self._candidates(cutoff, last))).all()
+            if not rows:
+                break
+            last = (rows[-1].created_at, rows[-1].id)
+
+            for row in rows:
+                if limit is not None and report["sessions"] >= limit:
+                    break
+                try:
+                    result = await self.archive_session(row.id, cutoff)
+                except Exception as e:
+                    logger.error(f"Failed to archive session {row.id}: {e}")
+                    result = None
+                if result is None:
+                    report["skipped"] += 1
+                    continue
+                message_count, raw_bytes, compressed_bytes = result
+                report["sessions"] += 1
+                report["messages"] += message_count
+                report["raw_bytes"] += raw_bytes
+                report["compressed_bytes"] += compressed_bytes
+
+            # 批次之间让出数据库
+            await asyncio.sleep(ARCHIVE_BATCH_PAUSE_MS / 1000)
+
+        report.update(
+            codec=self.codec,
+            cutoff=cutoff.isoformat(),
+            saved_bytes=report["raw_bytes"] - report["compressed_bytes"],
+            ratio=round(report["compressed_bytes"] / report["raw_bytes"], 4) if report["raw_bytes"] else None,
+            elapsed_seconds=round(time.perf_counter() - started, 3)
+        )
+        if report["sessions"]:
+            logger.info(f"Archive run: {report}")
+        return report
+
+    async def archive_session(self, session_id: str, cutoff: datetime) -> Optional[Tuple[int, int, int]]:
+        """归档一个会话，返回 (消息数, 压缩前字节数, 压缩后字节数)；会话正在使用或不再满足条件时返回None"""
+        holder = f"archive:{uuid.uuid4().hex}"
+        if await generation_manager.reserve(session_id, holder) is not None:
+            return None
+        try:
+            if await session_state.get(session_id) is not None:
+                return None
+            await write_behind.barrier(session_id)
+
+            async with AsyncSession(self.engine, expire_on_commit=False) as db:
+                session = await db.get(ChatSession, session_id, with_for_update=True)
+                if session is None or session.archived_at is not None:
+                    return None
+                messages = (await db.execute(
+                    select(Message).where(Message.session_id == session_id).order_by(Message.created_at, Message.id)
+                )).scalars().all()
+                if not messages or messages[-1].created_at >= cutoff:
+                    return None
+
+                raw = encode_messages(messages)
+                data = compress(raw, self.codec)
+                archived_at = datetime.utcnow()
+                db.add(SessionArchive(
+                    session_id=session_id,
+                    codec=self.codec,
+                    message_count=len(messages),
+                    raw_bytes=len(raw),
+                    compressed_bytes=len(data),
+                    data=data,
+                    archived_at=archived_at
+                ))
+                session.archived_at = archived_at
+                db.add(session)
+                await db.execute(delete(Message).where(Message.session_id == session_id))
+                await db.commit()
+            return len(messages), len(raw), len(data)
+        finally:
+            await generation_manager.release(session_id, holder)
+
+    async def load(self, db: AsyncSession, session: ChatSession) -> Optional[List[Message]]:
+        """读取归档会话的全部消息（按时间正序），归档已被恢复时返回None"""
+        cached = self._cache.get(session.id)
+        if cached is not None and cached[0] == session.archived_at:
+            self._cache.move_to_end(session.id)
+            ARCHIVE_HYDRATIONS.labels("cache").inc()
+            return cached[1]
+
+        archive = await db.get(SessionArchive, session.id)
+        if archive is None:
+            return None
+        messages = decode_messages(session.id, decompress(archive.data, archive.codec))
+        ARCHIVE_HYDRATIONS.labels("blob").inc()
+
+        self._cache[session.id] = (archive.archived_at, messages)
+        self._cache.move_to_end(session.id)
+        while len(self._cache) > ARCHIVE_CACHE_SESSIONS:
+            self._cache.popitem(last=False)
+        return messages
+
+    async def restore(self, session_id: str) -> bool:
+        """把归档的消息写回消息表，调用方须持有会话的生成租约"""
+        self._cache.pop(session_id, None)
+        async with AsyncSession(self.engine, expire_on_commit=False) as db:
+            session = await db.get(ChatSession, session_id, with_for_update=True)
+            if session is None or session.archived_at is None:
+                return False
+            archive = await db.get(SessionArchive, session_id)
+            if archive is not None:
+                db.add_all(decode_messages(session_id, decompress(archive.data, archive.codec)))
+                await db.delete(archive)
+            session.archived_at = None
+            db.add(session)
+            await db.commit()
+        logger.info(f"Session {session_id} restored from archive")
+        return True
+
+    async def report(self, db: AsyncSession) -> Dict:
+        """归档表的累计统计；MySQL 下附带消息表和归档表实际占用的空间"""
+        archived = (await db.execute(select(
+            func.count(),
+            func.coalesce(func.sum(SessionArchive.message_count), 0),
+            func.coalesce(func.sum(SessionArchive.raw_bytes), 0),
+            func.coalesce(func.sum(SessionArchive.compressed_bytes), 0)
+        ))).one()
+        sessions, messages, raw_bytes, compressed_bytes = (int(value) for value in archived)
+        report = {
+            "codec": self.codec,
+            "archived_sessions": sessions,
+            "archived_messages": messages,
+            "raw_bytes": raw_bytes,
+            "compressed_bytes": compressed_bytes,
+            "saved_bytes": raw_bytes - compressed_bytes,
+            "ratio": round(compressed_bytes / raw_bytes, 4) if raw_bytes else None,
+            "cached_sessions": len(self._cache)
+        }
+        if self.engine.dialect.name == "mysql":
+            rows = (await db.execute(text(
+                "SELECT table_name, data_length, index_length FROM information_schema.tables "
+                "WHERE table_schema = DATABASE() AND table_name IN ('message', 'sessionarchive')"
+            ))).all()
+            report["tables"] = {
+                name: {"data_bytes": int(data_length), "index_bytes": int(index_length)}
+                for name, data_length, index_length in rows
+            }
+        return report
+
+
+session_archiver = SessionArchiver(async_engine, redis_client)
+
+
+async def _main():
+    parser = argparse.ArgumentParser(description="归档长期不活跃的会话")
+    parser.add_argument("--limit", type=int, default=None, help="本次最多归档的会话数")
+    parser.add_argument("--older-than-days", type=float, default=None, help="默认为 ARCHIVE_AFTER_DAYS")
+    args = parser.parse_args()
+    try:
+        report = await session_archiver.run(args.limit, args.older_than_days)
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    finally:
+        await close_connections()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main())
@@ -0,0 +1,401 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional, Set
+
+from fastapi import HTTPException
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from backend.database import async_engine, redis_client
+from backend.models import BatchCreate, BatchItem, ChatSession, Message, SessionStatus
+from .admission import ADMISSION_RETRY_AFTER, AdmissionSlot, Priority, admission_controller
+from .archive import session_archiver
+from .generation_worker import GENERATION_HEARTBEAT_TTL, generation_manager
+from .history_cache import history_cache
+from .metrics import BATCH_ITEMS
+from .openai_service import get_openai_service
+from .session_summary import reply_values, user_turn_values
+from .sse_encoder import json_dumps
+from .write_behind import insert_row, update_row, write_behind
+
+logger = logging.getLogger(__name__)
+
+# 单个批量任务同时生成的条目数（默认值与上限）和条目数上限
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "32"))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "5000"))
+# 任务结果的保留时长，期间可用相同 job_id 续跑
+BATCH_JOB_TTL = int(os.getenv("BATCH_JOB_TTL", "86400"))
+JOB_LOCK_TTL = 60
+
+
+@dataclass
+class BatchJob:
+    job_id: str
+    total: int
+    concurrency: int
+    # 按会话分组的待运行条目，同一已有会话的条目按提交顺序依次生成
+    groups: List[List[BatchItem]]
+    # 之前运行中已成功的条目结果
+    completed: List[Dict] = field(default_factory=list)
+    # 指定的会话不存在的条目
+    missing: List[BatchItem] = field(default_factory=list)
+
+    @property
+    def pending(self) -> int:
+        return sum(len(group) for group in self.groups)
+
+
+class BatchRunner:
+    """批量生成：在进程内经 OpenAIService 运行多个条目，按完成顺序输出 NDJSON
+
+    各条目共用上游客户端、限流器和重试逻辑，以 BATCH 优先级占用生成名额，不挤占交互请求；
+    成功的条目经后写队列批量写入数据库，结果记入 Redis，客户端断开后用相同 job_id 重新提交即可续跑。
+    """
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self._background: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def job_key(job_id: str) -> str:
+        return f"batch:{job_id}"
+
+    @staticmethod
+    def results_key(job_id: str) -> str:
+        return f"batch:{job_id}:results"
+
+    @staticmethod
+    def lock_key(job_id: str) -> str:
+        return f"batch:{job_id}:lock"
+
+    async def prepare(self, db: AsyncSession, batch: BatchCreate) -> BatchJob:
+        """校验请求、占用任务并读取之前的结果，须在开始输出响应之前调用"""
+        if not batch.items:
+            raise HTTPException(status_code=400, detail="No items")
+        if len(batch.items) > BATCH_MAX_ITEMS:
+            raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_ITEMS} items per batch")
+        if len({item.id for item in batch.items}) != len(batch.items):
+            raise HTTPException(status_code=400, detail="Duplicate item ids")
+
+        job_id = batch.job_id or uuid.uuid4().hex
+        if not await self.redis.set(self.lock_key(job_id), "1", nx=True, ex=JOB_LOCK_TTL):
+            raise HTTPException(status_code=409, detail=f"Batch job {job_id} is already running")
+
+        try:
+            previous = await self.redis.hgetall(self.results_key(job_id))
+            completed = {}
+            for item_id, raw in previous.items():
+                result = json.loads(raw)
+                if result["status"] == "ok":
+                    completed[item_id] = result
+
+            session_ids = {item.session_id for item in batch.items if item.session_id}
+            existing = set()
+            if session_ids:
+                result = await db.exec(select(ChatSession.id).where(ChatSession.id.in_(list(session_ids))))
+                existing = set(result.all())
+
+            job = BatchJob(
+                job_id=job_id,
+                total=len(batch.items),
+                concurrency=max(min(batch.concurrency or BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY), 1),
+                groups=[],
+                completed=[completed[item.id] for item in batch.items if item.id in completed]
+            )
+            by_session: Dict[str, List[BatchItem]] = {}
+            for item in batch.items:
+                if item.id in completed:
+                    continue
+                if item.session_id is None:
+                    job.groups.append([item])
+                elif item.session_id not in existing:
+                    job.missing.append(item)
+                elif item.session_id in by_session:
+                    by_session[item.session_id].append(item)
+                else:
+                    by_session[item.session_id] = [item]
+                    job.groups.append(by_session[item.session_id])
+
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hset(self.job_key(job_id), mapping={"total": job.total})
+            pipe.expire(self.job_key(job_id), BATCH_JOB_TTL)
+            await pipe.execute()
+            return job
+        except Exception:
+            await self.redis.delete(self.lock_key(job_id))
+            raise
+
+    async def run(self, job: BatchJob):
+        """按完成顺序输出每个条目的结果，最后输出汇总"""
+        started = time.perf_counter()
+        yield self._line({
+            "type": "job",
+            "job_id": job.job_id,
+            "total": job.total,
+            "pending": job.pending,
+            "resumed": len(job.completed)
+        })
+        for result in job.completed:
+            yield self._line({**result, "resumed": True})
+
+        counts = {"ok": len(job.completed), "error": 0}
+        for item in job.missing:
+            result = await self._record(job, item, {
+                "status": "error", "session_id": item.session_id, "error": "Session not found"
+            })
+            counts["error"] += 1
+            yield self._line(result)
+
+        results: asyncio.Queue = asyncio.Queue()
+        groups: Deque[List[BatchItem]] = deque(job.groups)
+
+        async def worker():
+            while groups:
+                for item in groups.popleft():
+                    try:
+                        result = await self._run_item(job, item)
+                    except Exception as e:
+                        # 连结果也无法记录（如Redis不可用），仍要输出该条目，以免响应一直等待
+                        result = {"type": "result", "id": item.id, "status": "error", "error": str(e)}
+                    results.put_nowait(result)
+
+        tasks = [asyncio.create_task(worker()) for _ in range(min(job.concurrency, len(groups)))]
+        tasks.append(asyncio.create_task(self._hold_lock(job.job_id)))
+        try:
+            for _ in range(job.pending):
+                result = await results.get()
+                counts[result["status"]] += 1
+                yield self._line(result)
+
+            yield self._line({
+                "type": "summary",
+                "job_id": job.job_id,
+                "total": job.total,
+                "succeeded": counts["ok"],
+                "failed": counts["error"],
+                "resumed": len(job.completed),
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)
+            })
+        finally:
+            # 客户端断开时处于已取消的作用域中，收尾放在后台完成
+            for task in tasks:
+                task.cancel()
+            self._spawn(self.redis.delete(self.lock_key(job.job_id)))
+
+    async def status(self, job_id: str) -> Dict:
+        """任务进度和各条目的结果（不含回复内容）"""
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hgetall(self.job_key(job_id))
+        pipe.hgetall(self.results_key(job_id))
+        pipe.exists(self.lock_key(job_id))
+        meta, raw_results, running = await pipe.execute()
+        if not meta:
+            raise HTTPException(status_code=404, detail="Batch job not found")
+
+        results = []
+        for raw in raw_results.values():
+            result = json.loads(raw)
+            result.pop("content", None)
+            results.append(result)
+        return {
+            "job_id": job_id,
+            "running": bool(running),
+            "total": int(meta["total"]),
+            "succeeded": sum(1 for result in results if result["status"] == "ok"),
+            "failed": sum(1 for result in results if result["status"] == "error"),
+            "results": results
+        }
+
+    async def _run_item(self, job: BatchJob, item: BatchItem) -> Dict:
+        """生成一个条目并保存，失败时返回错误结果而不抛出"""
+        new_session = item.session_id is None
+        session_id = item.session_id or str(uuid.uuid4())
+        user_message = Message(session_id=session_id, role="user", content=item.content)
+        ai_message = Message(session_id=session_id, role="assistant", content="")
+
+        try:
+            slot = await self._admit()
+            try:
+                async with self._session_lease(session_id, ai_message.id, slot, new_session):
+                    content, prompt_tokens, session, retries, error = await self._generate(
+                        session_id, item, new_session
+                    )
+                    if error is None:
+                        # 在租约内写入，下一个占用租约的请求读到的会话计数才是最新的
+                        ai_message.content = content
+                        ai_message.prompt_tokens = prompt_tokens
+                        await self._save(session_id, item, user_message, ai_message, session)
+            finally:
+                await slot.release()
+
+            if error is not None:
+                return await self._record(job, item, {
+                    "status": "error",
+                    "session_id": item.session_id,
+                    "error": error,
+                    "retries": retries
+                })
+            return await self._record(job, item, {
+                "status": "ok",
+                "session_id": session_id,
+                "message_id": ai_message.id,
+                "content": content,
+                "prompt_tokens": prompt_tokens,
+                "retries": retries
+            })
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Batch {job.job_id} item {item.id} failed: {e}")
+            return await self._record(job, item, {
+                "status": "error", "session_id": item.session_id, "error": str(e)
+            })
+
+    async def _generate(self, session_id: str, item: BatchItem, new_session: bool):
+        content: List[str] = []
+        prompt_tokens = None
+        session = None
+        retries = 0
+        error = None
+
+        async with AsyncSession(async_engine, expire_on_commit=False) as db:
+            if not new_session:
+                # 本进程中该会话尚未落库的写入须先写入，再读取历史
+                await write_behind.barrier(session_id)
+                session = await db.get(ChatSession, session_id)
+                if session and session.archived_at:
+                    await session_archiver.restore(session_id)
+
+            # 本条的用户消息在生成结束后才与回复一起写入
+            chunks = get_openai_service().stream_chat_completion(
+                db, session_id, item.content, item.cache, new_session=new_session, unsaved_message=True
+            )
+            try:
+                async for chunk in chunks:
+                    if chunk["type"] == "content":
+                        content.append(chunk["content"])
+                    elif chunk["type"] == "context":
+                        prompt_tokens = chunk["prompt_tokens"]
+                        # 历史已读取，生成期间不占用数据库连接
+                        await db.close()
+                    elif chunk["type"] == "retry":
+                        retries += 1
+                    elif chunk["type"] == "done":
+                        break
+                    elif chunk["type"] == "error":
+                        error = chunk["error"]
+                        break
+            finally:
+                await chunks.aclose()
+
+        return "".join(content), prompt_tokens, session, retries, error
+
+    @staticmethod
+    async def _save(
+            session_id: str,
+            item: BatchItem,
+            user_message: Message,
+            ai_message: Message,
+            session: Optional[ChatSession]
+    ):
+        """会话和两条消息作为一组写入，经后写队列合并为批量插入；session 为空表示新建会话"""
+        history = [message for message in (user_message, ai_message) if history_cache.is_history(message)]
+        base = session or ChatSession(id=session_id, title=item.title)
+        history_version = base.history_version
+        summary = {
+            **user_turn_values(base, user_message.content),
+            **reply_values(base, ai_message.content, ai_message.prompt_tokens)
+        }
+        rows = []
+        if session is None:
+            rows.append(insert_row(ChatSession(
+                id=session_id,
+                title=item.title,
+                last_message_id=ai_message.id,
+                history_version=len(history),
+                **summary
+            )))
+        else:
+            rows.append(update_row(
+                ChatSession, session_id, session_id,
+                last_message_id=ai_message.id,
+                status=SessionStatus.ACTIVE,
+                history_version=history_version + len(history),
+                **summary
+            ))
+        rows.extend([insert_row(user_message), insert_row(ai_message)])
+        await write_behind.put(*rows)
+
+        if session is not None:
+            for offset, message in enumerate(history, start=1):
+                await history_cache.append(session_id, message, history_version + offset)
+
+    async def _record(self, job: BatchJob, item: BatchItem, result: Dict) -> Dict:
+        result = {"type": "result", "id": item.id, **result}
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hset(self.results_key(job.job_id), item.id, json.dumps(result, ensure_ascii=False))
+        pipe.expire(self.results_key(job.job_id), BATCH_JOB_TTL)
+        await pipe.execute()
+        BATCH_ITEMS.labels(result["status"]).inc()
+        return result
+
+    @staticmethod
+    async def _admit() -> AdmissionSlot:
+        """批量条目不因排队超时失败，名额不足时稍后再试"""
+        while True:
+            try:
+                return await admission_controller.admit(Priority.BATCH)
+            except HTTPException as e:
+                if e.status_code != 503:
+                    raise
+                await asyncio.sleep(ADMISSION_RETRY_AFTER)
+
+    @asynccontextmanager
+    async def _session_lease(self, session_id: str, message_id: str, slot: AdmissionSlot, new_session: bool):
+        """已有会话占用生成租约，与交互请求互斥；生成期间续期租约和名额"""
+        if not new_session and await generation_manager.reserve(session_id, message_id) is not None:
+            raise RuntimeError("Session already has an active generation")
+
+        async def renew():
+            while True:
+                await asyncio.sleep(GENERATION_HEARTBEAT_TTL / 3)
+                if not new_session:
+                    await self.redis.expire(generation_manager.session_key(session_id), GENERATION_HEARTBEAT_TTL)
+                await slot.renew()
+
+        renewer = asyncio.create_task(renew())
+        try:
+            yield
+        finally:
+            renewer.cancel()
+            if not new_session:
+                try:
+                    # 写入落库后才释放租约，与交互请求的生成任务一致
+                    await write_behind.barrier(session_id)
+                finally:
+                    await generation_manager.release(session_id, message_id)
+
+    async def _hold_lock(self, job_id: str):
+        while True:
+            await asyncio.sleep(JOB_LOCK_TTL / 3)
+            await self.redis.expire(self.lock_key(job_id), JOB_LOCK_TTL)
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    @staticmethod
+    def _line(data: Dict) -> bytes:
+        return json_dumps(data) + b"\n"
+
+
+batch_runner = BatchRunner(redis_client)
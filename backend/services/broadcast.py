@@ -0,0 +1,92 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, Optional, Set
+
+from backend.database import redis_client
+
+logger = logging.getLogger(__name__)
+
+Listener = Callable[[str], None]
+
+
+class Broadcaster:
+    """进程内共用一个Redis pub/sub连接，把频道消息分发给本进程的订阅者
+
+    订阅者是同步回调，在读取任务中调用，不能阻塞；退订在后台完成，
+    客户端断开时（调用方处于已取消的作用域中）也能正确清理。
+    """
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self._pubsub = None
+        self._listeners: Dict[str, Set[Listener]] = {}
+        self._reader: Optional[asyncio.Task] = None
+        self._background: Set[asyncio.Task] = set()
+
+    async def publish(self, channel: str, data: str) -> int:
+        return await self.redis.publish(channel, data)
+
+    @asynccontextmanager
+    async def listen(self, channel: str, listener: Listener):
+        """在作用域内接收频道消息"""
+        listeners = self._listeners.get(channel)
+        if listeners is None:
+            listeners = self._listeners[channel] = set()
+            try:
+                if self._pubsub is None:
+                    self._pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                await self._pubsub.subscribe(channel)
+            except BaseException:
+                # 订阅失败时不留下空的订阅者集合，否则之后的订阅者会误以为频道已订阅
+                if self._listeners.get(channel) is listeners:
+                    del self._listeners[channel]
+                    self._schedule_unsubscribe(channel)
+                raise
+            if self._reader is None or self._reader.done():
+                self._reader = asyncio.create_task(self._read())
+        listeners.add(listener)
+        try:
+            yield
+        finally:
+            listeners.discard(listener)
+            if not listeners and self._listeners.get(channel) is listeners:
+                del self._listeners[channel]
+                self._schedule_unsubscribe(channel)
+
+    def _schedule_unsubscribe(self, channel: str):
+        task = asyncio.create_task(self._unsubscribe(channel))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _unsubscribe(self, channel: str):
+        # 期间可能有新的订阅者
+        if channel not in self._listeners and self._pubsub is not None:
+            await self._pubsub.unsubscribe(channel)
+
+    async def _read(self):
+        while self._listeners:
+            try:
+                message = await self._pubsub.get_message(timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Pub/sub read failed: {e}")
+                await asyncio.sleep(1.0)
+                continue
+            if not message or message["type"] != "message":
+                continue
+            for listener in list(self._listeners.get(message["channel"], ())):
+                listener(message["data"])
+
+    async def close(self):
+        for task in [self._reader, *self._background]:
+            if task:
+                task.cancel()
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+            self._pubsub = None
+        self._listeners.clear()
+
+
+broadcaster = Broadcaster(redis_client)
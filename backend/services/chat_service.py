@@ -1,169 +1,432 @@
-import json
+import asyncio
+import os
+from contextlib import AsyncExitStack
+from typing import Optional, Set
 
-from backend.models import Message
-from sqlmodel import Session
+from fastapi import HTTPException, Request
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from .openai_service import OpenAIService
+from backend.models import ChatSession, Message, MessageCreate, SessionStatus
+from .admission import AdmissionSlot, Priority, admission_controller
+from .archive import session_archiver
+from .broadcast import broadcaster
+from .generation_worker import STREAM_DISCONNECT_MODE, generation_manager
+from .history_cache import history_cache
+from .idempotency import idempotency_store
+from .metrics import ACTIVE_STREAMS, REDIS_WRITE
+from .session_state import session_state
+from .session_summary import user_turn_values
+from .sse_encoder import ContentCoalescer, SSEEncoder
+from .stream_log import StreamLog
+from .write_behind import insert_row, update_row, write_behind
+
+STREAM_POLL_INTERVAL = float(os.getenv("STREAM_POLL_INTERVAL", "0.5"))
+DISCONNECT_POLL_INTERVAL = 1.0
+# 只读订阅在两次生成之间发送注释帧，防止代理因空闲断开连接
+SSE_KEEPALIVE_INTERVAL = float(os.getenv("SSE_KEEPALIVE_INTERVAL", "15"))
+
+# SSE协议版本：2 只发送增量并带 id（字符偏移）；1 为旧格式，每帧携带 accumulated
+SSE_PROTOCOL_VERSION = int(os.getenv("SSE_PROTOCOL_VERSION", "2"))
 
 
 class ChatService:
-    def __init__(self, db: Session, redis_client):
+    def __init__(
+            self,
+            db: AsyncSession,
+            redis_client,
+            protocol: int = SSE_PROTOCOL_VERSION,
+            request: Optional[Request] = None,
+            encoder: Optional[SSEEncoder] = None
+    ):
         self.db = db
         self.redis = redis_client
-        self.openai_service = OpenAIService()
+        self.log = StreamLog(redis_client)
+        self.generations = generation_manager
+        self.legacy = protocol < 2
+        # 默认编码为SSE帧；其他传输（如WebSocket）传入自己的编码器，事件内容不变
+        self.encoder = encoder or SSEEncoder(self.legacy)
+        self.request = request
+        # 本连接当前登记为读者的消息
+        self._attached: Set[str] = set()
+
+    def _sse(self, data: dict, offset: int) -> bytes:
+        return self.encoder.encode(data, offset)
+
+    async def open_completion(
+            self,
+            session_id: str,
+            message: MessageCreate,
+            idempotency_key: Optional[str] = None
+    ):
+        """发起一轮对话：写入用户消息和回复占位并启动生成，返回该回复的帧生成器
 
-    async def stream_response(self, session_id: str, message_id: str, user_input: str):
-        """使用OpenAI GPT-4进行流式响应"""
-        accumulated_content = ""
+        会话不存在（404）、过载（503）或会话正在生成（409）时抛出 HTTPException，此时不写入任何数据。
+        """
+        # 验证会话存在
+        session = await self.db.get(ChatSession, session_id)
+        if not session:
+            raise HTTPException(status_code=404, detail="Session not found")
+
+        # 客户端重试：接入首个请求的生成结果
+        if idempotency_key:
+            existing_message_id = await idempotency_store.claim(session_id, idempotency_key)
+            if existing_message_id:
+                return self.attach_response(existing_message_id)
+
+        # 保存用户消息
+        user_message = Message(
+            session_id=session_id,
+            role="user",
+            content=message.content
+        )
+
+        # 创建AI消息占位符
+        ai_message = Message(
+            session_id=session_id,
+            role="assistant",
+            content="",
+            is_streaming=True
+        )
 
         try:
-            async for chunk in self.openai_service.stream_chat_completion(
-                    self.db, session_id, user_input
-            ):
-                if chunk["type"] == "content":
-                    accumulated_content += chunk["content"]
-
-                    # 构造SSE格式的数据
-                    data = {
-                        "type": "content",
-                        "content": chunk["content"],
-                        "message_id": message_id,
-                        "accumulated": accumulated_content
-                    }
+            # 过载时在写入任何数据之前排队或拒绝
+            slot = await admission_controller.admit(Priority.NEW)
+        except HTTPException:
+            if idempotency_key:
+                await idempotency_store.release(session_id, idempotency_key)
+            raise
 
-                    yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+        # 每个会话同时只允许一个生成任务
+        active_message_id = await self.generations.reserve(session_id, ai_message.id)
+        if active_message_id:
+            await slot.release()
+            if idempotency_key:
+                await idempotency_store.release(session_id, idempotency_key)
+            raise HTTPException(
+                status_code=409,
+                detail=f"Session already has an active generation: {active_message_id}"
+            )
 
-                    # 更新Redis中的当前内容
-                    self.redis.hset(f"message:{message_id}", "content", accumulated_content)
+        try:
+            # 上一轮生成在释放会话租约前才把回复落库，占到租约后重新读取历史版本
+            await self.db.refresh(session, ["history_version", "archived_at", "message_count"])
+            if session.archived_at:
+                # 归档的会话先把消息写回消息表，之后按普通会话生成
+                await session_archiver.restore(session_id)
+            history_version = session.history_version
+            if history_cache.is_history(user_message):
+                history_version += 1
 
-                elif chunk["type"] == "done":
-                    # 流式完成，更新数据库
-                    message = self.db.get(Message, message_id)
-                    if message:
-                        message.content = accumulated_content
-                        message.is_streaming = False
-                        self.db.commit()
+            # 消息和会话状态经后写队列批量落库，不阻塞响应
+            await write_behind.put(
+                insert_row(user_message),
+                insert_row(ai_message),
+                update_row(
+                    ChatSession, session_id, session_id,
+                    last_message_id=ai_message.id,
+                    status=SessionStatus.ACTIVE,
+                    history_version=history_version,
+                    **user_turn_values(session, message.content)
+                )
+            )
+        except Exception:
+            await slot.release()
+            await self.generations.release(session_id, ai_message.id)
+            if idempotency_key:
+                await idempotency_store.release(session_id, idempotency_key)
+            raise
 
-                    # 清理Redis流式状态
-                    self.redis.hdel(f"session:{session_id}", "current_message_id", "status")
-                    self.redis.delete(f"message:{message_id}")
+        # 不再等待提交，主动结束只读事务，避免整个流式响应期间占用数据库连接
+        await self.db.close()
 
-                    # 发送完成信号
-                    completion_data = {
-                        "type": "done",
-                        "message_id": message_id,
-                        "total_content": accumulated_content
-                    }
-                    yield f"data: {json.dumps(completion_data, ensure_ascii=False)}\n\n"
-                    break
+        if idempotency_key:
+            await idempotency_store.bind(session_id, idempotency_key, ai_message.id)
 
-                elif chunk["type"] == "retry":
-                    # 转发重试信息给前端
-                    retry_data = {
-                        "type": "retry",
-                        "message": chunk["message"],
-                        "attempt": chunk["attempt"]
-                    }
-                    yield f"data: {json.dumps(retry_data, ensure_ascii=False)}\n\n"
-
-                elif chunk["type"] == "error":
-                    raise Exception(chunk["error"])
-
-        except Exception as e:
-            # 保存已生成的部分内容
-            if accumulated_content:
-                message = self.db.get(Message, message_id)
-                if message:
-                    message.content = accumulated_content
-                    message.is_streaming = False
-                    self.db.commit()
-
-            error_data = {
-                "type": "error",
-                "error": str(e),
-                "message_id": message_id,
-                "partial_content": accumulated_content
-            }
-            yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
+        # 写穿历史缓存
+        if history_cache.is_history(user_message):
+            await history_cache.append(session_id, user_message, history_version)
 
-    async def continue_stream_response(self, session_id: str, message_id: str, user_input: str):
-        """继续中断的OpenAI流式响应"""
-        existing_content = self.redis.hget(f"message:{message_id}", "content") or ""
-        accumulated_content = existing_content
+        # 在Redis中存储流式状态
+        with REDIS_WRITE.labels("session_state").time():
+            await session_state.start(session_id, ai_message.id, user_message.id)
 
-        try:
-            # 先发送恢复信号
+        await self.start_generation(session_id, ai_message.id, message.content, slot, message.cache)
+        return self.stream_response(ai_message.id)
+
+    async def open_continue(self, session_id: str, last_event_id: Optional[int] = None):
+        """续传会话中断的回复（生成任务已不存在时重新发起续写），返回帧生成器"""
+        # 检查会话状态
+        session = await self.db.get(ChatSession, session_id)
+        if not session:
+            raise HTTPException(status_code=404, detail="Session not found")
+
+        # 从Redis获取中断的流式状态
+        state = await session_state.get(session_id)
+        if not state:
+            raise HTTPException(status_code=400, detail="No active streaming to continue")
+
+        message_id = state.message_id
+        last_user_message = state.user_message
+        if last_user_message is None and state.user_message_id:
+            # 用户消息可能还在本进程的后写队列中
+            await write_behind.barrier(session_id)
+            user_message = await self.db.get(Message, state.user_message_id)
+            last_user_message = user_message.content if user_message else None
+
+        if not last_user_message:
+            raise HTTPException(status_code=400, detail="Invalid session state")
+
+        # 续传只读取生成日志，结束只读事务以免整个流式响应期间占用数据库连接
+        await self.db.close()
+
+        await self.resume_generation(session_id, message_id, last_user_message)
+        return self.continue_stream_response(message_id, last_event_id)
+
+    async def open_watch(self, session_id: str):
+        """只读订阅会话，返回帧生成器"""
+        session = await self.db.get(ChatSession, session_id)
+        if not session:
+            raise HTTPException(status_code=404, detail="Session not found")
+        await self.db.close()
+        return self.watch_session(session_id)
+
+    async def start_generation(
+            self,
+            session_id: str,
+            message_id: str,
+            user_input: str,
+            slot: AdmissionSlot,
+            use_cache: Optional[bool] = None
+    ):
+        """用已获得的生成名额启动后台生成任务"""
+        await self.generations.start(session_id, message_id, user_input, use_cache=use_cache, slot=slot)
+
+    async def resume_generation(self, session_id: str, message_id: str, user_input: str):
+        """生成任务已不存在（进程重启或出错）时，基于日志中已有内容重新发起续写
+
+        续写优先于新对话获得生成名额；名额不足时抛出503。
+        """
+        if await self.generations.is_running(message_id):
+            return
+        existing_content, _, final_event = StreamLog.fold(await self.log.read(message_id))
+        if final_event and final_event["type"] == "done":
+            return
+        if not existing_content:
+            # 日志已过期：从数据库中保存的部分内容续写，读取后立即归还连接
+            message = await self.db.get(Message, message_id)
+            existing_content = message.content if message else ""
+            await self.db.close()
+            if existing_content:
+                # 写回日志，读者的偏移与数据库中的内容保持一致
+                await self.log.append(message_id, {"type": "content", "content": existing_content})
+                await self.log.expire(message_id)
+
+        slot = await admission_controller.admit(Priority.CONTINUE)
+        await session_state.resume(session_id)
+        await self.generations.start(session_id, message_id, user_input, existing_content, slot=slot)
+
+    async def stream_response(self, message_id: str):
+        """从头读取该消息的生成日志"""
+        async for frame in self._tail(message_id, "0-0", ""):
+            yield frame
+
+    async def attach_response(self, message_id: str):
+        """重复请求接入已有消息的生成结果，不再发起新的生成"""
+        if await self.log.last(message_id) is None and not await self.generations.is_running(message_id):
+            # 日志已过期，直接返回数据库中已保存的回复
+            message = await self.db.get(Message, message_id)
+            if message and not message.is_streaming:
+                offset = len(message.content)
+                data = {"type": "content", "content": message.content, "message_id": message_id}
+                if self.legacy:
+                    data["accumulated"] = message.content
+                yield self._sse(data, offset)
+                yield self._sse(self._done_data(message_id, message.content), offset)
+                return
+
+        async for frame in self._tail(message_id, "0-0", ""):
+            yield frame
+
+    async def watch_session(self, session_id: str):
+        """只读订阅会话：先发送当前回复的快照，再推送增量，之后跟随该会话的每一次新生成
+
+        不发起生成，也不占用生成名额；任意进程中的生成任务都可被订阅。
+        """
+        started: asyncio.Queue = asyncio.Queue()
+        # 已完整推送的回复，重复的开始通知（如续写）不再推送
+        finished: Set[str] = set()
+
+        # 先订阅再读取当前状态，以免错过两者之间开始的生成
+        async with broadcaster.listen(self.generations.events_channel(session_id), started.put_nowait):
+            state = await session_state.get(session_id)
+            message_id = state.message_id if state else None
+
+            while True:
+                if message_id and message_id not in finished:
+                    async for frame in self.continue_stream_response(message_id):
+                        yield frame
+                    last = await self.log.last(message_id)
+                    if last and last.get("type") == "done":
+                        finished.add(message_id)
+
+                try:
+                    message_id = await asyncio.wait_for(started.get(), SSE_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    message_id = None
+                    yield self.encoder.KEEPALIVE
+
+    async def continue_stream_response(self, message_id: str, last_event_id: Optional[int] = None):
+        """恢复中断的流式响应：先补发已生成的内容，再接续日志
+
+        last_event_id 为客户端已收到的字符偏移（Last-Event-ID），只补发其后的内容。
+        """
+        existing_content, last_id, final_event = StreamLog.fold(await self.log.read(message_id))
+        offset = len(existing_content)
+
+        # 先发送恢复信号
+        if self.legacy:
             resume_data = {
                 "type": "resume",
                 "message_id": message_id,
                 "existing_content": existing_content
             }
-            yield f"data: {json.dumps(resume_data, ensure_ascii=False)}\n\n"
-
-            # 继续OpenAI流式输出
-            async for chunk in self.openai_service.continue_chat_completion(
-                    self.db, session_id, user_input, existing_content
-            ):
-                if chunk["type"] == "content":
-                    accumulated_content += chunk["content"]
-
-                    data = {
-                        "type": "content",
-                        "content": chunk["content"],
-                        "message_id": message_id,
-                        "accumulated": accumulated_content
-                    }
+        else:
+            resume_from = min(max(last_event_id or 0, 0), offset)
+            resume_data = {
+                "type": "resume",
+                "message_id": message_id,
+                "offset": resume_from,
+                "existing_content": existing_content[resume_from:]
+            }
+        yield self._sse(resume_data, offset)
 
-                    yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+        if final_event and final_event["type"] == "done":
+            yield self._sse(self._done_data(message_id, existing_content), offset)
+            return
 
-                    # 更新Redis
-                    self.redis.hset(f"message:{message_id}", "content", accumulated_content)
+        async for frame in self._tail(message_id, last_id, existing_content):
+            yield frame
 
-                elif chunk["type"] == "done":
-                    # 完成处理
-                    message = self.db.get(Message, message_id)
-                    if message:
-                        message.content = accumulated_content
-                        message.is_streaming = False
-                        self.db.commit()
+    def _done_data(self, message_id: str, accumulated_content: str) -> dict:
+        completion_data = {"type": "done", "message_id": message_id}
+        if self.legacy:
+            completion_data["total_content"] = accumulated_content
+        return completion_data
 
-                    # 清理状态
-                    self.redis.hdel(f"session:{session_id}", "current_message_id", "status")
-                    self.redis.delete(f"message:{message_id}")
+    async def _watch_disconnect(self, message_id: str):
+        """生成器只能在下一次 yield 时发现连接已断开，由独立任务轮询连接状态"""
+        while not await self.request.is_disconnected():
+            await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+        self._detach(message_id)
 
-                    completion_data = {
-                        "type": "done",
-                        "message_id": message_id,
-                        "total_content": accumulated_content
-                    }
-                    yield f"data: {json.dumps(completion_data, ensure_ascii=False)}\n\n"
-                    break
+    def _detach(self, message_id: str):
+        if message_id in self._attached:
+            self._attached.discard(message_id)
+            self.generations.detach_reader(message_id)
+
+    async def _tail(self, message_id: str, last_id: str, existing_content: str):
+        """登记为该消息的读者，并在断开时注销，读取逻辑见 _read_log"""
+        await self.generations.attach_reader(message_id)
+        self._attached.add(message_id)
+        ACTIVE_STREAMS.inc()
+        watcher = None
+        if self.request is not None and STREAM_DISCONNECT_MODE == "cancel":
+            watcher = asyncio.create_task(self._watch_disconnect(message_id))
+        try:
+            async with AsyncExitStack() as stack:
+                if not self.generations.is_local(message_id):
+                    # 生成任务在其他进程中，通过pub/sub及时获知日志更新，不必等待轮询
+                    await stack.enter_async_context(broadcaster.listen(
+                        StreamLog.notify_channel(message_id),
+                        lambda _: self.generations.notify(message_id)
+                    ))
+                async for frame in self._read_log(message_id, last_id, existing_content):
+                    yield frame
+        finally:
+            ACTIVE_STREAMS.dec()
+            if watcher:
+                watcher.cancel()
+            self._detach(message_id)
+
+    async def _read_log(self, message_id: str, last_id: str, existing_content: str):
+        """从last_id之后持续读取生成日志，转换为SSE帧，直到完成或出错"""
+        # 新协议只需要偏移量，旧协议才需要维护完整的累积内容
+        accumulated_content = existing_content
+        offset = len(existing_content)
+        coalescer = ContentCoalescer()
+
+        while True:
+            event = self.generations.watch(message_id)
+            entries = await self.log.read(message_id, last_id)
+
+            if not entries:
+                if coalescer.due():
+                    yield self._content_frame(message_id, coalescer.take(), offset, accumulated_content)
+                    continue
+                if await self.generations.is_running(message_id):
+                    await self.generations.wait(event, coalescer.timeout(STREAM_POLL_INTERVAL))
+                    continue
+
+                # 生成任务已结束，再读一次以免错过最后写入的条目
+                entries = await self.log.read(message_id, last_id)
+                if not entries:
+                    if coalescer.pending:
+                        yield self._content_frame(message_id, coalescer.take(), offset, accumulated_content)
+                    yield self._sse(self._error_data(message_id, "生成任务已中断", accumulated_content), offset)
+                    return
+
+            for entry_id, fields in entries:
+                last_id = entry_id
+
+                if fields["type"] == "content":
+                    offset += len(fields["content"])
+                    if self.legacy:
+                        accumulated_content += fields["content"]
+                    if coalescer.add(fields["content"]):
+                        yield self._content_frame(message_id, coalescer.take(), offset, accumulated_content)
+                    continue
 
-                elif chunk["type"] == "retry":
+                # 控制事件之前先发送缓冲的内容
+                if coalescer.pending:
+                    yield self._content_frame(message_id, coalescer.take(), offset, accumulated_content)
+
+                if fields["type"] == "retry":
                     # 转发重试信息给前端
                     retry_data = {
                         "type": "retry",
-                        "message": chunk["message"],
-                        "attempt": chunk["attempt"]
+                        "message": fields["message"],
+                        "attempt": int(fields["attempt"])
                     }
-                    yield f"data: {json.dumps(retry_data, ensure_ascii=False)}\n\n"
-
-                elif chunk["type"] == "error":
-                    raise Exception(chunk["error"])
-
-        except Exception as e:
-            # 保存部分内容
-            if accumulated_content != existing_content:
-                message = self.db.get(Message, message_id)
-                if message:
-                    message.content = accumulated_content
-                    message.is_streaming = False
-                    self.db.commit()
-
-            error_data = {
-                "type": "error",
-                "error": str(e),
+                    yield self._sse(retry_data, offset)
+
+                elif fields["type"] == "done":
+                    # 发送完成信号
+                    yield self._sse(self._done_data(message_id, accumulated_content), offset)
+                    return
+
+                elif fields["type"] == "error":
+                    yield self._sse(self._error_data(message_id, fields["error"], accumulated_content), offset)
+                    return
+
+            if coalescer.due():
+                yield self._content_frame(message_id, coalescer.take(), offset, accumulated_content)
+
+    def _content_frame(self, message_id: str, content: str, offset: int, accumulated_content: str) -> bytes:
+        if self.legacy:
+            return self._sse({
+                "type": "content",
+                "content": content,
                 "message_id": message_id,
-                "partial_content": accumulated_content
-            }
-            yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
+                "accumulated": accumulated_content
+            }, offset)
+        return self.encoder.content(message_id, content, offset)
+
+    def _error_data(self, message_id: str, error: str, accumulated_content: str) -> dict:
+        error_data = {
+            "type": "error",
+            "error": error,
+            "message_id": message_id
+        }
+        if self.legacy:
+            error_data["partial_content"] = accumulated_content
+        return error_data
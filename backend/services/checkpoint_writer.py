@@ -0,0 +1,100 @@
+import asyncio
+import os
+from typing import Callable, Dict, List, Optional
+
+from .metrics import REDIS_WRITE
+from .stream_log import STREAM_LOG_TTL, StreamLog
+
+# 合并写入阈值：间隔越小续传越精确，Redis写入越频繁；间隔为0时每个片段立即写入
+CHECKPOINT_FLUSH_INTERVAL_MS = int(os.getenv("CHECKPOINT_FLUSH_INTERVAL_MS", "50"))
+CHECKPOINT_FLUSH_BYTES = int(os.getenv("CHECKPOINT_FLUSH_BYTES", "1024"))
+
+
+class CheckpointWriter:
+    """生成日志的增量写入器
+
+    只追加新增的内容片段，按时间或大小阈值合并后通过pipeline一次写入；
+    控制事件（retry/done/error）会连同缓冲内容立即写入。
+    """
+
+    def __init__(
+            self,
+            redis_client,
+            message_id: str,
+            on_flush: Optional[Callable[[], None]] = None,
+            flush_interval_ms: int = CHECKPOINT_FLUSH_INTERVAL_MS,
+            flush_bytes: int = CHECKPOINT_FLUSH_BYTES
+    ):
+        self.redis = redis_client
+        self.key = StreamLog.key(message_id)
+        self.channel = StreamLog.notify_channel(message_id)
+        self.on_flush = on_flush
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_bytes = flush_bytes
+
+        self._buffer: List[str] = []
+        self._buffered_bytes = 0
+        self._events: List[Dict] = []
+        self._timer: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self._flushed_once = False
+
+    async def write(self, content: str):
+        """缓冲一个内容片段，首个片段立即写入以降低首字延迟"""
+        self._buffer.append(content)
+        self._buffered_bytes += len(content.encode("utf-8"))
+
+        if (not self._flushed_once
+                or self.flush_interval <= 0
+                or self._buffered_bytes >= self.flush_bytes):
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def write_event(self, event: Dict):
+        """写入控制事件，之前缓冲的内容先于事件写入"""
+        self._events.append(event)
+        await self.flush()
+
+    async def flush(self):
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+        self._timer = None
+
+        async with self._lock:
+            if not self._buffer and not self._events:
+                return
+
+            buffer, events = self._buffer, self._events
+            self._buffer, self._buffered_bytes, self._events = [], 0, []
+
+            pipe = self.redis.pipeline(transaction=False)
+            if buffer:
+                pipe.xadd(self.key, {"type": "content", "content": "".join(buffer)})
+            for event in events:
+                pipe.xadd(self.key, event)
+            if not self._flushed_once:
+                # 生成过程中由心跳续期，进程崩溃后日志也会过期
+                pipe.expire(self.key, STREAM_LOG_TTL)
+            pipe.publish(self.channel, "1")
+            try:
+                with REDIS_WRITE.labels("checkpoint").time():
+                    await pipe.execute()
+            except Exception:
+                # 写入失败时放回缓冲区，下次写入时重试
+                self._buffer = buffer + self._buffer
+                self._buffered_bytes = sum(len(part.encode("utf-8")) for part in self._buffer)
+                self._events = events + self._events
+                raise
+
+            self._flushed_once = True
+            if self.on_flush:
+                self.on_flush()
+
+    async def close(self):
+        """最终写入，确保缓冲内容全部落到日志中"""
+        await self.flush()
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
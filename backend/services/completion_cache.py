@@ -0,0 +1,120 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import AsyncGenerator, Dict, List, Optional
+
+from backend.database import redis_client
+
+# off：全部关闭；temperature_zero：仅 temperature 为 0 时默认启用；always：默认启用
+COMPLETION_CACHE_MODE = os.getenv("COMPLETION_CACHE_MODE", "temperature_zero")
+COMPLETION_CACHE_TTL = int(os.getenv("COMPLETION_CACHE_TTL", "86400"))
+COMPLETION_CACHE_MAX_ENTRIES = int(os.getenv("COMPLETION_CACHE_MAX_ENTRIES", "10000"))
+# 命中时按片段回放，延迟为0时不做节流
+COMPLETION_CACHE_REPLAY_CHUNK_CHARS = int(os.getenv("COMPLETION_CACHE_REPLAY_CHUNK_CHARS", "16"))
+COMPLETION_CACHE_REPLAY_DELAY_MS = int(os.getenv("COMPLETION_CACHE_REPLAY_DELAY_MS", "0"))
+
+LRU_KEY = "completion_cache:lru"
+STATS_KEY = "completion_cache:stats"
+
+
+class CompletionCache:
+    """按规范化提示精确匹配的回复缓存，带TTL和按最近访问淘汰的容量上限"""
+
+    def __init__(self, redis_client, mode: str = COMPLETION_CACHE_MODE):
+        self.redis = redis_client
+        self.mode = mode
+
+    @staticmethod
+    def key(digest: str) -> str:
+        return f"completion_cache:{digest}"
+
+    @staticmethod
+    def make_digest(model: str, temperature: float, max_tokens: int, messages: List[Dict[str, str]]) -> str:
+        normalized = [
+            {"role": message["role"], "content": " ".join(message["content"].split())}
+            for message in messages
+        ]
+        payload = json.dumps(
+            {"model": model, "temperature": temperature, "max_tokens": max_tokens, "messages": normalized},
+            ensure_ascii=False, sort_keys=True, separators=(",", ":")
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def enabled(self, temperature: float, requested: Optional[bool] = None) -> bool:
+        """请求显式指定时以请求为准，否则 temperature_zero 模式下只缓存确定性的回复"""
+        if self.mode == "off":
+            return False
+        if requested is not None:
+            return requested
+        return self.mode == "always" or (self.mode == "temperature_zero" and temperature == 0)
+
+    async def get(self, digest: str) -> Optional[str]:
+        content = await self.redis.get(self.key(digest))
+        pipe = self.redis.pipeline(transaction=False)
+        if content is None:
+            pipe.hincrby(STATS_KEY, "misses", 1)
+        else:
+            pipe.hincrby(STATS_KEY, "hits", 1)
+            pipe.zadd(LRU_KEY, {digest: time.time()})
+        await pipe.execute()
+        return content
+
+    async def set(self, digest: str, content: str):
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set(self.key(digest), content, ex=COMPLETION_CACHE_TTL)
+        pipe.zadd(LRU_KEY, {digest: now})
+        # 清理已过期条目的LRU记录
+        pipe.zremrangebyscore(LRU_KEY, "-inf", now - COMPLETION_CACHE_TTL)
+        pipe.zcard(LRU_KEY)
+        pipe.hincrby(STATS_KEY, "stores", 1)
+        *_, size, _ = await pipe.execute()
+
+        overflow = size - COMPLETION_CACHE_MAX_ENTRIES
+        if overflow > 0:
+            evicted = await self.redis.zpopmin(LRU_KEY, overflow)
+            if evicted:
+                pipe = self.redis.pipeline(transaction=False)
+                pipe.delete(*[self.key(member) for member, _ in evicted])
+                pipe.hincrby(STATS_KEY, "evictions", len(evicted))
+                await pipe.execute()
+
+    async def stats(self) -> Dict:
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hgetall(STATS_KEY)
+        pipe.zcard(LRU_KEY)
+        counters, entries = await pipe.execute()
+        hits = int(counters.get("hits", 0))
+        misses = int(counters.get("misses", 0))
+        return {
+            "mode": self.mode,
+            "hits": hits,
+            "misses": misses,
+            "stores": int(counters.get("stores", 0)),
+            "evictions": int(counters.get("evictions", 0)),
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "entries": entries
+        }
+
+    @staticmethod
+    async def replay(content: str) -> AsyncGenerator[Dict, None]:
+        """把缓存的回复还原为与上游相同格式的流式片段"""
+        step = max(COMPLETION_CACHE_REPLAY_CHUNK_CHARS, 1)
+        for start in range(0, len(content), step):
+            if start and COMPLETION_CACHE_REPLAY_DELAY_MS > 0:
+                await asyncio.sleep(COMPLETION_CACHE_REPLAY_DELAY_MS / 1000)
+            yield {
+                "type": "content",
+                "content": content[start:start + step],
+                "finish_reason": None
+            }
+        yield {
+            "type": "done",
+            "finish_reason": "stop",
+            "cached": True
+        }
+
+
+completion_cache = CompletionCache(redis_client)
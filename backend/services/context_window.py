@@ -0,0 +1,132 @@
+import importlib
+import logging
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 历史消息（含系统提示和摘要）的token预算
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+# 未摘要部分超过该值时在后台生成滚动摘要
+CONTEXT_SUMMARY_THRESHOLD = int(os.getenv("CONTEXT_SUMMARY_THRESHOLD", "3000"))
+# heuristic / tiktoken / 自定义 "module:ClassName"
+CONTEXT_TOKENIZER = os.getenv("CONTEXT_TOKENIZER", "heuristic")
+
+# 每条消息的角色、分隔符等额外开销
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_CJK_PATTERN = re.compile(r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+class HeuristicTokenizer:
+    """无依赖的估算：中日韩字符按1个token计，其余约4个字符1个token"""
+
+    def count(self, text: str) -> int:
+        cjk = len(_CJK_PATTERN.findall(text))
+        return cjk + (len(text) - cjk + 3) // 4
+
+
+class TiktokenTokenizer:
+    def __init__(self, model: str):
+        import tiktoken
+        try:
+            self.encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            self.encoding = tiktoken.get_encoding("cl100k_base")
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text))
+
+
+def get_tokenizer(name: str, model: str):
+    """按配置创建分词器，依赖缺失时退回估算"""
+    try:
+        if name == "tiktoken":
+            return TiktokenTokenizer(model)
+        if ":" in name:
+            module_name, class_name = name.split(":", 1)
+            return getattr(importlib.import_module(module_name), class_name)()
+    except Exception as e:
+        logger.warning(f"Tokenizer {name} unavailable, falling back to heuristic: {e}")
+    return HeuristicTokenizer()
+
+
+@dataclass
+class ContextWindow:
+    messages: List[Dict[str, str]]
+    prompt_tokens: int
+    history_count: int
+    dropped_count: int
+    # 需要折叠进摘要的历史区间 [summarized_count, summarize_upto)，为None表示无需摘要
+    summarize_upto: Optional[int] = None
+    summarize_entries: List[Dict] = field(default_factory=list)
+
+
+class ContextBuilder:
+    """在token预算内组装提示：系统提示 + 滚动摘要 + 最近的若干轮对话"""
+
+    def __init__(
+            self,
+            tokenizer,
+            budget: int = CONTEXT_TOKEN_BUDGET,
+            summary_threshold: int = CONTEXT_SUMMARY_THRESHOLD
+    ):
+        self.tokenizer = tokenizer
+        self.budget = budget
+        self.summary_threshold = summary_threshold
+
+    def count_message(self, message: Dict[str, str]) -> int:
+        return self.tokenizer.count(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+    def count_messages(self, messages: List[Dict[str, str]]) -> int:
+        return sum(self.count_message(message) for message in messages)
+
+    def build(
+            self,
+            system_prompt: str,
+            entries: List[Dict],
+            summary: Optional[str] = None,
+            summarized_count: int = 0
+    ) -> ContextWindow:
+        """entries 为按时间排序的历史，前 summarized_count 条已包含在摘要中"""
+        head = [{"role": "system", "content": system_prompt}]
+        if summary:
+            head.append({"role": "system", "content": f"以下是之前对话的摘要：\n{summary}"})
+        else:
+            summarized_count = 0
+        summarized_count = min(summarized_count, len(entries))
+
+        used = self.count_messages(head)
+        entry_tokens = [self.count_message(entry) for entry in entries]
+
+        # 从最新的消息往前保留，至少保留最后一条
+        cut = len(entries)
+        while cut > summarized_count:
+            tokens = entry_tokens[cut - 1]
+            if used + tokens > self.budget and cut < len(entries):
+                break
+            used += tokens
+            cut -= 1
+
+        window = ContextWindow(
+            messages=head + [{"role": entry["role"], "content": entry["content"]} for entry in entries[cut:]],
+            prompt_tokens=used,
+            history_count=len(entries) - cut,
+            dropped_count=cut
+        )
+
+        # 未摘要部分过长时，把较早的消息折叠进摘要，只留下约一半阈值的最近对话
+        unsummarized = entry_tokens[summarized_count:]
+        if sum(unsummarized) > self.summary_threshold:
+            upto = len(entries)
+            tail_tokens = 0
+            while upto > summarized_count and tail_tokens + entry_tokens[upto - 1] <= self.summary_threshold // 2:
+                tail_tokens += entry_tokens[upto - 1]
+                upto -= 1
+            if upto > summarized_count:
+                window.summarize_upto = upto
+                window.summarize_entries = entries[summarized_count:upto]
+
+        return window
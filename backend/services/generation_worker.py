@@ -0,0 +1,469 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, Optional, Set
+
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from backend.database import async_engine, redis_client
+from backend.models import ChatSession, Message, SessionStatus
+from .admission import AdmissionSlot
+from .broadcast import broadcaster
+from .checkpoint_writer import CheckpointWriter
+from .history_cache import history_cache
+from .metrics import ACTIVE_GENERATIONS, REDIS_WRITE
+from .openai_service import get_openai_service
+from .session_state import session_state
+from .session_summary import reply_values
+from .stream_log import STREAM_LOG_TTL, StreamLog
+from .write_behind import WRITE_BEHIND_CHECKPOINT_MS, WRITE_BEHIND_ENABLED, update_row, write_behind
+
+logger = logging.getLogger(__name__)
+
+GENERATION_HEARTBEAT_TTL = int(os.getenv("GENERATION_HEARTBEAT_TTL", "15"))
+# keep_generating：客户端断开后继续生成，之后可续传；cancel：最后一个读者断开后停止生成
+STREAM_DISCONNECT_MODE = os.getenv("STREAM_DISCONNECT_MODE", "keep_generating")
+# 最后一个读者断开后等待重连的秒数（如刷新页面），超时仍无读者才取消
+STREAM_DISCONNECT_GRACE = float(os.getenv("STREAM_DISCONNECT_GRACE", "2"))
+
+# 跨进程取消请求的检查间隔
+CANCEL_POLL_INTERVAL = 1.0
+STATS_KEY = "generation:stats"
+
+# 只释放自己持有的会话租约
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class GenerationManager:
+    """管理与客户端连接解耦的后台生成任务
+
+    生成任务把上游返回的片段追加到消息日志，默认客户端断开不会中断生成
+    （STREAM_DISCONNECT_MODE=cancel 时最后一个读者断开后停止生成）；
+    /completions 与 /completions-continue 都只是该日志的读者。
+    每条消息和每个会话各有一个租约，保证同一时刻最多一个生成任务。
+    """
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self.log = StreamLog(redis_client)
+        self._release_script = redis_client.register_script(RELEASE_SCRIPT)
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._events: Dict[str, asyncio.Event] = {}
+        # 因客户端断开而被取消的消息
+        self._disconnected: Set[str] = set()
+        self._background: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def heartbeat_key(message_id: str) -> str:
+        return f"generation:{message_id}"
+
+    @staticmethod
+    def session_key(session_id: str) -> str:
+        return f"generation:session:{session_id}"
+
+    @staticmethod
+    def events_channel(session_id: str) -> str:
+        """会话开始新的生成时发布消息ID，供只读订阅者跟随"""
+        return f"session:{session_id}:events"
+
+    @staticmethod
+    def readers_key(message_id: str) -> str:
+        return f"generation:{message_id}:readers"
+
+    @staticmethod
+    def cancel_key(message_id: str) -> str:
+        return f"generation:{message_id}:cancel"
+
+    async def attach_reader(self, message_id: str):
+        """SSE连接开始读取该消息的日志，各进程的读者共用一个计数"""
+        if STREAM_DISCONNECT_MODE != "cancel":
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.incr(self.readers_key(message_id))
+        pipe.expire(self.readers_key(message_id), STREAM_LOG_TTL)
+        await pipe.execute()
+
+    def detach_reader(self, message_id: str):
+        """SSE连接结束或客户端断开；cancel 模式下最后一个读者离开后取消生成
+
+        客户端断开时调用方通常处于已取消的作用域中，实际操作放在后台任务里完成。
+        """
+        if STREAM_DISCONNECT_MODE != "cancel":
+            return
+        task = asyncio.create_task(self._cancel_if_abandoned(message_id))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _cancel_if_abandoned(self, message_id: str):
+        # 计数键可能已过期，DECR 会重新创建它
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.decr(self.readers_key(message_id))
+        pipe.expire(self.readers_key(message_id), STREAM_LOG_TTL)
+        readers, _ = await pipe.execute()
+        if readers > 0:
+            return
+        await asyncio.sleep(STREAM_DISCONNECT_GRACE)
+        readers = await self.redis.get(self.readers_key(message_id))
+        if readers is not None and int(readers) > 0:
+            return
+        if not await self.is_running(message_id):
+            return
+
+        logger.info(f"All readers of message {message_id} disconnected, cancelling generation")
+        task = self._tasks.get(message_id)
+        if task and not task.done():
+            self._disconnected.add(message_id)
+            task.cancel()
+        else:
+            # 生成任务在其他进程中，由其心跳循环检查取消标记
+            await self.redis.set(self.cancel_key(message_id), "1", ex=GENERATION_HEARTBEAT_TTL * 4)
+
+    async def reserve(self, session_id: str, message_id: str) -> Optional[str]:
+        """为消息占用会话的生成租约，成功返回None，已被占用时返回正在生成的消息ID"""
+        key = self.session_key(session_id)
+        for _ in range(2):
+            if await self.redis.set(key, message_id, nx=True, ex=GENERATION_HEARTBEAT_TTL):
+                return None
+            holder = await self.redis.get(key)
+            if holder == message_id:
+                return None
+            if holder is not None:
+                return holder
+        return holder
+
+    async def release(self, session_id: str, message_id: str):
+        await self._release_script(keys=[self.session_key(session_id)], args=[message_id])
+
+    def is_local(self, message_id: str) -> bool:
+        """该消息的生成任务是否在本进程中运行"""
+        task = self._tasks.get(message_id)
+        return task is not None and not task.done()
+
+    async def is_running(self, message_id: str) -> bool:
+        """本进程或其他进程中是否有该消息的生成任务"""
+        if self.is_local(message_id):
+            return True
+        return bool(await self.redis.exists(self.heartbeat_key(message_id)))
+
+    async def start(
+            self,
+            session_id: str,
+            message_id: str,
+            user_input: str,
+            existing_content: str = "",
+            use_cache: Optional[bool] = None,
+            slot: Optional[AdmissionSlot] = None
+    ) -> bool:
+        """启动后台生成任务，已有任务在运行时返回False
+
+        slot 为准入控制分配的生成名额，由生成任务持有；未能启动时立即释放。
+        """
+        if not await self._acquire(session_id, message_id):
+            if slot:
+                await slot.release()
+            return False
+
+        task = asyncio.create_task(self._run(session_id, message_id, user_input, existing_content, use_cache, slot))
+        self._tasks[message_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(message_id, None))
+        await broadcaster.publish(self.events_channel(session_id), message_id)
+        return True
+
+    async def _acquire(self, session_id: str, message_id: str) -> bool:
+        if await self.reserve(session_id, message_id) is not None:
+            return False
+
+        # 心跳键兼作租约，保证同一消息只有一个生成任务
+        if not await self.redis.set(self.heartbeat_key(message_id), "1", nx=True, ex=GENERATION_HEARTBEAT_TTL):
+            return False
+
+        # 上一个任务可能在调用方检查之后刚刚完成，不再重复生成
+        last = await self.log.last(message_id)
+        if last and last.get("type") == "done":
+            await self.redis.delete(self.heartbeat_key(message_id))
+            await self.release(session_id, message_id)
+            return False
+        return True
+
+    def watch(self, message_id: str) -> asyncio.Event:
+        """获取日志更新通知，须在读取日志之前调用以免错过通知"""
+        event = self._events.get(message_id)
+        if event is None:
+            event = self._events[message_id] = asyncio.Event()
+        return event
+
+    @staticmethod
+    async def wait(event: asyncio.Event, timeout: float):
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def shutdown(self):
+        """进程退出时取消仍在运行的生成任务，已生成内容会被保存"""
+        for task in list(self._background):
+            task.cancel()
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def notify(self, message_id: str):
+        """日志有新条目，唤醒等待的读者"""
+        waiter = self._events.pop(message_id, None)
+        if waiter:
+            waiter.set()
+
+    async def _keepalive(self, session_id: str, message_id: str, slot: Optional[AdmissionSlot]):
+        renew_every = max(int(GENERATION_HEARTBEAT_TTL / 3 / CANCEL_POLL_INTERVAL), 1)
+        ticks = 0
+        while True:
+            await asyncio.sleep(CANCEL_POLL_INTERVAL)
+            ticks += 1
+
+            if STREAM_DISCONNECT_MODE == "cancel" and await self.redis.exists(self.cancel_key(message_id)):
+                task = self._tasks.get(message_id)
+                if task and not task.done():
+                    self._disconnected.add(message_id)
+                    task.cancel()
+                return
+
+            if ticks % renew_every == 0:
+                pipe = self.redis.pipeline(transaction=False)
+                pipe.expire(self.heartbeat_key(message_id), GENERATION_HEARTBEAT_TTL)
+                pipe.expire(self.session_key(session_id), GENERATION_HEARTBEAT_TTL)
+                pipe.expire(StreamLog.key(message_id), STREAM_LOG_TTL)
+                session_state.touch(pipe, session_id)
+                await pipe.execute()
+                if slot:
+                    await slot.renew()
+
+    async def _run(
+            self,
+            session_id: str,
+            message_id: str,
+            user_input: str,
+            existing_content: str,
+            use_cache: Optional[bool] = None,
+            slot: Optional[AdmissionSlot] = None
+    ):
+        accumulated_content = existing_content
+        prompt_tokens = None
+        keepalive = asyncio.create_task(self._keepalive(session_id, message_id, slot))
+        writer = CheckpointWriter(self.redis, message_id, on_flush=lambda: self.notify(message_id))
+
+        chunks = None
+        ACTIVE_GENERATIONS.inc()
+        # 定期把部分内容写入后写队列，Redis和进程同时丢失时也不会丢掉整段回复
+        checkpoint_interval = WRITE_BEHIND_CHECKPOINT_MS / 1000 if WRITE_BEHIND_ENABLED else 0
+        last_checkpoint = time.monotonic()
+
+        # 读取会话历史用的数据库会话，提示组装完成（context 事件）后即归还连接，生成期间不占用连接池
+        db = AsyncSession(async_engine, expire_on_commit=False)
+        try:
+            # 请求路径写入的消息和会话状态须先落库，再读取会话历史
+            await write_behind.barrier(session_id)
+
+            openai_service = get_openai_service()
+            if existing_content:
+                chunks = openai_service.continue_chat_completion(
+                    db, session_id, message_id, user_input, existing_content
+                )
+            else:
+                chunks = openai_service.stream_chat_completion(db, session_id, user_input, use_cache)
+
+            async for chunk in chunks:
+                if chunk["type"] == "content":
+                    accumulated_content += chunk["content"]
+                    await writer.write(chunk["content"])
+
+                    if checkpoint_interval and time.monotonic() - last_checkpoint >= checkpoint_interval:
+                        last_checkpoint = time.monotonic()
+                        await write_behind.put(update_row(
+                            Message, message_id, session_id, content=accumulated_content, is_streaming=True
+                        ))
+
+                elif chunk["type"] == "context":
+                    prompt_tokens = chunk["prompt_tokens"]
+                    await db.close()
+                    logger.info(
+                        f"Message {message_id} prompt: {prompt_tokens} tokens, "
+                        f"{chunk['history_messages']} history messages, "
+                        f"{chunk['dropped_messages']} dropped"
+                    )
+
+                elif chunk["type"] == "retry":
+                    await writer.write_event({
+                        "type": "retry",
+                        "message": chunk["message"],
+                        "attempt": chunk["attempt"]
+                    })
+
+                elif chunk["type"] == "done":
+                    if chunk.get("cached"):
+                        logger.info(f"Message {message_id} served from completion cache")
+                    break
+
+                elif chunk["type"] == "error":
+                    raise Exception(chunk["error"])
+
+            # 流式完成，更新数据库
+            await self._save(session_id, message_id, accumulated_content, prompt_tokens)
+
+            # 清理Redis流式状态
+            with REDIS_WRITE.labels("session_state").time():
+                await session_state.finish(session_id)
+            await writer.write_event({"type": "done"})
+
+        except asyncio.CancelledError:
+            if message_id not in self._disconnected:
+                # 进程退出：保存已生成的部分内容，会话状态保留以便续写
+                if accumulated_content:
+                    await self._save(session_id, message_id, accumulated_content, prompt_tokens)
+                await writer.write_event({"type": "error", "error": "生成任务被取消"})
+                raise
+
+            # 客户端全部断开：上游连接已随生成器关闭，保存部分内容并标记会话中断
+            if accumulated_content:
+                await self._save(session_id, message_id, accumulated_content, prompt_tokens)
+            await self._mark_interrupted(session_id)
+            await writer.write_event({"type": "error", "error": "客户端已断开，生成已停止"})
+            await self._record_cancellation(message_id, accumulated_content[len(existing_content):])
+
+        except Exception as e:
+            # 保存已生成的部分内容，会话状态保留以便续写
+            if accumulated_content:
+                await self._save(session_id, message_id, accumulated_content, prompt_tokens)
+            await writer.write_event({"type": "error", "error": str(e)})
+
+        finally:
+            ACTIVE_GENERATIONS.dec()
+            self._disconnected.discard(message_id)
+            keepalive.cancel()
+            try:
+                if chunks is not None:
+                    # 收到 done 后提前退出循环时也要关闭上游连接
+                    await chunks.aclose()
+                await db.close()
+                await writer.close()
+                await self.log.expire(message_id)
+                await self.redis.delete(self.heartbeat_key(message_id), self.cancel_key(message_id))
+            except Exception as e:
+                logger.error(f"Failed to clean up generation {message_id}: {e!r}")
+            try:
+                # 回复落库后才释放会话租约，下一轮对话读到的历史才完整
+                await write_behind.barrier(session_id)
+            except Exception as e:
+                logger.error(f"Failed to flush message {message_id}, left in write-behind journal: {e}")
+            # 清理失败时也必须释放租约和名额，否则本进程的生成容量永久减少
+            try:
+                await self.release(session_id, message_id)
+            except Exception as e:
+                logger.error(f"Failed to release lease for message {message_id}: {e!r}")
+            finally:
+                if slot:
+                    await slot.release()
+
+    async def _record_cancellation(self, message_id: str, generated: str):
+        """记录因断开而取消的生成，节省的token按 max_tokens 减去已生成部分估算"""
+        openai_service = get_openai_service()
+        generated_tokens = openai_service.context.tokenizer.count(generated)
+        tokens_saved = max(openai_service.max_tokens - generated_tokens, 0)
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hincrby(STATS_KEY, "cancelled", 1)
+        pipe.hincrby(STATS_KEY, "tokens_saved", tokens_saved)
+        await pipe.execute()
+        logger.info(
+            f"Message {message_id} cancelled after {generated_tokens} tokens, "
+            f"up to {tokens_saved} tokens saved"
+        )
+
+    async def stats(self) -> Dict:
+        counters = await self.redis.hgetall(STATS_KEY)
+        return {
+            "disconnect_mode": STREAM_DISCONNECT_MODE,
+            "running": len(self._tasks),
+            "cancelled": int(counters.get("cancelled", 0)),
+            "tokens_saved": int(counters.get("tokens_saved", 0))
+        }
+
+    async def recover_orphan(self, session_id: str, message_id: str) -> bool:
+        """接管已无生成任务的中断回复：把日志中的部分内容落库并标记会话中断，消息不存在时返回False"""
+        logged_content, _, _ = StreamLog.fold(await self.log.read(message_id))
+        # 崩溃的生成任务没能为日志设置过期时间
+        await self.log.expire(message_id)
+        async with AsyncSession(async_engine, expire_on_commit=False) as db:
+            await write_behind.barrier(session_id)
+            message = await db.get(Message, message_id)
+            if not message:
+                return False
+            # 日志可能已过期，此时数据库中的检查点更完整
+            content = logged_content if len(logged_content) > len(message.content) else message.content
+            if content and (message.is_streaming or content != message.content):
+                await self._save_message(db, session_id, message_id, content)
+            await self._mark_interrupted(session_id)
+        return True
+
+    async def _save(self, session_id: str, message_id: str, content: str, prompt_tokens: Optional[int] = None):
+        """用短时的数据库会话保存回复，只在写入时占用连接"""
+        async with AsyncSession(async_engine, expire_on_commit=False) as db:
+            await self._save_message(db, session_id, message_id, content, prompt_tokens)
+
+    @staticmethod
+    async def _mark_interrupted(session_id: str):
+        await write_behind.put(update_row(ChatSession, session_id, session_id, status=SessionStatus.INTERRUPTED))
+
+    @staticmethod
+    async def _save_message(
+            db: AsyncSession,
+            session_id: str,
+            message_id: str,
+            content: str,
+            prompt_tokens: Optional[int] = None
+    ):
+        """保存回复内容，并同步会话历史版本与历史缓存；写入经后写队列落库"""
+        message = await db.get(Message, message_id)
+        if not message:
+            return
+
+        # 不修改会话中跟踪的对象，以免被自动flush直接写入数据库
+        was_streaming = message.is_streaming
+        saved = Message(
+            id=message.id,
+            session_id=message.session_id,
+            role=message.role,
+            content=content,
+            is_streaming=False,
+            prompt_tokens=prompt_tokens if prompt_tokens is not None else message.prompt_tokens,
+            created_at=message.created_at
+        )
+        rows = [update_row(
+            Message, message_id, session_id,
+            content=saved.content, is_streaming=False, prompt_tokens=saved.prompt_tokens
+        )]
+
+        history_version = None
+        if was_streaming:
+            # 回复首次完成（含中断保存）时更新会话摘要，与消息在同一组写入中落库
+            session = await db.get(ChatSession, session_id)
+            if session:
+                values = reply_values(session, saved.content, saved.prompt_tokens)
+                if history_cache.is_history(saved):
+                    history_version = values["history_version"] = session.history_version + 1
+                rows.append(update_row(ChatSession, session_id, session_id, **values))
+        await write_behind.put(*rows)
+
+        if history_version is not None:
+            await history_cache.append(session_id, saved, history_version)
+        elif not was_streaming:
+            # 已在历史中的部分回复被续写更新，缓存失效后按需重建
+            await history_cache.invalidate(session_id)
+
+generation_manager = GenerationManager(redis_client)
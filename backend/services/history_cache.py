@@ -0,0 +1,104 @@
+import json
+import os
+from typing import Dict, List, Optional
+
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from backend.database import redis_client
+from backend.models import ChatSession, Message
+
+HISTORY_CACHE_TTL = int(os.getenv("HISTORY_CACHE_TTL", "86400"))
+
+# 只有缓存长度与追加前的版本一致时才追加，否则删除缓存等待重建
+APPEND_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 and tonumber(ARGV[1]) > 0 then
+    return 0
+end
+if redis.call('LLEN', KEYS[1]) == tonumber(ARGV[1]) then
+    redis.call('RPUSH', KEYS[1], ARGV[2])
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    return 1
+end
+redis.call('DEL', KEYS[1])
+return 0
+"""
+
+
+class HistoryCache:
+    """会话历史的写穿缓存
+
+    每个会话一个Redis列表，元素为序列化好的 {id, role, content}。
+    ChatSession.history_version 记录已进入历史的消息数，缓存长度与之不一致时从数据库重建。
+    """
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self._append_script = redis_client.register_script(APPEND_SCRIPT)
+
+    @staticmethod
+    def key(session_id: str) -> str:
+        return f"history:{session_id}"
+
+    @staticmethod
+    def serialize(message: Message) -> str:
+        return json.dumps(
+            {"id": message.id, "role": message.role, "content": message.content},
+            ensure_ascii=False
+        )
+
+    @staticmethod
+    def is_history(message: Message) -> bool:
+        """空消息和生成中的消息不进入历史"""
+        return not message.is_streaming and bool(message.content.strip())
+
+    async def get(self, session_id: str, version: int) -> Optional[List[Dict]]:
+        """读取缓存，不存在或版本不一致时返回None"""
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.lrange(self.key(session_id), 0, -1)
+        pipe.expire(self.key(session_id), HISTORY_CACHE_TTL)
+        raw_entries, exists = await pipe.execute()
+        if not exists or len(raw_entries) != version:
+            return None
+        return [json.loads(raw) for raw in raw_entries]
+
+    async def append(self, session_id: str, message: Message, version: int):
+        """消息写入数据库并提交后调用，version 为提交后的 history_version"""
+        await self._append_script(
+            keys=[self.key(session_id)],
+            args=[version - 1, self.serialize(message), HISTORY_CACHE_TTL]
+        )
+
+    async def invalidate(self, session_id: str):
+        await self.redis.delete(self.key(session_id))
+
+    async def rebuild(self, db: AsyncSession, session_id: str) -> List[Dict]:
+        result = await db.exec(
+            select(Message)
+            .where(Message.session_id == session_id)
+            .where(Message.is_streaming == False)
+            .order_by(Message.created_at, Message.id)
+        )
+        raw_entries = [self.serialize(msg) for msg in result.all() if self.is_history(msg)]
+
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.delete(self.key(session_id))
+        if raw_entries:
+            pipe.rpush(self.key(session_id), *raw_entries)
+            pipe.expire(self.key(session_id), HISTORY_CACHE_TTL)
+        await pipe.execute()
+
+        return [json.loads(raw) for raw in raw_entries]
+
+    async def load(self, db: AsyncSession, session_id: str) -> List[Dict]:
+        """获取会话历史，缓存未命中时按需重建"""
+        session = await db.get(ChatSession, session_id)
+        version = session.history_version if session else 0
+
+        entries = await self.get(session_id, version)
+        if entries is None:
+            entries = await self.rebuild(db, session_id)
+        return entries
+
+
+history_cache = HistoryCache(redis_client)
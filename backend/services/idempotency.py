@@ -0,0 +1,55 @@
+import asyncio
+import os
+from typing import Optional
+
+from fastapi import HTTPException
+
+from backend.database import redis_client
+
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+# 占用后尚未写入消息ID时的过期秒数：首个请求所在进程崩溃时，重试最多被拒绝这么久
+IDEMPOTENCY_PENDING_TTL = int(os.getenv("IDEMPOTENCY_PENDING_TTL", "30"))
+# 首个请求尚未写入消息时，重复请求最多等待的秒数
+IDEMPOTENCY_WAIT = float(os.getenv("IDEMPOTENCY_WAIT", "5"))
+
+PENDING = ""
+
+
+class IdempotencyStore:
+    """Idempotency-Key 到回复消息ID的映射，重复请求接入同一条消息的生成结果"""
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+
+    @staticmethod
+    def key(session_id: str, idempotency_key: str) -> str:
+        return f"idempotency:{session_id}:{idempotency_key}"
+
+    async def claim(self, session_id: str, idempotency_key: str) -> Optional[str]:
+        """首次使用该键时占用并返回None，否则返回首个请求创建的消息ID"""
+        key = self.key(session_id, idempotency_key)
+        if await self.redis.set(key, PENDING, nx=True, ex=IDEMPOTENCY_PENDING_TTL):
+            return None
+
+        deadline = asyncio.get_running_loop().time() + IDEMPOTENCY_WAIT
+        while True:
+            message_id = await self.redis.get(key)
+            if message_id is None:
+                # 首个请求失败并已释放，由当前请求重新占用
+                if await self.redis.set(key, PENDING, nx=True, ex=IDEMPOTENCY_PENDING_TTL):
+                    return None
+            elif message_id != PENDING:
+                return message_id
+            if asyncio.get_running_loop().time() >= deadline:
+                raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is in progress")
+            await asyncio.sleep(0.1)
+
+    async def bind(self, session_id: str, idempotency_key: str, message_id: str):
+        """写入消息ID，并把过期时间延长到完整的 IDEMPOTENCY_TTL"""
+        await self.redis.set(self.key(session_id, idempotency_key), message_id, ex=IDEMPOTENCY_TTL)
+
+    async def release(self, session_id: str, idempotency_key: str):
+        await self.redis.delete(self.key(session_id, idempotency_key))
+
+
+idempotency_store = IdempotencyStore(redis_client)
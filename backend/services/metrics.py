@@ -0,0 +1,152 @@
+import time
+from typing import Optional
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# 标签只使用上游名、操作名、错误类型等有限取值，不带会话或消息ID
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+UPSTREAM_TTFT = Histogram(
+    "streamchat_upstream_ttft_seconds",
+    "上游从发出请求（限流排队之后）到返回首个token的时间",
+    ["backend", "kind"],
+    buckets=LATENCY_BUCKETS
+)
+UPSTREAM_INTER_TOKEN = Histogram(
+    "streamchat_upstream_inter_token_seconds",
+    "上游相邻两个内容片段的间隔",
+    ["backend"],
+    buckets=FAST_BUCKETS
+)
+RATE_LIMIT_WAIT = Histogram(
+    "streamchat_rate_limit_wait_seconds",
+    "调用上游前在共享限流器中排队的时间",
+    ["backend"],
+    buckets=LATENCY_BUCKETS
+)
+UPSTREAM_RETRIES = Counter(
+    "streamchat_upstream_retries_total",
+    "调用上游的重试次数",
+    ["error"]
+)
+UPSTREAM_ERRORS = Counter(
+    "streamchat_upstream_errors_total",
+    "重试后仍失败的上游调用次数",
+    ["error"]
+)
+LOCAL_ERRORS = Counter(
+    "streamchat_local_errors_total",
+    "生成流程中与上游无关的错误次数（读取历史时的数据库、Redis等）",
+    ["error"]
+)
+UPSTREAM_REQUESTS = Counter(
+    "streamchat_upstream_requests_total",
+    "按上游统计的请求结果（ok、error，abandoned 为对冲落败或被取消）",
+    ["backend", "outcome"]
+)
+UPSTREAM_HEDGES = Counter(
+    "streamchat_upstream_hedges_total",
+    "首token超时后发出的对冲请求，按对冲请求是否胜出区分",
+    ["outcome"]
+)
+UPSTREAM_BREAKER_STATE = Gauge(
+    "streamchat_upstream_circuit_state",
+    "上游熔断器状态：0 闭合，1 半开，2 断开",
+    ["backend"]
+)
+
+REDIS_WRITE = Histogram(
+    "streamchat_redis_write_seconds",
+    "流式路径上Redis写入的耗时",
+    ["operation"],
+    buckets=FAST_BUCKETS
+)
+DB_COMMIT = Histogram(
+    "streamchat_db_commit_seconds",
+    "流式路径上数据库提交的耗时",
+    ["operation"],
+    buckets=FAST_BUCKETS
+)
+
+SSE_ENCODE = Histogram(
+    "streamchat_sse_encode_seconds",
+    "SSE帧的编码耗时",
+    buckets=(0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005)
+)
+SSE_BYTES = Counter(
+    "streamchat_sse_bytes_total",
+    "发送给客户端的SSE字节数",
+    ["type"]
+)
+SSE_FRAMES = Counter(
+    "streamchat_sse_frames_total",
+    "发送给客户端的SSE帧数",
+    ["type"]
+)
+
+WS_BYTES = Counter(
+    "streamchat_ws_bytes_total",
+    "经WebSocket多路连接发送的事件字节数",
+    ["type"]
+)
+WS_FRAMES = Counter(
+    "streamchat_ws_frames_total",
+    "经WebSocket多路连接发送的事件帧数",
+    ["type"]
+)
+WS_CREDIT_STALLS = Counter(
+    "streamchat_ws_credit_stalls_total",
+    "WebSocket多路流因客户端额度用尽而暂停读取的次数"
+)
+
+BATCH_ITEMS = Counter(
+    "streamchat_batch_items_total",
+    "批量接口处理的条目数",
+    ["status"]
+)
+
+ARCHIVE_HYDRATIONS = Counter(
+    "streamchat_archive_hydrations_total",
+    "读取已归档会话的次数，按命中本进程缓存（cache）或解压数据块（blob）区分",
+    ["source"]
+)
+
+SEARCH_LATENCY = Histogram(
+    "streamchat_search_seconds",
+    "全文检索查询的耗时",
+    ["backend"],
+    buckets=LATENCY_BUCKETS
+)
+
+WRITE_BEHIND_PENDING = Gauge("streamchat_write_behind_pending_rows", "后写队列中尚未写入数据库的行数")
+ACTIVE_STREAMS = Gauge("streamchat_active_streams", "本进程中正在读取生成日志的流数（SSE连接或WebSocket多路流）")
+WS_CONNECTIONS = Gauge("streamchat_ws_connections", "本进程中打开的WebSocket多路连接数")
+WS_STREAMS = Gauge("streamchat_ws_streams", "本进程中WebSocket连接上打开的会话流数")
+ACTIVE_GENERATIONS = Gauge("streamchat_active_generations", "本进程中正在运行的生成任务数")
+
+
+class UpstreamTimer:
+    """记录一次上游流式调用的首token时间和token间隔"""
+
+    def __init__(self, backend: str, kind: str):
+        self.backend = backend
+        self.kind = kind
+        self.started: Optional[float] = None
+        self.last: Optional[float] = None
+
+    def start(self):
+        self.started = time.perf_counter()
+
+    def token(self):
+        now = time.perf_counter()
+        if self.last is not None:
+            UPSTREAM_INTER_TOKEN.labels(self.backend).observe(now - self.last)
+        elif self.started is not None:
+            UPSTREAM_TTFT.labels(self.backend, self.kind).observe(now - self.started)
+        self.last = now
+
+
+def render() -> bytes:
+    return generate_latest()
+
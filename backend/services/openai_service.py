@@ -1,161 +1,394 @@
+import asyncio
+import json
+import logging
 import os
-from typing import AsyncGenerator, Dict, List
+from dataclasses import dataclass
+from typing import AsyncGenerator, Dict, List, Optional, Tuple
 
+import httpx
 from openai import AsyncOpenAI
-from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from backend.models import Message
-from .error_handler import handle_openai_errors, StreamErrorHandler
+from backend.database import async_engine, redis_client
+from backend.models import ChatSession
+from .completion_cache import completion_cache
+from .context_window import CONTEXT_TOKENIZER, ContextBuilder, ContextWindow, get_tokenizer
+from .error_handler import StreamErrorHandler
+from .history_cache import history_cache
+from .rate_limiter import get_rate_limiter
+from .upstream_router import Backend, UpstreamRouter
 
+logger = logging.getLogger(__name__)
 
-class OpenAIService:
-    def __init__(self):
-        self.client = AsyncOpenAI(
-            api_key=os.getenv("OPENAI_API_KEY"),
-            base_url=os.getenv("OPENAI_API_BASE_URL", "https://api.openai.com/v1"),
+CONTEXT_SUMMARY_MAX_TOKENS = int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", "500"))
+SUMMARY_PROMPT = "请把以下对话压缩为简洁的摘要，保留关键事实、结论和用户的偏好与要求，用中文输出。"
+
+
+@dataclass(frozen=True)
+class BackendConfig:
+    """一个 OpenAI 兼容的上游"""
+    name: str
+    base_url: str
+    api_key: Optional[str]
+    model: str
+
+
+def parse_backends(raw: Optional[str], api_key: Optional[str], base_url: str, model: str) -> Tuple[BackendConfig, ...]:
+    """OPENAI_BACKENDS 为JSON数组，每项含 name、base_url，可选 api_key、model（缺省沿用 OPENAI_*）；
+    未配置时只有 OPENAI_API_BASE_URL 一个上游，以模型名命名"""
+    if not raw:
+        return (BackendConfig(name=model, base_url=base_url, api_key=api_key, model=model),)
+    backends = tuple(
+        BackendConfig(
+            name=item["name"],
+            base_url=item["base_url"],
+            api_key=item.get("api_key", api_key),
+            model=item.get("model", model)
         )
-        self.model = os.getenv("OPENAI_MODEL", "gpt-4")
-        self.max_tokens = int(os.getenv("OPENAI_MAX_TOKENS", "2000"))
-        self.temperature = float(os.getenv("OPENAI_TEMPERATURE", "0.7"))
-
-    async def get_chat_messages(self, db: Session, session_id: str) -> List[Dict[str, str]]:
-        """获取会话历史消息，转换为OpenAI格式"""
-        from sqlmodel import select
-        messages = db.exec(
-            select(Message)
-            .where(Message.session_id == session_id)
-            .where(Message.is_streaming == False)
-            .order_by(Message.created_at)
-        ).all()
-
-        openai_messages = []
-        for msg in messages:
-            if msg.content.strip():  # 过滤空消息
-                openai_messages.append({
-                    "role": msg.role,
-                    "content": msg.content
-                })
-
-        # 如果没有历史消息，添加系统提示
-        if not openai_messages:
-            openai_messages.append({
-                "role": "system",
-                "content": "你是一个有用的AI助手，请用中文回答用户的问题。"
-            })
+        for item in json.loads(raw)
+    )
+    if not backends or len({backend.name for backend in backends}) != len(backends):
+        raise ValueError("OPENAI_BACKENDS must be a non-empty list with unique names")
+    return backends
+
+
+@dataclass(frozen=True)
+class OpenAIConfig:
+    """OpenAI配置，启动时解析一次"""
+    api_key: Optional[str]
+    base_url: str
+    model: str
+    max_tokens: int
+    temperature: float
+    max_connections: int
+    max_keepalive_connections: int
+    keepalive_expiry: float
+    connect_timeout: float
+    read_timeout: float
+    http2: bool
+    system_prompt: str
+    backends: Tuple[BackendConfig, ...]
+
+    @classmethod
+    def from_env(cls) -> "OpenAIConfig":
+        api_key = os.getenv("OPENAI_API_KEY")
+        base_url = os.getenv("OPENAI_API_BASE_URL", "https://api.openai.com/v1")
+        model = os.getenv("OPENAI_MODEL", "gpt-4")
+        return cls(
+            api_key=api_key,
+            base_url=base_url,
+            model=model,
+            max_tokens=int(os.getenv("OPENAI_MAX_TOKENS", "2000")),
+            temperature=float(os.getenv("OPENAI_TEMPERATURE", "0.7")),
+            max_connections=int(os.getenv("OPENAI_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20")),
+            keepalive_expiry=float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "30")),
+            connect_timeout=float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10")),
+            read_timeout=float(os.getenv("OPENAI_READ_TIMEOUT", "600")),
+            http2=os.getenv("OPENAI_HTTP2", "false").lower() in ("1", "true", "yes"),
+            system_prompt=os.getenv("OPENAI_SYSTEM_PROMPT", "你是一个有用的AI助手，请用中文回答用户的问题。"),
+            backends=parse_backends(os.getenv("OPENAI_BACKENDS"), api_key, base_url, model),
+        )
+
+
+def create_openai_client(config: OpenAIConfig, backend: BackendConfig) -> AsyncOpenAI:
+    """为一个上游创建带连接池的客户端，进程内所有请求共享"""
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=config.max_connections,
+            max_keepalive_connections=config.max_keepalive_connections,
+            keepalive_expiry=config.keepalive_expiry,
+        ),
+        timeout=httpx.Timeout(config.read_timeout, connect=config.connect_timeout),
+        http2=config.http2,  # 需要安装 h2
+    )
+    return AsyncOpenAI(
+        api_key=backend.api_key,
+        base_url=backend.base_url,
+        http_client=http_client,
+        # 重试和切换上游由 UpstreamRouter 配合共享限流器完成，SDK 自身的退避重试会绕过限流器
+        max_retries=0,
+    )
+
+
+def create_router(config: OpenAIConfig) -> UpstreamRouter:
+    """每个上游各自一个连接池和限流器"""
+    return UpstreamRouter([
+        Backend(
+            name=backend.name,
+            model=backend.model,
+            base_url=backend.base_url,
+            client=create_openai_client(config, backend),
+            rate_limiter=get_rate_limiter(backend.name)
+        )
+        for backend in config.backends
+    ])
+
+
+class OpenAIService:
+    def __init__(self, config: OpenAIConfig, router: UpstreamRouter):
+        self.config = config
+        self.router = router
+        self.model = config.model
+        self.max_tokens = config.max_tokens
+        self.temperature = config.temperature
+        self.context = ContextBuilder(get_tokenizer(CONTEXT_TOKENIZER, config.model))
+        self.rate_limiter = router.primary.rate_limiter
+        self._summary_tasks: Dict[str, asyncio.Task] = {}
+
+    async def close(self):
+        for task in list(self._summary_tasks.values()):
+            task.cancel()
+        await self.router.close()
+
+    async def get_chat_context(
+            self,
+            db: AsyncSession,
+            session_id: str,
+            exclude_message_id: Optional[str] = None
+    ) -> ContextWindow:
+        """在token预算内组装会话历史（读取历史缓存），必要时在后台更新滚动摘要"""
+        session = await db.get(ChatSession, session_id)
+        entries = await history_cache.load(db, session_id)
+        entries = [entry for entry in entries if entry["id"] != exclude_message_id]
+
+        summary = session.summary if session else None
+        summarized_count = session.summarized_count if session else 0
+        window = self.context.build(self.config.system_prompt, entries, summary, summarized_count)
+
+        if window.summarize_upto is not None:
+            self._schedule_summary(session_id, window, summary, summarized_count)
+        return window
+
+    def _schedule_summary(
+            self,
+            session_id: str,
+            window: ContextWindow,
+            summary: Optional[str],
+            summarized_count: int
+    ):
+        if session_id in self._summary_tasks:
+            return
+        task = asyncio.create_task(self._summarize(
+            session_id, window.summarize_entries, summary, summarized_count, window.summarize_upto
+        ))
+        self._summary_tasks[session_id] = task
+        task.add_done_callback(lambda _: self._summary_tasks.pop(session_id, None))
+
+    async def _summarize(
+            self,
+            session_id: str,
+            entries: List[Dict],
+            previous_summary: Optional[str],
+            summarized_count: int,
+            summarize_upto: int
+    ):
+        """把较早的对话折叠进会话的滚动摘要"""
+        lock_key = f"summary:{session_id}:lock"
+        if not await redis_client.set(lock_key, "1", nx=True, ex=120):
+            return
+
+        try:
+            conversation = "\n".join(f"{entry['role']}: {entry['content']}" for entry in entries)
+            if previous_summary:
+                conversation = f"已有摘要：\n{previous_summary}\n\n新增对话：\n{conversation}"
+
+            messages = [
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": conversation}
+            ]
+            response = await self.router.create(
+                self.context.count_messages(messages) + CONTEXT_SUMMARY_MAX_TOKENS,
+                messages=messages,
+                max_tokens=CONTEXT_SUMMARY_MAX_TOKENS,
+                temperature=0.3
+            )
+            new_summary = response.choices[0].message.content
 
-        return openai_messages
+            async with AsyncSession(async_engine, expire_on_commit=False) as db:
+                session = await db.get(ChatSession, session_id)
+                # 期间已被其他任务更新过则放弃
+                if not session or session.summarized_count != summarized_count:
+                    return
+                session.summary = new_summary
+                session.summarized_count = summarize_upto
+                await db.commit()
+
+            logger.info(f"Session {session_id} summarized up to message #{summarize_upto}")
+        except Exception as e:
+            logger.warning(f"Failed to summarize session {session_id}: {e}")
+        finally:
+            await redis_client.delete(lock_key)
+
+    @staticmethod
+    def _context_event(window: ContextWindow) -> Dict:
+        return {
+            "type": "context",
+            "prompt_tokens": window.prompt_tokens,
+            "history_messages": window.history_count,
+            "dropped_messages": window.dropped_count
+        }
+
+    def _cache_digest(self, model: str, messages: List[Dict[str, str]]) -> str:
+        return completion_cache.make_digest(model, self.temperature, self.max_tokens, messages)
+
+    @staticmethod
+    def _ensure_user_message(messages: List[Dict[str, str]], user_message: str):
+        """用户消息在保存时已写入历史，仅在历史中缺失时补上"""
+        if messages[-1]["role"] != "user":
+            messages.append({
+                "role": "user",
+                "content": user_message
+            })
 
     async def stream_chat_completion(
             self,
-            db: Session,
+            db: AsyncSession,
             session_id: str,
-            user_message: str
+            user_message: str,
+            use_cache: Optional[bool] = None,
+            new_session: bool = False,
+            unsaved_message: bool = False
     ) -> AsyncGenerator[Dict, None]:
-        """流式获取OpenAI回复（带错误处理）"""
+        """流式获取OpenAI回复（带错误处理），new_session 表示会话尚无历史，不读取数据库；
+        unsaved_message 表示本轮用户消息尚未写入历史，总是追加到提示末尾"""
         async for result in StreamErrorHandler.handle_stream_errors(
                 self._internal_stream_chat_completion,
-                db, session_id, user_message
+                db, session_id, user_message, use_cache, new_session, unsaved_message
         ):
             yield result
 
-    @handle_openai_errors
     async def _internal_stream_chat_completion(
             self,
-            db: Session,
+            db: AsyncSession,
             session_id: str,
-            user_message: str
+            user_message: str,
+            use_cache: Optional[bool] = None,
+            new_session: bool = False,
+            unsaved_message: bool = False
     ) -> AsyncGenerator[Dict, None]:
         """内部流式聊天完成方法"""
-        # 获取会话历史
-        messages = await self.get_chat_messages(db, session_id)
-
-        # 添加新的用户消息
-        messages.append({
-            "role": "user",
-            "content": user_message
-        })
-
-        # 调用OpenAI流式API
-        stream = await self.client.chat.completions.create(
-            model=self.model,
+        # 获取会话历史（除 unsaved_message 外已包含本轮用户消息）
+        if new_session:
+            window = self.context.build(self.config.system_prompt, [])
+        else:
+            window = await self.get_chat_context(db, session_id)
+        messages = window.messages
+        if unsaved_message:
+            # 历史可能以之前未得到回复的用户消息结尾，不能按最后一条的角色判断
+            messages.append({"role": "user", "content": user_message})
+        else:
+            self._ensure_user_message(messages, user_message)
+        window.prompt_tokens = self.context.count_messages(messages)
+        yield self._context_event(window)
+
+        # 完全相同的提示直接回放缓存的回复，不请求上游；各上游的模型可能不同，按路由将选择的上游的模型查找
+        use_cache = completion_cache.enabled(self.temperature, use_cache)
+        if use_cache:
+            cache_digest = self._cache_digest(self.router.preferred_model(), messages)
+            cached_content = await completion_cache.get(cache_digest)
+            if cached_content is not None:
+                async for chunk in completion_cache.replay(cached_content):
+                    yield chunk
+                return
+        collected: List[str] = []
+
+        # 经路由调用上游流式API
+        events = self.router.stream(
+            window.prompt_tokens + self.max_tokens,
+            "completion",
             messages=messages,
             max_tokens=self.max_tokens,
-            temperature=self.temperature,
-            stream=True
+            temperature=self.temperature
         )
 
-        async for chunk in stream:
-            if chunk.choices and len(chunk.choices) > 0:
-                delta = chunk.choices[0].delta
-                if hasattr(delta, 'content') and delta.content:
-                    yield {
-                        "type": "content",
-                        "content": delta.content,
-                        "finish_reason": chunk.choices[0].finish_reason
-                    }
-                elif chunk.choices[0].finish_reason:
-                    yield {
-                        "type": "done",
-                        "finish_reason": chunk.choices[0].finish_reason
-                    }
+        # 生成任务被取消（如客户端全部断开）时立即关闭上游连接，不再为无人读取的token付费
+        try:
+            async for event in events:
+                if event["type"] == "content":
+                    collected.append(event["content"])
+                elif event["type"] == "done":
+                    # 只缓存正常结束的完整回复，按实际生成回复的上游的模型存放
+                    if use_cache and event["finish_reason"] == "stop" and collected:
+                        await completion_cache.set(self._cache_digest(event["model"], messages), "".join(collected))
+                yield event
+        finally:
+            await events.aclose()
 
     async def continue_chat_completion(
             self,
-            db: Session,
+            db: AsyncSession,
             session_id: str,
+            message_id: str,
             user_message: str,
             existing_content: str = ""
     ) -> AsyncGenerator[Dict, None]:
         """继续中断的聊天流式回复（带错误处理）"""
         async for result in StreamErrorHandler.handle_stream_errors(
                 self._internal_continue_chat_completion,
-                db, session_id, user_message, existing_content
+                db, session_id, message_id, user_message, existing_content
         ):
             yield result
 
-    @handle_openai_errors
     async def _internal_continue_chat_completion(
             self,
-            db: Session,
+            db: AsyncSession,
             session_id: str,
+            message_id: str,
             user_message: str,
             existing_content: str = ""
     ) -> AsyncGenerator[Dict, None]:
         """内部继续聊天完成方法"""
-        # 获取会话历史
-        messages = await self.get_chat_messages(db, session_id)
+        # 获取会话历史，排除正在续写的这条回复
+        window = await self.get_chat_context(db, session_id, exclude_message_id=message_id)
+        messages = window.messages
         messages.insert(0, {"role": "system", "content": "续写未完成的回答"})
-        # 添加用户消息和已有的助手回复
-        messages.append({
-            "role": "user",
-            "content": user_message
-        })
+        self._ensure_user_message(messages, user_message)
 
+        # 添加已有的助手回复
         if existing_content:
             messages.append({
                 "role": "assistant",
                 "content": existing_content
             })
+        window.prompt_tokens = self.context.count_messages(messages)
+        yield self._context_event(window)
 
-        stream = await self.client.chat.completions.create(
-            model=self.model,
+        events = self.router.stream(
+            window.prompt_tokens + self.max_tokens,
+            "continue",
             messages=messages,
             max_tokens=self.max_tokens,
-            temperature=self.temperature,
-            stream=True
+            temperature=self.temperature
         )
 
-        async for chunk in stream:
-            if chunk.choices and len(chunk.choices) > 0:
-                delta = chunk.choices[0].delta
-                if hasattr(delta, 'content') and delta.content:
-                    yield {
-                        "type": "content",
-                        "content": delta.content,
-                        "finish_reason": chunk.choices[0].finish_reason
-                    }
-                elif chunk.choices[0].finish_reason:
-                    yield {
-                        "type": "done",
-                        "finish_reason": chunk.choices[0].finish_reason
-                    }
+        # 生成任务被取消（如客户端全部断开）时立即关闭上游连接，不再为无人读取的token付费
+        try:
+            async for event in events:
+                yield event
+        finally:
+            await events.aclose()
+
+
+_openai_service: Optional[OpenAIService] = None
+
+
+def init_openai_service() -> OpenAIService:
+    """在应用启动时创建共享的OpenAIService"""
+    global _openai_service
+    if _openai_service is None:
+        config = OpenAIConfig.from_env()
+        _openai_service = OpenAIService(config, create_router(config))
+    return _openai_service
+
+
+async def close_openai_service():
+    global _openai_service
+    if _openai_service is not None:
+        await _openai_service.close()
+        _openai_service = None
+
+
+def get_openai_service() -> OpenAIService:
+    # 脚本等未经过 lifespan 的场景下按需创建
+    return init_openai_service()
@@ -0,0 +1,115 @@
+import base64
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import tuple_
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(timestamp: datetime, row_id: str) -> str:
+    """游标为 (时间, id) 的base64编码，对客户端不透明"""
+    raw = f"{timestamp.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, row_id = base64.urlsafe_b64decode(padded).decode("utf-8").split("|", 1)
+        return datetime.fromisoformat(timestamp), row_id
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def keyset_filter(time_column, id_column, cursor: str, before: bool):
+    """(time, id) 严格小于/大于游标位置，配合 (time, id) 复合索引使用"""
+    timestamp, row_id = decode_cursor(cursor)
+    key = tuple_(time_column, id_column)
+    position = tuple_(timestamp, row_id)
+    return key < position if before else key > position
+
+
+def validate_cursors(before: Optional[str], after: Optional[str]):
+    if before and after:
+        raise HTTPException(status_code=400, detail="Only one of before/after can be given")
+
+
+async def keyset_page(
+        db,
+        statement,
+        time_column,
+        id_column,
+        limit: int,
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        newest_first: bool = False
+):
+    """按 (time, id) 键集分页，返回 (items, before_cursor, after_cursor)
+
+    不带游标时返回最新的一页；before 取更早的一页，after 取更新的一页。
+    """
+    validate_cursors(before, after)
+
+    if after:
+        statement = statement.where(keyset_filter(time_column, id_column, after, before=False))
+        statement = statement.order_by(time_column, id_column)
+    else:
+        if before:
+            statement = statement.where(keyset_filter(time_column, id_column, before, before=True))
+        statement = statement.order_by(time_column.desc(), id_column.desc())
+
+    result = await db.exec(statement.limit(limit + 1))
+    rows = result.all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    if after:
+        ascending = rows
+        older_exists, newer_exists = True, has_more
+    else:
+        ascending = list(reversed(rows))
+        older_exists, newer_exists = has_more, bool(before)
+    return _page(ascending, older_exists, newer_exists, time_column.key, id_column.key, newest_first)
+
+
+def keyset_page_items(
+        rows: List,
+        time_key: str,
+        id_key: str,
+        limit: int,
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        newest_first: bool = False
+):
+    """对已按 (time, id) 升序排列的列表做与 keyset_page 相同的分页，游标可以互换使用"""
+    validate_cursors(before, after)
+
+    def key_of(row):
+        return getattr(row, time_key), getattr(row, id_key)
+
+    if after:
+        position = decode_cursor(after)
+        newer = [row for row in rows if key_of(row) > position]
+        ascending = newer[:limit]
+        older_exists, newer_exists = True, len(newer) > limit
+    else:
+        older = rows
+        if before:
+            position = decode_cursor(before)
+            older = [row for row in rows if key_of(row) < position]
+        ascending = older[-limit:]
+        older_exists, newer_exists = len(older) > limit, bool(before)
+    return _page(ascending, older_exists, newer_exists, time_key, id_key, newest_first)
+
+
+def _page(ascending: List, older_exists: bool, newer_exists: bool, time_key: str, id_key: str, newest_first: bool):
+    def cursor_of(row) -> str:
+        return encode_cursor(getattr(row, time_key), getattr(row, id_key))
+
+    before_cursor = cursor_of(ascending[0]) if ascending and older_exists else None
+    after_cursor = cursor_of(ascending[-1]) if ascending and newer_exists else None
+    items = list(reversed(ascending)) if newest_first else ascending
+    return items, before_cursor, after_cursor
@@ -0,0 +1,289 @@
+import asyncio
+import logging
+import os
+import re
+import uuid
+from typing import Dict, Optional
+
+from backend.database import redis_client
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+# 上游尚未返回限额响应头之前使用的每分钟请求数/token数
+RATE_LIMIT_RPM = int(os.getenv("RATE_LIMIT_RPM", "500"))
+RATE_LIMIT_TPM = int(os.getenv("RATE_LIMIT_TPM", "300000"))
+# AIMD：被限流时速率乘以该系数，每次成功后加回固定步长
+RATE_LIMIT_DECREASE = float(os.getenv("RATE_LIMIT_DECREASE", "0.5"))
+RATE_LIMIT_INCREASE = float(os.getenv("RATE_LIMIT_INCREASE", "0.05"))
+RATE_LIMIT_MIN_FACTOR = float(os.getenv("RATE_LIMIT_MIN_FACTOR", "0.1"))
+# 排队超过该秒数仍未获得额度则放弃
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "300"))
+RATE_LIMIT_POLL_INTERVAL = float(os.getenv("RATE_LIMIT_POLL_INTERVAL", "0.1"))
+
+# 排队者超过该秒数未轮询视为已放弃
+QUEUE_LEASE_SECONDS = 10
+
+_CLOCK = """
+if redis.replicate_commands then redis.replicate_commands() end
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+"""
+
+# KEYS: 状态、排队顺序、排队心跳；ARGV: 排队号、本次token消耗、默认RPM、默认TPM、心跳时长
+# 返回 {状态, 需等待秒数}：状态0为已到队首，-1为仍在排队，-2为排队号已失效
+ACQUIRE_SCRIPT = _CLOCK + """
+redis.call('ZADD', KEYS[3], now + tonumber(ARGV[5]), ARGV[1])
+local stale = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', now)
+for _, ticket in ipairs(stale) do
+    redis.call('ZREM', KEYS[2], ticket)
+    redis.call('ZREM', KEYS[3], ticket)
+end
+if not redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+    redis.call('ZREM', KEYS[3], ARGV[1])
+    return {-2, '0'}
+end
+if redis.call('ZRANGE', KEYS[2], 0, 0)[1] ~= ARGV[1] then
+    return {-1, '0'}
+end
+
+local s = redis.call('HMGET', KEYS[1], 'requests', 'tokens', 'ts', 'rpm', 'tpm', 'factor', 'blocked_until')
+local factor = tonumber(s[6]) or 1
+local rcap = (tonumber(s[4]) or tonumber(ARGV[3])) * factor
+local tcap = (tonumber(s[5]) or tonumber(ARGV[4])) * factor
+local elapsed = math.max(now - (tonumber(s[3]) or now), 0)
+local requests = math.min(rcap, (tonumber(s[1]) or rcap) + elapsed * rcap / 60)
+local tokens = math.min(tcap, (tonumber(s[2]) or tcap) + elapsed * tcap / 60)
+-- 单个请求超过桶容量时按满桶计算，避免永远等待
+local cost = math.min(tonumber(ARGV[2]), tcap)
+
+local wait = math.max((tonumber(s[7]) or 0) - now, 0)
+if requests < 1 then
+    wait = math.max(wait, (1 - requests) * 60 / rcap)
+end
+if tokens < cost then
+    wait = math.max(wait, (cost - tokens) * 60 / tcap)
+end
+if wait <= 0 then
+    requests = requests - 1
+    tokens = tokens - cost
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    redis.call('ZREM', KEYS[3], ARGV[1])
+end
+redis.call('HSET', KEYS[1], 'requests', tostring(requests), 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], 3600)
+return {0, tostring(wait)}
+"""
+
+# ARGV: RPM、TPM、剩余请求数、剩余token数、速率系数乘数、速率系数增量、暂停秒数、速率系数下限
+# 前四项和暂停秒数为空字符串表示未知
+FEEDBACK_SCRIPT = _CLOCK + """
+local s = redis.call('HMGET', KEYS[1], 'requests', 'tokens', 'factor', 'blocked_until')
+local factor = tonumber(s[3]) or 1
+factor = math.max(math.min(factor * tonumber(ARGV[5]) + tonumber(ARGV[6]), 1), tonumber(ARGV[8]))
+redis.call('HSET', KEYS[1], 'factor', tostring(factor))
+if ARGV[1] ~= '' then redis.call('HSET', KEYS[1], 'rpm', ARGV[1]) end
+if ARGV[2] ~= '' then redis.call('HSET', KEYS[1], 'tpm', ARGV[2]) end
+-- 以上游看到的剩余额度为准，只向下修正
+if ARGV[3] ~= '' and s[1] then
+    redis.call('HSET', KEYS[1], 'requests', tostring(math.min(tonumber(s[1]), tonumber(ARGV[3]))))
+end
+if ARGV[4] ~= '' and s[2] then
+    redis.call('HSET', KEYS[1], 'tokens', tostring(math.min(tonumber(s[2]), tonumber(ARGV[4]))))
+end
+if ARGV[7] ~= '' then
+    local blocked_until = now + tonumber(ARGV[7])
+    if blocked_until > (tonumber(s[4]) or 0) then
+        redis.call('HSET', KEYS[1], 'blocked_until', tostring(blocked_until))
+    end
+end
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(factor)
+"""
+
+_DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """解析 x-ratelimit-reset-* 的时长格式，如 "1s"、"6m0s"、"20ms" """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PATTERN.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def retry_after_seconds(headers) -> Optional[float]:
+    """从 Retry-After / retry-after-ms / x-ratelimit-reset-* 响应头中取出需要等待的秒数"""
+    if headers is None:
+        return None
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    retry_after = parse_duration(headers.get("retry-after"))
+    if retry_after is not None:
+        return retry_after
+    resets = [
+        parse_duration(headers.get("x-ratelimit-reset-requests")),
+        parse_duration(headers.get("x-ratelimit-reset-tokens"))
+    ]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+
+def _int_header(headers, name: str) -> str:
+    value = headers.get(name)
+    return value if value and value.isdigit() else ""
+
+
+class RateLimitTimeout(Exception):
+    pass
+
+
+class RateLimiter:
+    """跨进程共享的上游限流器
+
+    请求数和token数各一个令牌桶，状态存放在Redis中；容量来自上游的限额响应头，
+    并按AIMD调整：被限流时乘性降低，成功时加性恢复。
+    等待额度的请求按排队号先来先得，只有队首可以扣减额度。
+    """
+
+    def __init__(self, redis_client, name: str):
+        self.redis = redis_client
+        self.name = name
+        self._acquire_script = redis_client.register_script(ACQUIRE_SCRIPT)
+        self._feedback_script = redis_client.register_script(FEEDBACK_SCRIPT)
+
+    @property
+    def state_key(self) -> str:
+        return f"ratelimit:{self.name}"
+
+    @property
+    def queue_key(self) -> str:
+        return f"ratelimit:{self.name}:queue"
+
+    @property
+    def alive_key(self) -> str:
+        return f"ratelimit:{self.name}:alive"
+
+    @property
+    def stats_key(self) -> str:
+        return f"ratelimit:{self.name}:stats"
+
+    async def _enqueue(self, ticket: str):
+        position = await self.redis.incr(f"ratelimit:{self.name}:seq")
+        await self.redis.zadd(self.queue_key, {ticket: position})
+
+    async def acquire(self, tokens: int) -> float:
+        """排队获取一次请求和 tokens 个token的额度，返回等待的秒数"""
+        if not RATE_LIMIT_ENABLED:
+            return 0.0
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        ticket = uuid.uuid4().hex
+        acquired = False
+        await self._enqueue(ticket)
+
+        try:
+            while True:
+                status, wait = await self._acquire_script(
+                    keys=[self.state_key, self.queue_key, self.alive_key],
+                    args=[ticket, tokens, RATE_LIMIT_RPM, RATE_LIMIT_TPM, QUEUE_LEASE_SECONDS]
+                )
+                status, wait = int(status), float(wait)
+                if status == 0 and wait <= 0:
+                    acquired = True
+                    break
+                if status == -2:
+                    # 排队号因长时间未轮询被清理，重新排队
+                    await self._enqueue(ticket)
+
+                delay = min(wait, QUEUE_LEASE_SECONDS / 2) if status == 0 else RATE_LIMIT_POLL_INTERVAL
+                if loop.time() - started + delay > RATE_LIMIT_MAX_WAIT:
+                    raise RateLimitTimeout(f"等待上游限流额度超过{RATE_LIMIT_MAX_WAIT:g}秒")
+                await asyncio.sleep(max(delay, RATE_LIMIT_POLL_INTERVAL / 10))
+        finally:
+            if not acquired:
+                pipe = self.redis.pipeline(transaction=False)
+                pipe.zrem(self.queue_key, ticket)
+                pipe.zrem(self.alive_key, ticket)
+                await pipe.execute()
+
+        waited = loop.time() - started
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hincrby(self.stats_key, "acquired", 1)
+        pipe.hincrbyfloat(self.stats_key, "wait_seconds_total", waited)
+        await pipe.execute()
+        if waited > 1:
+            logger.info(f"Waited {waited:.2f}s for upstream rate limit ({self.name})")
+        return waited
+
+    async def on_response(self, headers):
+        """请求成功：以响应头更新限额，并加性恢复速率"""
+        await self._feedback(headers, 1, RATE_LIMIT_INCREASE, "")
+
+    async def on_rate_limited(self, headers):
+        """被上游限流（429）：乘性降低速率，并按 Retry-After 暂停所有进程的请求"""
+        retry_after = retry_after_seconds(headers)
+        factor = await self._feedback(
+            headers, RATE_LIMIT_DECREASE, 0, "" if retry_after is None else str(retry_after)
+        )
+        await self.redis.hincrby(self.stats_key, "throttled", 1)
+        logger.warning(f"Upstream rate limited ({self.name}), rate factor now {factor:.2f}")
+
+    async def _feedback(self, headers, multiplier: float, increment: float, pause: str) -> float:
+        headers = headers or {}
+        factor = await self._feedback_script(
+            keys=[self.state_key],
+            args=[
+                _int_header(headers, "x-ratelimit-limit-requests"),
+                _int_header(headers, "x-ratelimit-limit-tokens"),
+                _int_header(headers, "x-ratelimit-remaining-requests"),
+                _int_header(headers, "x-ratelimit-remaining-tokens"),
+                multiplier,
+                increment,
+                pause,
+                RATE_LIMIT_MIN_FACTOR
+            ]
+        )
+        return float(factor)
+
+    async def stats(self) -> Dict:
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hgetall(self.state_key)
+        pipe.hgetall(self.stats_key)
+        pipe.zcard(self.queue_key)
+        state, counters, queue_depth = await pipe.execute()
+
+        acquired = int(counters.get("acquired", 0))
+        wait_total = float(counters.get("wait_seconds_total", 0))
+        return {
+            "enabled": RATE_LIMIT_ENABLED,
+            "rpm": int(float(state.get("rpm", RATE_LIMIT_RPM))),
+            "tpm": int(float(state.get("tpm", RATE_LIMIT_TPM))),
+            "rate_factor": float(state.get("factor", 1)),
+            "queue_depth": queue_depth,
+            "acquired": acquired,
+            "throttled": int(counters.get("throttled", 0)),
+            "avg_wait_seconds": wait_total / acquired if acquired else 0.0
+        }
+
+
+_limiters: Dict[str, RateLimiter] = {}
+
+
+def get_rate_limiter(name: str) -> RateLimiter:
+    """每个模型一个限流器，同一模型的所有进程共享额度"""
+    limiter = _limiters.get(name)
+    if limiter is None:
+        limiter = _limiters[name] = RateLimiter(redis_client, name)
+    return limiter
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import os
+import re
+import time
+from typing import Dict, List, Optional
+
+from redis.exceptions import ResponseError
+
+from backend.database import redis_client
+from .generation_worker import generation_manager
+from .session_state import session_state
+
+logger = logging.getLogger(__name__)
+
+# 清理任务的运行间隔，0 为关闭
+STATE_SWEEP_INTERVAL = int(os.getenv("STATE_SWEEP_INTERVAL", "60"))
+# 流式状态存在超过该秒数且已无生成任务时视为中断
+STATE_SWEEP_STALE_AFTER = int(os.getenv("STATE_SWEEP_STALE_AFTER", "120"))
+SWEEP_LOCK_KEY = "sweeper:lock"
+SCAN_COUNT = 500
+
+# 按键名归类，统计各类键的数量和内存；按顺序匹配，未匹配的计入 other
+KEY_FAMILIES = [
+    ("session_state", re.compile(r"^session:[^:]+$")),
+    ("generation_log", re.compile(r"^message:.+:log$")),
+    ("generation", re.compile(r"^generation:")),
+    ("history", re.compile(r"^history:")),
+    ("completion_cache", re.compile(r"^completion_cache:")),
+    ("idempotency", re.compile(r"^idempotency:")),
+    ("ratelimit", re.compile(r"^ratelimit:")),
+    ("admission", re.compile(r"^admission:")),
+    ("writebehind", re.compile(r"^writebehind:")),
+    ("summary", re.compile(r"^summary:")),
+    ("batch", re.compile(r"^batch:")),
+    ("sweeper", re.compile(r"^sweeper:")),
+    ("archiver", re.compile(r"^archiver:")),
+]
+
+
+def key_family(key: str) -> str:
+    for family, pattern in KEY_FAMILIES:
+        if pattern.match(key):
+            return family
+    return "other"
+
+
+class StateSweeper:
+    """定期扫描会话的流式状态，接管生成任务已不存在的中断回复
+
+    进程崩溃或生成出错后 session:{id} 会一直保留到过期，期间会话仍显示为进行中、
+    部分内容只在生成日志中。清理任务把这些内容落库并把会话标记为中断，之后仍可续写。
+    多个进程中同一时刻只有一个执行清理。
+    """
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if STATE_SWEEP_INTERVAL <= 0 or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def sweep(self) -> Dict[str, int]:
+        """扫描一遍所有流式状态，返回各类处理结果的数量"""
+        result = {"scanned": 0, "recovered": 0, "removed": 0}
+        now = time.time()
+        async for key in self.redis.scan_iter(match="session:*", count=SCAN_COUNT, _type="hash"):
+            session_id = key[len("session:"):]
+            if ":" in session_id:
+                continue
+            result["scanned"] += 1
+
+            state = await session_state.get(session_id)
+            if state is None:
+                # 旧版本创建会话时写入的初始状态，或已不完整的状态
+                await self.redis.delete(key)
+                result["removed"] += 1
+                continue
+            if state.swept or now - state.started_at < STATE_SWEEP_STALE_AFTER:
+                continue
+            if await generation_manager.is_running(state.message_id):
+                continue
+
+            try:
+                if await generation_manager.recover_orphan(session_id, state.message_id):
+                    await session_state.mark_swept(session_id)
+                    result["recovered"] += 1
+                else:
+                    # 消息已不存在，无法续写
+                    await session_state.finish(session_id)
+                    result["removed"] += 1
+            except Exception as e:
+                logger.error(f"Failed to recover session {session_id}: {e}")
+
+        if result["recovered"] or result["removed"]:
+            logger.info(f"State sweep: {result}")
+        return result
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(STATE_SWEEP_INTERVAL)
+            try:
+                if await self.redis.set(SWEEP_LOCK_KEY, "1", nx=True, ex=STATE_SWEEP_INTERVAL):
+                    await self.sweep()
+            except Exception as e:
+                logger.error(f"State sweep failed: {e}")
+
+
+async def memory_report(sample: int = 100) -> Dict:
+    """按键类别统计数量、未设置过期时间的键数和内存占用
+
+    每类只对前 sample 个键执行 MEMORY USAGE，总量按样本均值估算。
+    """
+    families: Dict[str, Dict] = {}
+    cursor = 0
+    while True:
+        cursor, keys = await redis_client.scan(cursor, count=SCAN_COUNT)
+        if keys:
+            await _measure(keys, families, sample)
+        if cursor == 0:
+            break
+
+    for stats in families.values():
+        stats["estimated_bytes"] = (
+            int(stats["sampled_bytes"] / stats["sampled"] * stats["keys"]) if stats["sampled"] else None
+        )
+
+    try:
+        used_memory = (await redis_client.info("memory")).get("used_memory")
+    except ResponseError:
+        # 部分托管Redis禁用了 INFO
+        used_memory = None
+    return {
+        "used_memory": used_memory,
+        "total_keys": sum(stats["keys"] for stats in families.values()),
+        "families": dict(sorted(families.items(), key=lambda item: -item[1]["keys"]))
+    }
+
+
+async def _measure(keys: List[str], families: Dict[str, Dict], sample: int):
+    pipe = redis_client.pipeline(transaction=False)
+    measured = []
+    # 本批中各类已安排采样的键数
+    planned: Dict[str, int] = {}
+    for key in keys:
+        family = key_family(key)
+        stats = families.setdefault(family, {"keys": 0, "without_ttl": 0, "sampled": 0, "sampled_bytes": 0})
+        stats["keys"] += 1
+        pipe.ttl(key)
+        sampled = stats["sampled"] + planned.get(family, 0) < sample
+        if sampled:
+            planned[family] = planned.get(family, 0) + 1
+            pipe.memory_usage(key)
+        measured.append((stats, sampled))
+
+    results = iter(await pipe.execute(raise_on_error=False))
+    for stats, sampled in measured:
+        # -1 为未设置过期时间，-2 为扫描后已被删除
+        if next(results) == -1:
+            stats["without_ttl"] += 1
+        if sampled:
+            usage = next(results)
+            if isinstance(usage, int):
+                stats["sampled"] += 1
+                stats["sampled_bytes"] += usage
+
+
+state_sweeper = StateSweeper(redis_client)
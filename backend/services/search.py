@@ -0,0 +1,197 @@
+import base64
+import html
+import logging
+import os
+import re
+import time
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import and_, column, func, literal, literal_column, or_, select, table, text
+from sqlalchemy.dialects.mysql import match
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from backend.database import async_engine
+from backend.models import ChatSession, Message, SearchHit, SearchPage
+from .metrics import SEARCH_LATENCY
+
+logger = logging.getLogger(__name__)
+
+# 片段长度（字符）
+SEARCH_SNIPPET_CHARS = int(os.getenv("SEARCH_SNIPPET_CHARS", "80"))
+MAX_TERMS = 10
+
+# SQLite：FTS5 trigram 分词可检索任意语言的子串，由触发器随消息表增量维护；只收录已完成的消息
+SQLITE_FTS_DDL = [
+    "CREATE VIRTUAL TABLE message_fts USING fts5(content, message_id UNINDEXED, tokenize='trigram')",
+    """
+    CREATE TRIGGER message_fts_insert AFTER INSERT ON message WHEN new.is_streaming = 0 BEGIN
+        INSERT INTO message_fts(rowid, content, message_id) VALUES (new.rowid, new.content, new.id);
+    END
+    """,
+    """
+    CREATE TRIGGER message_fts_update AFTER UPDATE OF content, is_streaming ON message BEGIN
+        DELETE FROM message_fts WHERE rowid = old.rowid;
+        INSERT INTO message_fts(rowid, content, message_id)
+        SELECT new.rowid, new.content, new.id WHERE new.is_streaming = 0;
+    END
+    """,
+    """
+    CREATE TRIGGER message_fts_delete AFTER DELETE ON message BEGIN
+        DELETE FROM message_fts WHERE rowid = old.rowid;
+    END
+    """,
+    "INSERT INTO message_fts(rowid, content, message_id) SELECT rowid, content, id FROM message WHERE is_streaming = 0",
+]
+
+# 索引能匹配的最短词长：MySQL ngram 默认按2字切分，FTS5 trigram 按3字；更短的词用 LIKE 过滤
+MIN_INDEXED_TERM = {"mysql": 2, "sqlite": 3}
+
+message_fts = table("message_fts", column("rowid"), column("message_id"))
+
+
+def parse_terms(query: str) -> List[str]:
+    """按空白切分为检索词，去掉引号以便作为短语交给全文检索"""
+    terms = []
+    for term in query.replace('"', " ").split():
+        if term.lower() not in (t.lower() for t in terms):
+            terms.append(term)
+    return terms[:MAX_TERMS]
+
+
+def encode_cursor(score: float, message_id: str) -> str:
+    raw = f"{score!r}|{message_id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[float, str]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        score, message_id = base64.urlsafe_b64decode(padded).decode("utf-8").split("|", 1)
+        return float(score), message_id
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def make_snippet(content: str, terms: List[str], width: int = SEARCH_SNIPPET_CHARS) -> str:
+    """截取首个命中位置附近的内容并标出命中词，其余文本做HTML转义"""
+    pattern = re.compile("|".join(re.escape(term) for term in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    first = pattern.search(content)
+    start = max((first.start() if first else 0) - width // 4, 0)
+    end = min(start + width, len(content))
+    window = content[start:end]
+
+    parts, last = [], 0
+    for hit in pattern.finditer(window):
+        parts.append(html.escape(window[last:hit.start()]))
+        parts.append(f"<mark>{html.escape(hit.group())}</mark>")
+        last = hit.end()
+    parts.append(html.escape(window[last:]))
+    return ("…" if start > 0 else "") + "".join(parts).replace("\n", " ") + ("…" if end < len(content) else "")
+
+
+def _like(term: str):
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return Message.content.like(f"%{escaped}%", escape="\\")
+
+
+class MessageSearch:
+    """消息全文检索：MySQL 使用 FULLTEXT 索引，SQLite 使用 FTS5
+
+    索引随消息写入由数据库增量维护，生成中的回复在完成后才可检索。
+    结果按相关度排序，以 (score, message_id) 键集分页；过短的检索词以 LIKE 在候选集上过滤，
+    全部检索词都过短时退化为按消息ID顺序的 LIKE 扫描。
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.dialect = engine.dialect.name
+        self.fts_available = self.dialect == "mysql"
+
+    async def setup(self):
+        """SQLite 下按需创建FTS表和触发器，并为已有消息建立索引"""
+        if self.dialect != "sqlite":
+            return
+        try:
+            async with self.engine.begin() as conn:
+                exists = await conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'message_fts'"))
+                if exists.first() is None:
+                    for statement in SQLITE_FTS_DDL:
+                        await conn.execute(text(statement))
+            self.fts_available = True
+        except Exception as e:
+            logger.warning(f"FTS5 unavailable, search falls back to LIKE scans: {e}")
+
+    async def search(
+            self,
+            db: AsyncSession,
+            query: str,
+            limit: int,
+            cursor: Optional[str] = None,
+            session_id: Optional[str] = None
+    ) -> SearchPage:
+        terms = parse_terms(query)
+        if not terms:
+            raise HTTPException(status_code=400, detail="Empty search query")
+
+        min_length = MIN_INDEXED_TERM.get(self.dialect) if self.fts_available else None
+        indexed = [term for term in terms if min_length and len(term) >= min_length]
+        backend = self.dialect if indexed else "like"
+
+        if not indexed:
+            score = literal(0.0)
+            statement = select(Message, ChatSession.title, score.label("score"))
+        elif self.dialect == "mysql":
+            score = match(Message.content, against=" ".join(f'+"{term}"' for term in indexed)).in_boolean_mode()
+            statement = select(Message, ChatSession.title, score.label("score")).where(score)
+        else:
+            # bm25 越小越相关，取负值使分数越大越相关
+            fts_query = " ".join(f'"{term}"' for term in indexed)
+            ranked = (
+                select(message_fts.c.message_id, (-func.bm25(literal_column("message_fts"))).label("score"))
+                .where(literal_column("message_fts").op("MATCH")(fts_query))
+                .subquery()
+            )
+            score = ranked.c.score
+            statement = (
+                select(Message, ChatSession.title, score)
+                .join(ranked, ranked.c.message_id == Message.id)
+            )
+
+        statement = statement.join(ChatSession, ChatSession.id == Message.session_id).where(
+            Message.is_streaming == False,
+            *(_like(term) for term in terms if term not in indexed)
+        )
+        if session_id:
+            statement = statement.where(Message.session_id == session_id)
+        if cursor:
+            last_score, last_id = decode_cursor(cursor)
+            statement = statement.where(or_(score < last_score, and_(score == last_score, Message.id > last_id)))
+        statement = statement.order_by(score.desc(), Message.id).limit(limit + 1)
+
+        started = time.perf_counter()
+        rows = (await db.execute(statement)).all()
+        elapsed = time.perf_counter() - started
+        SEARCH_LATENCY.labels(backend).observe(elapsed)
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(float(rows[-1].score), rows[-1].Message.id)
+
+        items = [
+            SearchHit(
+                message_id=message.id,
+                session_id=message.session_id,
+                session_title=title,
+                role=message.role,
+                snippet=make_snippet(message.content, terms),
+                score=float(row_score),
+                created_at=message.created_at
+            )
+            for message, title, row_score in rows
+        ]
+        return SearchPage(items=items, next_cursor=next_cursor, took_ms=round(elapsed * 1000, 2))
+
+
+message_search = MessageSearch(async_engine)
@@ -0,0 +1,103 @@
+import argparse
+import asyncio
+import json
+import logging
+import time
+import uuid
+from typing import Dict, List
+
+from sqlalchemy import select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from backend.database import async_engine, close_connections
+from backend.models import ChatSession, Message, SessionArchive
+from .archive import decode_messages, decompress
+from .generation_worker import generation_manager
+from .session_summary import summarize
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_BATCH_SIZE = 500
+BACKFILL_PAUSE_SECONDS = 0.1
+
+
+async def backfill(batch_size: int = BACKFILL_BATCH_SIZE) -> Dict:
+    """按会话ID分批由消息表（归档会话由归档数据）重新计算全部会话的摘要字段
+
+    每个会话计算期间占用其生成租约，正在生成的会话跳过，可重新执行补齐。
+    """
+    report = {"sessions": 0, "skipped": 0}
+    started = time.perf_counter()
+    last_id = None
+    holder = f"backfill:{uuid.uuid4().hex}"
+
+    while True:
+        async with AsyncSession(async_engine, expire_on_commit=False) as db:
+            statement = select(ChatSession).order_by(ChatSession.id).limit(batch_size)
+            if last_id:
+                statement = statement.where(ChatSession.id > last_id)
+            sessions = (await db.execute(statement)).scalars().all()
+            if not sessions:
+                break
+            last_id = sessions[-1].id
+
+            reserved = []
+            for session in sessions:
+                if await generation_manager.reserve(session.id, holder) is None:
+                    reserved.append(session)
+                else:
+                    report["skipped"] += 1
+            try:
+                values = await _summarize_batch(db, reserved)
+                if values:
+                    await db.execute(update(ChatSession), values)
+                    await db.commit()
+                report["sessions"] += len(values)
+            finally:
+                for session in reserved:
+                    await generation_manager.release(session.id, holder)
+
+        await asyncio.sleep(BACKFILL_PAUSE_SECONDS)
+
+    report["elapsed_seconds"] = round(time.perf_counter() - started, 3)
+    logger.info(f"Session summary backfill: {report}")
+    return report
+
+
+async def _summarize_batch(db: AsyncSession, sessions: List[ChatSession]) -> List[Dict]:
+    ids = [session.id for session in sessions]
+    if not ids:
+        return []
+    by_session: Dict[str, List[Message]] = {session_id: [] for session_id in ids}
+    messages = (await db.execute(
+        select(Message).where(Message.session_id.in_(ids)).order_by(Message.created_at, Message.id)
+    )).scalars().all()
+    for message in messages:
+        by_session[message.session_id].append(message)
+
+    archived = [session.id for session in sessions if session.archived_at]
+    if archived:
+        archives = (await db.execute(
+            select(SessionArchive).where(SessionArchive.session_id.in_(archived))
+        )).scalars().all()
+        for archive in archives:
+            by_session[archive.session_id] = decode_messages(
+                archive.session_id, decompress(archive.data, archive.codec)
+            )
+    return [summarize(session, by_session[session.id]) for session in sessions]
+
+
+async def _main():
+    parser = argparse.ArgumentParser(description="重新计算会话列表的摘要字段（消息数、最后一条消息预览、token总数等）")
+    parser.add_argument("--batch-size", type=int, default=BACKFILL_BATCH_SIZE)
+    args = parser.parse_args()
+    try:
+        print(json.dumps(await backfill(args.batch_size), ensure_ascii=False, indent=2))
+    finally:
+        await close_connections()
+
+
+# python -m backend.services.session_backfill --batch-size 500
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main())
@@ -0,0 +1,82 @@
+import os
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from backend.database import redis_client
+
+# 中断后可续写的时长，生成过程中由心跳续期
+SESSION_STATE_TTL = int(os.getenv("SESSION_STATE_TTL", "86400"))
+
+
+@dataclass
+class StreamingState:
+    message_id: str
+    user_message_id: Optional[str]
+    started_at: float
+    # 已由清理任务处理（部分内容已保存、会话已标记中断）
+    swept: bool = False
+    # 旧格式直接保存的用户消息原文
+    user_message: Optional[str] = None
+
+
+class SessionStateStore:
+    """会话的流式状态：Redis 哈希 session:{id}
+
+    只在生成进行中或中断待续写时存在，生成正常结束后删除。字段名压缩为单个字母：
+    m 回复消息ID，u 用户消息ID（原文从数据库读取，不在每个哈希中重复保存），t 开始时间，x 已被清理任务处理。
+    """
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+
+    @staticmethod
+    def key(session_id: str) -> str:
+        return f"session:{session_id}"
+
+    async def start(self, session_id: str, message_id: str, user_message_id: str):
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.delete(self.key(session_id))
+        pipe.hset(self.key(session_id), mapping={"m": message_id, "u": user_message_id, "t": int(time.time())})
+        pipe.expire(self.key(session_id), SESSION_STATE_TTL)
+        await pipe.execute()
+
+    async def get(self, session_id: str) -> Optional[StreamingState]:
+        data = await self.redis.hgetall(self.key(session_id))
+        if data.get("m"):
+            return StreamingState(
+                message_id=data["m"],
+                user_message_id=data.get("u"),
+                started_at=float(data.get("t", 0)),
+                swept="x" in data
+            )
+        # 旧格式：status/current_message_id/last_user_message
+        if data.get("status") == "streaming" and data.get("current_message_id"):
+            return StreamingState(
+                message_id=data["current_message_id"],
+                user_message_id=None,
+                started_at=0,
+                user_message=data.get("last_user_message")
+            )
+        return None
+
+    async def resume(self, session_id: str):
+        """续写重新开始计时，清除清理标记以便再次中断时仍会被处理"""
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hdel(self.key(session_id), "x")
+        pipe.hset(self.key(session_id), "t", int(time.time()))
+        pipe.expire(self.key(session_id), SESSION_STATE_TTL)
+        await pipe.execute()
+
+    def touch(self, pipe, session_id: str):
+        """在调用方的pipeline中续期"""
+        pipe.expire(self.key(session_id), SESSION_STATE_TTL)
+
+    async def finish(self, session_id: str):
+        await self.redis.delete(self.key(session_id))
+
+    async def mark_swept(self, session_id: str):
+        await self.redis.hset(self.key(session_id), "x", 1)
+
+
+session_state = SessionStateStore(redis_client)
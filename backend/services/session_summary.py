@@ -0,0 +1,58 @@
+import os
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from backend.models import ChatSession, Message
+from .openai_service import get_openai_service
+
+# 会话列表中最后一条消息预览的长度（字符），不超过列宽
+SESSION_PREVIEW_CHARS = min(int(os.getenv("SESSION_PREVIEW_CHARS", "100")), 255)
+
+
+def preview(content: str) -> str:
+    text = " ".join(content.split())
+    if len(text) <= SESSION_PREVIEW_CHARS:
+        return text
+    return text[:SESSION_PREVIEW_CHARS - 1] + "…"
+
+
+def reply_tokens(content: str, prompt_tokens: Optional[int]) -> int:
+    """一次回复消耗的token：提示token加上按上下文分词器估算的回复token"""
+    return (prompt_tokens or 0) + get_openai_service().context.tokenizer.count(content)
+
+
+def user_turn_values(session: ChatSession, content: str, added: int = 2) -> Dict:
+    """写入用户消息（及回复占位）时会话摘要字段的新值，调用方须持有会话的生成租约"""
+    return {
+        "updated_at": datetime.utcnow(),
+        "message_count": session.message_count + added,
+        "last_message_preview": preview(content),
+        "last_role": "user"
+    }
+
+
+def reply_values(session: ChatSession, content: str, prompt_tokens: Optional[int]) -> Dict:
+    """回复完成时会话摘要字段的新值，空回复不替换预览"""
+    values = {
+        "updated_at": datetime.utcnow(),
+        "total_tokens": session.total_tokens + reply_tokens(content, prompt_tokens)
+    }
+    if content.strip():
+        values.update(last_message_preview=preview(content), last_role="assistant")
+    return values
+
+
+def summarize(session: ChatSession, messages: List[Message]) -> Dict:
+    """由会话的全部消息（按时间正序）计算摘要字段，不改动 updated_at 以免打乱会话列表顺序"""
+    visible = [message for message in messages if message.content.strip()]
+    last = visible[-1] if visible else None
+    return {
+        "id": session.id,
+        "message_count": len(messages),
+        "last_message_preview": preview(last.content) if last else None,
+        "last_role": last.role if last else None,
+        "total_tokens": sum(
+            reply_tokens(message.content, message.prompt_tokens)
+            for message in messages if message.role == "assistant"
+        )
+    }
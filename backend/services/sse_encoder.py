@@ -0,0 +1,130 @@
+import importlib
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from .metrics import SSE_BYTES, SSE_ENCODE, SSE_FRAMES
+
+logger = logging.getLogger(__name__)
+
+# auto（已安装 orjson 时使用，否则标准库）/ orjson / json / 自定义 "module:function"（返回bytes）
+SSE_JSON_BACKEND = os.getenv("SSE_JSON_BACKEND", "auto")
+# 连续内容增量的合并窗口（毫秒，0 为每个日志条目一帧）和提前发送的字节数
+SSE_COALESCE_MS = int(os.getenv("SSE_COALESCE_MS", "20"))
+SSE_COALESCE_BYTES = int(os.getenv("SSE_COALESCE_BYTES", "1024"))
+
+JsonDumps = Callable[[Any], bytes]
+
+
+def _stdlib_dumps(data: Any) -> bytes:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def get_json_backend(name: str) -> JsonDumps:
+    """按配置选择JSON序列化，依赖缺失时退回标准库"""
+    try:
+        if name in ("auto", "orjson"):
+            import orjson
+            return orjson.dumps
+        if ":" in name:
+            module_name, function_name = name.split(":", 1)
+            return getattr(importlib.import_module(module_name), function_name)
+    except Exception as e:
+        if name != "auto":
+            logger.warning(f"JSON backend {name} unavailable, falling back to json: {e}")
+    return _stdlib_dumps
+
+
+json_dumps = get_json_backend(SSE_JSON_BACKEND)
+
+
+class SSEEncoder:
+    """把事件编码为SSE帧（UTF-8字节）
+
+    帧的固定部分预先编码；内容帧只序列化增量本身，消息ID部分按消息缓存。
+    """
+
+    DATA = b"data: "
+    ID = b"id: "
+    END = b"\n\n"
+    KEEPALIVE = b": keepalive\n\n"
+    CONTENT_PREFIX = b'{"type":"content","content":'
+
+    def __init__(self, legacy: bool, dumps: JsonDumps = json_dumps):
+        self.legacy = legacy
+        self.dumps = dumps
+        self._content_suffixes: Dict[str, bytes] = {}
+
+    def encode(self, data: dict, offset: int) -> bytes:
+        started = time.perf_counter()
+        frame = self._frame(self.dumps(data), offset)
+        self._observe(data["type"], frame, started)
+        return frame
+
+    def content(self, message_id: str, content: str, offset: int) -> bytes:
+        """内容增量帧，等价于 encode({"type": "content", "content": ..., "message_id": ...})"""
+        started = time.perf_counter()
+        suffix = self._content_suffixes.get(message_id)
+        if suffix is None:
+            suffix = self._content_suffixes[message_id] = b',"message_id":' + self.dumps(message_id) + b"}"
+        frame = self._frame(self.CONTENT_PREFIX + self.dumps(content) + suffix, offset)
+        self._observe("content", frame, started)
+        return frame
+
+    def _frame(self, payload: bytes, offset: int) -> bytes:
+        if self.legacy:
+            return self.DATA + payload + self.END
+        return b"".join((self.ID, str(offset).encode(), b"\n", self.DATA, payload, self.END))
+
+    @staticmethod
+    def _observe(event_type: str, frame: bytes, started: float):
+        SSE_ENCODE.observe(time.perf_counter() - started)
+        SSE_FRAMES.labels(event_type).inc()
+        SSE_BYTES.labels(event_type).inc(len(frame))
+
+
+class ContentCoalescer:
+    """Nagle式合并：窗口内连续的内容增量合并为一帧发送
+
+    首个增量立即发送以免增加首字延迟；缓冲超过 max_bytes 或窗口到期时发送；
+    控制事件（retry、done、error）之前由调用方先取出缓冲的内容。
+    """
+
+    def __init__(self, window_ms: int = SSE_COALESCE_MS, max_bytes: int = SSE_COALESCE_BYTES):
+        self.window = window_ms / 1000
+        self.max_bytes = max_bytes
+        self._parts: List[str] = []
+        self._size = 0
+        self._deadline: Optional[float] = None
+        self._first = True
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._parts)
+
+    def add(self, content: str) -> bool:
+        """缓冲一个增量，返回是否应立即发送"""
+        self._parts.append(content)
+        self._size += len(content.encode("utf-8"))
+        if self._deadline is None:
+            self._deadline = time.monotonic() + self.window
+        if self._first or self.window <= 0 or self._size >= self.max_bytes:
+            self._first = False
+            return True
+        return False
+
+    def due(self) -> bool:
+        return self._deadline is not None and time.monotonic() >= self._deadline
+
+    def timeout(self, default: float) -> float:
+        """等待新条目的时长，不超过窗口剩余时间"""
+        if self._deadline is None:
+            return default
+        return min(default, max(self._deadline - time.monotonic(), 0))
+
+    def take(self) -> str:
+        content = "".join(self._parts)
+        self._parts, self._size, self._deadline = [], 0, None
+        return content
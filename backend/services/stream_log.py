@@ -0,0 +1,53 @@
+import os
+from typing import Dict, List, Optional, Tuple
+
+STREAM_LOG_TTL = int(os.getenv("STREAM_LOG_TTL", "600"))
+
+
+class StreamLog:
+    """基于Redis Stream的消息生成日志：生成任务追加写入，SSE连接按偏移读取"""
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+
+    @staticmethod
+    def key(message_id: str) -> str:
+        return f"message:{message_id}:log"
+
+    @staticmethod
+    def notify_channel(message_id: str) -> str:
+        """日志有新条目时发布通知的频道，供其他进程中的读者及时读取"""
+        return f"message:{message_id}:notify"
+
+    async def append(self, message_id: str, event: Dict[str, str]) -> str:
+        return await self.redis.xadd(self.key(message_id), event)
+
+    async def read(self, message_id: str, after_id: str = "0-0", count: Optional[int] = None) -> List[Tuple[str, Dict]]:
+        """读取after_id之后的日志条目（不阻塞）"""
+        result = await self.redis.xread({self.key(message_id): after_id}, count=count)
+        if not result:
+            return []
+        return result[0][1]
+
+    async def last(self, message_id: str) -> Optional[Dict]:
+        """最后一条日志条目，日志不存在时返回None"""
+        entries = await self.redis.xrevrange(self.key(message_id), count=1)
+        return entries[0][1] if entries else None
+
+    async def expire(self, message_id: str, ttl: int = STREAM_LOG_TTL):
+        await self.redis.expire(self.key(message_id), ttl)
+
+    @staticmethod
+    def fold(entries: List[Tuple[str, Dict]]) -> Tuple[str, str, Optional[Dict]]:
+        """把日志条目折叠为(已生成内容, 最后条目ID, 结束事件)"""
+        content = ""
+        last_id = "0-0"
+        final_event = None
+        for entry_id, fields in entries:
+            last_id = entry_id
+            if fields.get("type") == "content":
+                content += fields.get("content", "")
+                final_event = None
+            elif fields.get("type") in ("done", "error"):
+                final_event = fields
+        return content, last_id, final_event
@@ -0,0 +1,444 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncGenerator, Dict, List, Optional
+
+from openai import APIConnectionError, APIStatusError, AsyncOpenAI, RateLimitError
+
+from .metrics import (
+    RATE_LIMIT_WAIT, UPSTREAM_BREAKER_STATE, UPSTREAM_HEDGES, UPSTREAM_REQUESTS, UPSTREAM_RETRIES, UpstreamTimer
+)
+from .rate_limiter import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+# 首token时间和错误率的指数滑动平均系数
+ROUTER_EWMA_ALPHA = float(os.getenv("ROUTER_EWMA_ALPHA", "0.2"))
+# 评分 = 首token时间均值 × (1 + 系数 × 错误率)，越小越优先
+ROUTER_ERROR_PENALTY = float(os.getenv("ROUTER_ERROR_PENALTY", "5"))
+# 按该比例随机选择非最优上游，使其延迟估计保持更新
+ROUTER_EXPLORE_RATIO = float(os.getenv("ROUTER_EXPLORE_RATIO", "0.05"))
+# 超过该毫秒数仍未收到首token时向另一个上游发出对冲请求，0为不对冲
+ROUTER_HEDGE_AFTER_MS = int(os.getenv("ROUTER_HEDGE_AFTER_MS", "0"))
+# 每个请求最多尝试的次数（含切换上游），同一上游重试时按指数退避
+ROUTER_MAX_ATTEMPTS = int(os.getenv("ROUTER_MAX_ATTEMPTS", "3"))
+ROUTER_RETRY_DELAY = float(os.getenv("ROUTER_RETRY_DELAY", "1.0"))
+# 连续失败该次数后熔断，冷却后放行一个探测请求
+ROUTER_BREAKER_FAILURES = int(os.getenv("ROUTER_BREAKER_FAILURES", "5"))
+ROUTER_BREAKER_COOLDOWN = float(os.getenv("ROUTER_BREAKER_COOLDOWN", "30"))
+
+
+class NoBackendAvailable(Exception):
+    pass
+
+
+def is_retryable(error: BaseException) -> bool:
+    """限流、连接错误（含超时）和5xx可以换一个上游重试，其余错误与上游无关"""
+    if isinstance(error, (RateLimitError, APIConnectionError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+
+def chunk_event(chunk, model: str) -> Optional[Dict]:
+    """把上游的流式片段转换为内容或结束事件，结束事件带上实际生成回复的模型"""
+    if not chunk.choices:
+        return None
+    choice = chunk.choices[0]
+    content = getattr(choice.delta, "content", None)
+    if content:
+        return {"type": "content", "content": content, "finish_reason": choice.finish_reason}
+    if choice.finish_reason:
+        return {"type": "done", "finish_reason": choice.finish_reason, "model": model}
+    return None
+
+
+class CircuitBreaker:
+    """连续失败达到阈值后熔断，冷却期过后只放行一个探测请求，成功则恢复"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    GAUGE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name: str, failures: int = ROUTER_BREAKER_FAILURES, cooldown: float = ROUTER_BREAKER_COOLDOWN):
+        self.name = name
+        self.threshold = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._set_state(self.CLOSED)
+
+    def _set_state(self, state: str):
+        self.state = state
+        UPSTREAM_BREAKER_STATE.labels(self.name).set(self.GAUGE[state])
+
+    def available(self) -> bool:
+        if self.state == self.OPEN:
+            return time.monotonic() - self.opened_at >= self.cooldown
+        return not (self.state == self.HALF_OPEN and self._probing)
+
+    def try_acquire(self) -> bool:
+        if not self.available():
+            return False
+        if self.state != self.CLOSED:
+            self._set_state(self.HALF_OPEN)
+            self._probing = True
+        return True
+
+    def release(self):
+        """请求未得出结果（被取消或与上游无关的错误），归还探测名额"""
+        self._probing = False
+
+    def on_success(self):
+        self.failures = 0
+        self._probing = False
+        if self.state != self.CLOSED:
+            logger.info(f"Upstream {self.name} recovered, circuit closed")
+            self._set_state(self.CLOSED)
+
+    def on_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+            logger.warning(f"Upstream {self.name} failed {self.failures} times, circuit open")
+            self.opened_at = time.monotonic()
+            self._set_state(self.OPEN)
+
+
+@dataclass(eq=False)
+class Backend:
+    """一个 OpenAI 兼容的上游，延迟和错误率只在本进程内统计"""
+    name: str
+    model: str
+    base_url: str
+    client: AsyncOpenAI
+    rate_limiter: RateLimiter
+    breaker: Optional[CircuitBreaker] = None
+    ttft: Optional[float] = None
+    error_rate: float = 0.0
+    inflight: int = 0
+
+    def __post_init__(self):
+        if self.breaker is None:
+            self.breaker = CircuitBreaker(self.name)
+
+    @property
+    def score(self) -> float:
+        # 尚无延迟样本的上游优先尝试
+        return (self.ttft or 0.0) * (1 + ROUTER_ERROR_PENALTY * self.error_rate)
+
+    def observe_latency(self, seconds: float):
+        if self.ttft is None:
+            self.ttft = seconds
+        else:
+            self.ttft += ROUTER_EWMA_ALPHA * (seconds - self.ttft)
+
+    def on_success(self, ttft: Optional[float] = None):
+        if ttft is not None:
+            self.observe_latency(ttft)
+        self.error_rate *= 1 - ROUTER_EWMA_ALPHA
+        self.breaker.on_success()
+        UPSTREAM_REQUESTS.labels(self.name, "ok").inc()
+
+    def on_failure(self):
+        self.error_rate += ROUTER_EWMA_ALPHA * (1 - self.error_rate)
+        self.breaker.on_failure()
+        UPSTREAM_REQUESTS.labels(self.name, "error").inc()
+
+    def on_abandoned(self, waited: float):
+        """对冲落败或调用方取消：已等待的时长是首token时间的下限，超过当前估计时才计入"""
+        if self.ttft is None or waited > self.ttft:
+            self.observe_latency(waited)
+        self.breaker.release()
+        UPSTREAM_REQUESTS.labels(self.name, "abandoned").inc()
+
+
+@dataclass
+class OpenedStream:
+    """已收到首个事件的上游流"""
+    backend: Backend
+    stream: Any
+    iterator: Any
+    timer: UpstreamTimer
+    buffered: List[Dict] = field(default_factory=list)
+    exhausted: bool = False
+
+
+class UpstreamRouter:
+    """在多个上游之间路由请求
+
+    按首token时间和错误率的滑动平均选择评分最好的上游；首token超过 ROUTER_HEDGE_AFTER_MS 未到达时
+    向另一个上游发出对冲请求，先返回首token的流胜出，另一个立即取消。
+    出错的上游计入熔断器，请求切换到下一个上游；首token之后出错不再重试，以免内容重复。
+    """
+
+    def __init__(self, backends: List[Backend]):
+        if not backends:
+            raise ValueError("At least one upstream backend is required")
+        self.backends = backends
+
+    @property
+    def primary(self) -> Backend:
+        return self.backends[0]
+
+    def preferred_model(self) -> str:
+        """当前评分最好的可用上游的模型，即下一次请求最可能使用的模型；全部熔断时为主上游的模型"""
+        candidates = [backend for backend in self.backends if backend.breaker.available()]
+        if not candidates:
+            return self.primary.model
+        return min(candidates, key=lambda backend: (backend.score, backend.inflight)).model
+
+    async def close(self):
+        for backend in self.backends:
+            await backend.client.close()
+
+    def _pick(self, tried: List[Backend], repeat: bool = True) -> Optional[Backend]:
+        """选择评分最好的可用上游，优先本次请求尚未尝试过的；repeat 为 False 时只选未尝试过的"""
+        candidates = sorted(
+            (backend for backend in self.backends if backend.breaker.available()),
+            key=lambda backend: (backend.score, backend.inflight)
+        )
+        fresh = [backend for backend in candidates if backend not in tried]
+        if len(fresh) > 1 and random.random() < ROUTER_EXPLORE_RATIO:
+            fresh.insert(0, fresh.pop(random.randrange(1, len(fresh))))
+        for backend in fresh + (candidates if repeat else []):
+            if backend.breaker.try_acquire():
+                return backend
+        return None
+
+    @staticmethod
+    async def _acquire(backend: Backend, estimated_tokens: int):
+        queued_at = time.perf_counter()
+        await backend.rate_limiter.acquire(estimated_tokens)
+        RATE_LIMIT_WAIT.labels(backend.name).observe(time.perf_counter() - queued_at)
+
+    @staticmethod
+    async def _request(backend: Backend, **kwargs):
+        """调用上游，并把限额响应头反馈给该上游的限流器"""
+        try:
+            response = await backend.client.chat.completions.with_raw_response.create(model=backend.model, **kwargs)
+        except RateLimitError as e:
+            await backend.rate_limiter.on_rate_limited(e.response.headers)
+            raise
+        await backend.rate_limiter.on_response(response.headers)
+        return response.parse()
+
+    @staticmethod
+    def _retry_event(error: Exception, failed: Backend, backend: Backend, attempt: int, delay: float) -> Dict:
+        reason = type(error).__name__
+        if backend is failed:
+            message = f"上游调用失败（{reason}），{delay:g}秒后重试..." if delay else f"上游调用失败（{reason}），正在重试..."
+        else:
+            message = f"上游 {failed.name} 调用失败（{reason}），切换到 {backend.name}..."
+        return {"type": "retry", "message": message, "attempt": attempt}
+
+    @staticmethod
+    def _retry_delay(error: Exception, failed: Backend, backend: Backend, attempt: int) -> float:
+        # 换到其他上游无需等待；429 的等待由限流器按 Retry-After 统一完成
+        if backend is not failed or isinstance(error, RateLimitError):
+            return 0.0
+        return ROUTER_RETRY_DELAY * (2 ** (attempt - 1))
+
+    async def create(self, estimated_tokens: int, **kwargs):
+        """非流式调用，失败时切换上游重试"""
+        tried: List[Backend] = []
+        last_error: Optional[Exception] = None
+        for attempt in range(ROUTER_MAX_ATTEMPTS):
+            backend = self._pick(tried)
+            if backend is None:
+                break
+            if last_error is not None:
+                UPSTREAM_RETRIES.labels(type(last_error).__name__).inc()
+                delay = self._retry_delay(last_error, tried[-1], backend, attempt)
+                if delay:
+                    await asyncio.sleep(delay)
+            tried.append(backend)
+
+            backend.inflight += 1
+            try:
+                await self._acquire(backend, estimated_tokens)
+                response = await self._request(backend, **kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    backend.breaker.release()
+                    raise
+                backend.on_failure()
+                last_error = e
+                logger.warning(f"Upstream {backend.name} failed: {e}")
+                continue
+            except BaseException:
+                backend.breaker.release()
+                raise
+            finally:
+                backend.inflight -= 1
+            backend.on_success()
+            return response
+        raise last_error or NoBackendAvailable("所有上游均已熔断")
+
+    async def _open(self, backend: Backend, estimated_tokens: int, kind: str, kwargs: Dict) -> OpenedStream:
+        """发出流式请求并读到首个内容或结束事件为止"""
+        backend.inflight += 1
+        stream = None
+        timer = UpstreamTimer(backend.name, kind)
+        try:
+            await self._acquire(backend, estimated_tokens)
+            timer.start()
+            stream = await self._request(backend, stream=True, **kwargs)
+            opened = OpenedStream(backend, stream, stream.__aiter__(), timer)
+            while True:
+                try:
+                    chunk = await opened.iterator.__anext__()
+                except StopAsyncIteration:
+                    opened.exhausted = True
+                    break
+                event = chunk_event(chunk, backend.model)
+                if event:
+                    opened.buffered.append(event)
+                    if event["type"] == "content":
+                        timer.token()
+                    break
+            backend.on_success(time.perf_counter() - timer.started)
+            return opened
+        except BaseException as e:
+            backend.inflight -= 1
+            if stream is not None:
+                await stream.response.aclose()
+            if isinstance(e, asyncio.CancelledError):
+                if timer.started is not None:
+                    backend.on_abandoned(time.perf_counter() - timer.started)
+                else:
+                    backend.breaker.release()
+            elif isinstance(e, Exception) and is_retryable(e):
+                backend.on_failure()
+            else:
+                backend.breaker.release()
+            raise
+
+    @staticmethod
+    async def _release(opened: OpenedStream):
+        opened.backend.inflight -= 1
+        await opened.stream.response.aclose()
+
+    def _abandon(self, task: asyncio.Task):
+        """取消落败的请求；已经完成的则关闭其上游连接"""
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and task.exception() is None:
+            asyncio.create_task(self._release(task.result()))
+
+    def _spawn(self, backend: Backend, estimated_tokens: int, kind: str, kwargs: Dict) -> asyncio.Task:
+        task = asyncio.create_task(self._open(backend, estimated_tokens, kind, kwargs))
+        # 落败的请求不再被等待，取走其异常避免告警
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+
+    async def stream(self, estimated_tokens: int, kind: str, **kwargs) -> AsyncGenerator[Dict, None]:
+        """流式调用，依次产出 retry / content / done 事件"""
+        loop = asyncio.get_running_loop()
+        pending: Dict[asyncio.Task, Backend] = {}
+        tried: List[Backend] = []
+        opened: Optional[OpenedStream] = None
+        last_error: Optional[Exception] = None
+        hedged = ROUTER_HEDGE_AFTER_MS <= 0
+        hedge_at = 0.0
+        hedge_backend: Optional[Backend] = None
+        attempt = 0
+
+        try:
+            while opened is None:
+                if not pending:
+                    backend = self._pick(tried) if attempt < ROUTER_MAX_ATTEMPTS else None
+                    if backend is None:
+                        raise last_error or NoBackendAvailable("所有上游均已熔断")
+                    if last_error is not None:
+                        UPSTREAM_RETRIES.labels(type(last_error).__name__).inc()
+                        delay = self._retry_delay(last_error, tried[-1], backend, attempt)
+                        yield self._retry_event(last_error, tried[-1], backend, attempt, delay)
+                        if delay:
+                            await asyncio.sleep(delay)
+                    attempt += 1
+                    tried.append(backend)
+                    pending[self._spawn(backend, estimated_tokens, kind, kwargs)] = backend
+                    hedge_at = loop.time() + ROUTER_HEDGE_AFTER_MS / 1000
+
+                timeout = None if hedged else max(hedge_at - loop.time(), 0)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # 首token超时：向另一个上游发出对冲请求，两者谁先返回首token用谁
+                    hedged = True
+                    hedge_backend = self._pick(tried, repeat=False)
+                    if hedge_backend is not None:
+                        logger.info(f"No first token after {ROUTER_HEDGE_AFTER_MS}ms, hedging to {hedge_backend.name}")
+                        tried.append(hedge_backend)
+                        pending[self._spawn(hedge_backend, estimated_tokens, kind, kwargs)] = hedge_backend
+                    continue
+
+                # 同一批完成的对冲请求中有一个成功时优先使用它，不因另一个的错误放弃
+                fatal: Optional[Exception] = None
+                for task in done:
+                    backend = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        if not is_retryable(e):
+                            fatal = fatal or e
+                            continue
+                        last_error = e
+                        logger.warning(f"Upstream {backend.name} failed: {e}")
+                        continue
+                    if opened is None:
+                        opened = result
+                    else:
+                        await self._release(result)
+                if opened is None and fatal is not None:
+                    raise fatal
+
+            if hedge_backend is not None:
+                UPSTREAM_HEDGES.labels("won" if opened.backend is hedge_backend else "lost").inc()
+        except BaseException:
+            # 已打开的流尚未交给读取方，关闭它以归还上游连接
+            if opened is not None:
+                await self._release(opened)
+            raise
+        finally:
+            for task in pending:
+                self._abandon(task)
+
+        backend = opened.backend
+        try:
+            for event in opened.buffered:
+                yield event
+            if not opened.exhausted:
+                async for chunk in opened.iterator:
+                    event = chunk_event(chunk, backend.model)
+                    if event:
+                        if event["type"] == "content":
+                            opened.timer.token()
+                        yield event
+        except Exception as e:
+            if is_retryable(e):
+                backend.on_failure()
+            raise
+        finally:
+            await self._release(opened)
+
+    async def stats(self) -> List[Dict]:
+        result = []
+        for backend in self.backends:
+            result.append({
+                "name": backend.name,
+                "model": backend.model,
+                "base_url": backend.base_url,
+                "circuit": backend.breaker.state,
+                "consecutive_failures": backend.breaker.failures,
+                "ttft_ms": round(backend.ttft * 1000, 1) if backend.ttft is not None else None,
+                "error_rate": round(backend.error_rate, 4),
+                "score": round(backend.score, 4),
+                "inflight": backend.inflight,
+                "rate_limit": await backend.rate_limiter.stats()
+            })
+        return result
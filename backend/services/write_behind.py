@@ -0,0 +1,367 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import datetime
+from enum import Enum
+from typing import Dict, List, Optional, Set, Tuple, Type
+
+from sqlalchemy import DateTime, insert, select, update
+from sqlalchemy.exc import InterfaceError, OperationalError, TimeoutError as PoolTimeoutError
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from backend.database import async_engine, redis_client
+from backend.models import ChatSession, Message
+from .metrics import DB_COMMIT, WRITE_BEHIND_PENDING
+
+logger = logging.getLogger(__name__)
+
+# 关闭时每次写入都直接提交到数据库
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "true").lower() in ("1", "true", "yes")
+# 合并后批量写入数据库的间隔，积压行数达到 BATCH_SIZE 时提前写入
+WRITE_BEHIND_FLUSH_MS = int(os.getenv("WRITE_BEHIND_FLUSH_MS", "200"))
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "500"))
+# 生成过程中把已生成的部分内容写入队列的间隔，0 为只在结束时保存
+WRITE_BEHIND_CHECKPOINT_MS = int(os.getenv("WRITE_BEHIND_CHECKPOINT_MS", "1000"))
+# 进程存活标记的有效期，过期后其他进程接管它留在日志中的写入
+WRITE_BEHIND_NODE_TTL = int(os.getenv("WRITE_BEHIND_NODE_TTL", "15"))
+# 同一行写入失败该次数后转入死信，不再阻塞其他写入
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv("WRITE_BEHIND_MAX_ATTEMPTS", "5"))
+RECOVER_INTERVAL = 30
+
+JOURNAL_KEY = "writebehind:journal"
+# 死信：日志条目ID -> 写入失败的行和错误，对应的日志条目保留在日志中，供排查后手动处理
+DEAD_LETTER_KEY = "writebehind:deadletter"
+
+RowKey = Tuple[str, str]
+
+# 按外键依赖顺序写入
+MODELS: Dict[str, Type[SQLModel]] = {
+    ChatSession.__tablename__: ChatSession,
+    Message.__tablename__: Message,
+}
+TABLE_ORDER = {table_name: index for index, table_name in enumerate(MODELS)}
+
+
+def insert_row(entity: SQLModel) -> Dict:
+    """新建记录：整行写入"""
+    table = entity.__table__
+    values = {column.name: getattr(entity, column.name) for column in table.columns}
+    return {"table": table.name, "session_id": _session_of(entity), "values": values}
+
+
+def update_row(model: Type[SQLModel], row_id: str, session_id: str, **values) -> Dict:
+    """更新已有记录的部分字段"""
+    return {"table": model.__tablename__, "session_id": session_id, "values": {"id": row_id, **values}}
+
+
+def _session_of(entity: SQLModel) -> str:
+    return entity.session_id if isinstance(entity, Message) else entity.id
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Enum):
+        return value.value
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def _unavailable(error: Exception) -> bool:
+    """数据库不可用（连接失败、连接池超时、锁等待等），与具体的行无关，重试即可"""
+    return isinstance(error, (OperationalError, InterfaceError, PoolTimeoutError, OSError, asyncio.TimeoutError))
+
+
+def _decode(table_name: str, values: Dict) -> Dict:
+    """把日志中的JSON值还原为列类型"""
+    columns = MODELS[table_name].__table__.columns
+    decoded = dict(values)
+    for name, value in values.items():
+        if isinstance(value, str) and isinstance(columns[name].type, DateTime):
+            decoded[name] = datetime.fromisoformat(value)
+    return decoded
+
+
+class WriteBehindQueue:
+    """消息和会话写入的后写队列
+
+    写入先追加到Redis日志（至少一次），再在内存中按行合并，定时批量写入数据库，
+    请求路径不再等待数据库提交。正常写入后从日志删除；进程崩溃后由其他进程接管日志中剩余的写入。
+    读取会话数据之前调用 barrier 确保本进程尚未写入的变更已落库。
+    批量写入因个别行失败时逐行重写，其余行照常落库；反复失败的行转入死信。
+    """
+
+    def __init__(self, redis_client, engine):
+        self.redis = redis_client
+        self.engine = engine
+        self.node_id = uuid.uuid4().hex
+        self._pending: Dict[RowKey, Dict] = {}
+        # 尚未写入的日志条目及其包含的行
+        self._entries: List[Tuple[str, Set[RowKey]]] = []
+        self._attempts: Dict[RowKey, int] = {}
+        # 本进程转入死信的日志条目，不从日志删除
+        self._dead_entries: Set[str] = set()
+        self._pending_sessions: Set[str] = set()
+        self._inflight_sessions: Set[str] = set()
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def node_key(node_id: str) -> str:
+        return f"writebehind:node:{node_id}"
+
+    async def start(self):
+        if not WRITE_BEHIND_ENABLED or self._task is not None:
+            return
+        await self.redis.set(self.node_key(self.node_id), "1", ex=WRITE_BEHIND_NODE_TTL)
+        await self.recover()
+        self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        """停止后台写入并写完剩余变更"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        try:
+            await self.flush()
+        finally:
+            await self.redis.delete(self.node_key(self.node_id))
+
+    async def put(self, *rows: Dict):
+        """提交一组写入，返回时已记入Redis日志"""
+        if not WRITE_BEHIND_ENABLED or self._task is None:
+            await self._write(list(rows))
+            return
+
+        entry_id = await self.redis.xadd(JOURNAL_KEY, {
+            "node": self.node_id,
+            "rows": json.dumps(rows, default=_encode, ensure_ascii=False)
+        })
+        self._merge(rows)
+        self._entries.append((entry_id, {(row["table"], row["values"]["id"]) for row in rows}))
+        if len(self._pending) >= WRITE_BEHIND_BATCH_SIZE:
+            self._wakeup.set()
+
+    async def barrier(self, session_id: str):
+        """本进程中该会话尚未落库的变更立即写入，该会话有行写入失败时抛出异常"""
+        if session_id in self._pending_sessions or session_id in self._inflight_sessions:
+            if session_id in await self.flush():
+                raise RuntimeError(f"Write-behind rows of session {session_id} failed to write, will retry")
+
+    async def flush(self) -> Set[str]:
+        """写入全部待写的行，返回有行写入失败、留待重试的会话"""
+        async with self._lock:
+            if not self._pending:
+                return set()
+            pending, entries = self._pending, self._entries
+            self._pending, self._entries = {}, []
+            self._inflight_sessions, self._pending_sessions = self._pending_sessions, set()
+            WRITE_BEHIND_PENDING.set(0)
+
+            try:
+                retry = await self._write_rows(pending, entries)
+            except Exception:
+                # 数据库不可用：全部放回队列
+                self._requeue(pending, entries)
+                raise
+            finally:
+                self._inflight_sessions = set()
+
+            if retry:
+                self._requeue({key: pending[key] for key in retry}, [entry for entry in entries if entry[1] & retry])
+            await self._trim([
+                entry_id for entry_id, keys in entries
+                if not keys & retry and entry_id not in self._dead_entries
+            ])
+            return {pending[key]["session_id"] for key in retry}
+
+    async def recover(self):
+        """接管已退出进程留在日志中的写入"""
+        alive: Dict[str, bool] = {self.node_id: True}
+        last_id = "-"
+        while True:
+            entries = await self.redis.xrange(JOURNAL_KEY, min=last_id, count=500)
+            if last_id != "-":
+                entries = [entry for entry in entries if entry[0] != last_id]
+            if not entries:
+                return
+            last_id = entries[-1][0]
+            dead = await self.redis.hmget(DEAD_LETTER_KEY, [entry_id for entry_id, _ in entries])
+
+            orphaned: List[Tuple[str, Set[RowKey]]] = []
+            merged: Dict[RowKey, Dict] = {}
+            for (entry_id, fields), dead_letter in zip(entries, dead):
+                node = fields.get("node", "")
+                if node not in alive:
+                    alive[node] = bool(await self.redis.exists(self.node_key(node)))
+                if alive[node] or dead_letter is not None:
+                    continue
+                keys = set()
+                for row in json.loads(fields["rows"]):
+                    row = {**row, "values": _decode(row["table"], row["values"])}
+                    key = (row["table"], row["values"]["id"])
+                    previous = merged.get(key)
+                    merged[key] = {**row, "values": {**previous["values"], **row["values"]}} if previous else row
+                    keys.add(key)
+                orphaned.append((entry_id, keys))
+
+            retry: Set[RowKey] = set()
+            if merged:
+                retry = await self._write_rows(merged, orphaned)
+                logger.info(f"Recovered {len(merged) - len(retry)} write-behind rows from {len(orphaned)} journal entries")
+            # 仍需重试的条目留在日志中，下次接管时再写
+            await self._trim([
+                entry_id for entry_id, keys in orphaned
+                if not keys & retry and entry_id not in self._dead_entries
+            ])
+
+    async def _write_rows(self, rows: Dict[RowKey, Dict], entries: List[Tuple[str, Set[RowKey]]]) -> Set[RowKey]:
+        """写入合并后的行，返回未写入、需要重试的行
+
+        批量写入失败时逐行重写，其余行照常落库；同一行失败 WRITE_BEHIND_MAX_ATTEMPTS 次后转入死信。
+        数据库不可用时直接抛出，由调用方保留全部行重试。
+        """
+        try:
+            await self._write(list(rows.values()))
+            for key in rows:
+                self._attempts.pop(key, None)
+            return set()
+        except Exception as e:
+            if _unavailable(e):
+                raise
+            logger.warning(f"Write-behind batch of {len(rows)} rows failed, retrying row by row: {e}")
+
+        failed: Dict[RowKey, Exception] = {}
+        # 按外键依赖顺序逐行写入
+        for key, row in sorted(rows.items(), key=lambda item: TABLE_ORDER[item[0][0]]):
+            try:
+                await self._write([row])
+                self._attempts.pop(key, None)
+            except Exception as e:
+                if _unavailable(e):
+                    raise
+                failed[key] = e
+
+        retry = set()
+        for key, error in failed.items():
+            attempts = self._attempts.get(key, 0) + 1
+            if attempts < WRITE_BEHIND_MAX_ATTEMPTS:
+                self._attempts[key] = attempts
+                retry.add(key)
+                continue
+            self._attempts.pop(key, None)
+            await self._dead_letter(rows[key], error, [entry_id for entry_id, keys in entries if key in keys])
+        return retry
+
+    async def _dead_letter(self, row: Dict, error: Exception, entry_ids: List[str]):
+        """记录失败的行，其所在的日志条目保留在日志中，不再重试"""
+        logger.error(
+            f"Write-behind row {row['table']}:{row['values']['id']} failed {WRITE_BEHIND_MAX_ATTEMPTS} times, "
+            f"dead-lettered with journal entries {entry_ids}: {error}; row: "
+            f"{json.dumps(row, default=_encode, ensure_ascii=False)}"
+        )
+        record = json.dumps({
+            "node": self.node_id,
+            "table": row["table"],
+            "id": row["values"]["id"],
+            "error": str(error)[:1000],
+            "failed_at": datetime.utcnow().isoformat()
+        }, ensure_ascii=False)
+        if entry_ids:
+            await self.redis.hset(DEAD_LETTER_KEY, mapping={entry_id: record for entry_id in entry_ids})
+        self._dead_entries.update(entry_ids)
+
+    def _requeue(self, rows: Dict[RowKey, Dict], entries: List[Tuple[str, Set[RowKey]]]):
+        """放回队列，之后的变更覆盖较早的值"""
+        for key, row in rows.items():
+            newer = self._pending.get(key)
+            if newer:
+                row = {**row, "values": {**row["values"], **newer["values"]}}
+            self._pending[key] = row
+            self._pending_sessions.add(row["session_id"])
+        self._entries = entries + self._entries
+        WRITE_BEHIND_PENDING.set(len(self._pending))
+
+    def _merge(self, rows):
+        for row in rows:
+            key = (row["table"], row["values"]["id"])
+            previous = self._pending.get(key)
+            if previous:
+                row = {**row, "values": {**previous["values"], **row["values"]}}
+            self._pending[key] = row
+            self._pending_sessions.add(row["session_id"])
+        WRITE_BEHIND_PENDING.set(len(self._pending))
+
+    async def _trim(self, entry_ids: List[str]):
+        for i in range(0, len(entry_ids), 1000):
+            await self.redis.xdel(JOURNAL_KEY, *entry_ids[i:i + 1000])
+
+    async def _write(self, rows: List[Dict]):
+        """在一个事务中写入：已存在的行批量更新，其余批量插入"""
+        if not rows:
+            return
+        by_table: Dict[str, List[Dict]] = {}
+        for row in rows:
+            by_table.setdefault(row["table"], []).append(row["values"])
+
+        async with AsyncSession(self.engine, expire_on_commit=False) as db:
+            for table_name, model in MODELS.items():
+                values = by_table.get(table_name)
+                if not values:
+                    continue
+
+                ids = [item["id"] for item in values]
+                if model is Message:
+                    result = await db.execute(select(Message.id, Message.is_streaming).where(Message.id.in_(ids)))
+                    existing = dict(result.all())
+                    # 生成中的部分内容不能覆盖已完成的回复（如进程崩溃后迟到的检查点）
+                    values = [
+                        item for item in values
+                        if not (item.get("is_streaming") and existing.get(item["id"]) is False)
+                    ]
+                else:
+                    result = await db.execute(select(model.id).where(model.id.in_(ids)))
+                    existing = {row_id: True for row_id in result.scalars().all()}
+
+                inserts = [item for item in values if item["id"] not in existing]
+                updates = [item for item in values if item["id"] in existing]
+                if inserts:
+                    await db.execute(insert(model), inserts)
+                if updates:
+                    await db.execute(update(model), updates)
+
+            with DB_COMMIT.labels("write_behind").time():
+                await db.commit()
+
+    async def _loop(self):
+        interval = WRITE_BEHIND_FLUSH_MS / 1000
+        last_heartbeat = last_recover = time.monotonic()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                await self.flush()
+
+                now = time.monotonic()
+                if now - last_heartbeat >= WRITE_BEHIND_NODE_TTL / 3:
+                    await self.redis.set(self.node_key(self.node_id), "1", ex=WRITE_BEHIND_NODE_TTL)
+                    last_heartbeat = now
+                if now - last_recover >= RECOVER_INTERVAL:
+                    await self.recover()
+                    last_recover = now
+            except Exception as e:
+                logger.error(f"Write-behind flush failed, {len(self._pending)} rows pending: {e}")
+                await asyncio.sleep(interval)
+
+
+write_behind = WriteBehindQueue(redis_client, async_engine)
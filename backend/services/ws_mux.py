@@ -0,0 +1,295 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+from fastapi import HTTPException, WebSocket
+from pydantic import ValidationError
+from sqlmodel.ext.asyncio.session import AsyncSession
+from starlette.websockets import WebSocketDisconnect
+
+from backend.database import async_engine
+from backend.models import MessageCreate
+from .chat_service import ChatService
+from .metrics import SSE_ENCODE, WS_BYTES, WS_CONNECTIONS, WS_CREDIT_STALLS, WS_FRAMES, WS_STREAMS
+from .sse_encoder import SSEEncoder, json_dumps
+
+logger = logging.getLogger(__name__)
+
+# 每个连接最多同时打开的会话流
+WS_MAX_STREAMS = int(os.getenv("WS_MAX_STREAMS", "32"))
+# 每个会话流的初始额度（帧数），客户端以 credit 命令追加
+WS_INITIAL_CREDITS = int(os.getenv("WS_INITIAL_CREDITS", "64"))
+# 服务端发送 ping 的间隔；超过 WS_HEARTBEAT_TIMEOUT 秒未收到客户端任何消息即断开
+WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", "15"))
+WS_HEARTBEAT_TIMEOUT = float(os.getenv("WS_HEARTBEAT_TIMEOUT", "45"))
+# 没有打开的流且超过该秒数未收到命令时关闭连接，0 为不关闭
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "300"))
+
+STREAM_COMMANDS = ("start", "continue", "subscribe")
+
+
+class WebSocketFrameEncoder(SSEEncoder):
+    """把与SSE相同的事件编码为WebSocket文本帧：事件JSON开头加入 session_id 和 id（字符偏移）
+
+    只拼接字节，不重新序列化事件；只读订阅的保活帧为空，由连接级心跳代替。
+    """
+
+    KEEPALIVE = b""
+
+    def __init__(self, session_id: str, dumps=json_dumps):
+        super().__init__(legacy=False, dumps=dumps)
+        self._prefix = b'{"session_id":' + dumps(session_id) + b',"id":'
+
+    def _frame(self, payload: bytes, offset: int) -> bytes:
+        return b"".join((self._prefix, str(offset).encode(), b",", payload[1:]))
+
+    @staticmethod
+    def _observe(event_type: str, frame: bytes, started: float):
+        SSE_ENCODE.observe(time.perf_counter() - started)
+        WS_FRAMES.labels(event_type).inc()
+        WS_BYTES.labels(event_type).inc(len(frame))
+
+
+class MuxStream:
+    """连接上的一个会话流：按客户端授予的额度从 ChatService 的帧生成器中取帧发送
+
+    额度用尽时暂停读取生成日志，生成任务不受影响，内容留在日志中，追加额度后继续（期间的增量会合并成较大的帧）。
+    """
+
+    def __init__(self, mux: "StreamMultiplexer", session_id: str, credits: int):
+        self.mux = mux
+        self.session_id = session_id
+        self.credits = credits
+        self._granted = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def grant(self, credits: int):
+        self.credits += credits
+        if self.credits > 0:
+            self._granted.set()
+
+    async def run(self, opener: Callable[[], Awaitable]):
+        # 发起生成包含多步写入，不随流一起取消；取消时由 _discard 关闭已打开的生成器
+        opening = asyncio.ensure_future(opener())
+        try:
+            frames = await asyncio.shield(opening)
+        except asyncio.CancelledError:
+            opening.add_done_callback(self._discard)
+            raise
+        except HTTPException as e:
+            await self.mux.reject(self.session_id, e.status_code, e.detail, e.headers)
+            return
+        except Exception as e:
+            logger.exception(f"Failed to open stream for session {self.session_id}")
+            await self.mux.reject(self.session_id, 500, str(e))
+            return
+
+        try:
+            async for frame in frames:
+                if not frame:
+                    continue
+                if self.credits <= 0:
+                    WS_CREDIT_STALLS.inc()
+                    self._granted.clear()
+                    await self._granted.wait()
+                self.credits -= 1
+                await self.mux.send(frame)
+            await self.mux.send_json({"type": "end", "session_id": self.session_id})
+        finally:
+            await frames.aclose()
+
+    @staticmethod
+    def _discard(opening: asyncio.Future):
+        if opening.cancelled() or opening.exception() is not None:
+            return
+        task = asyncio.ensure_future(opening.result().aclose())
+        task.add_done_callback(lambda _: None)
+
+
+class StreamMultiplexer:
+    """一个WebSocket连接上的多路会话流
+
+    客户端发送JSON命令（op：start / continue / subscribe / cancel / credit / ping / pong），
+    各会话的事件与对应SSE接口相同，额外带 session_id 和 id。每个会话同时只有一个流。
+    """
+
+    def __init__(self, websocket: WebSocket, redis_client):
+        self.websocket = websocket
+        self.redis = redis_client
+        self.streams: Dict[str, MuxStream] = {}
+        self._send_lock = asyncio.Lock()
+        self._last_received = time.monotonic()
+        self._last_command = time.monotonic()
+
+    async def run(self):
+        await self.websocket.accept()
+        WS_CONNECTIONS.inc()
+        receiver = asyncio.create_task(self._receive())
+        heartbeat = asyncio.create_task(self._heartbeat())
+        try:
+            await asyncio.wait((receiver, heartbeat), return_when=asyncio.FIRST_COMPLETED)
+            if heartbeat.done() and not heartbeat.cancelled() and heartbeat.exception() is None:
+                code, reason = heartbeat.result()
+                try:
+                    await self.websocket.close(code, reason)
+                except RuntimeError:
+                    pass
+        finally:
+            receiver.cancel()
+            heartbeat.cancel()
+            # 先取消全部流，关闭连接的任务自身被取消时也不会留下仍在运行的流
+            for stream in list(self.streams.values()):
+                if stream.task is not None:
+                    stream.task.cancel()
+            try:
+                for session_id in list(self.streams):
+                    await self._close_stream(session_id)
+            finally:
+                WS_CONNECTIONS.dec()
+
+    async def _receive(self):
+        while True:
+            message = await self.websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            self._last_received = time.monotonic()
+            raw = message.get("text")
+            if raw is None and message.get("bytes") is not None:
+                raw = message["bytes"].decode("utf-8", "replace")
+            try:
+                await self._handle(raw)
+            except (WebSocketDisconnect, RuntimeError):
+                # 连接已关闭，发送失败
+                return
+
+    async def _heartbeat(self):
+        """返回关闭连接的 (code, reason)"""
+        while True:
+            await asyncio.sleep(WS_HEARTBEAT_INTERVAL)
+            now = time.monotonic()
+            if now - self._last_received > WS_HEARTBEAT_TIMEOUT:
+                return 1001, "heartbeat timeout"
+            if WS_IDLE_TIMEOUT > 0 and not self.streams and now - self._last_command > WS_IDLE_TIMEOUT:
+                return 1000, "idle timeout"
+            await self.send_json({"type": "ping"})
+
+    async def _handle(self, raw: Optional[str]):
+        try:
+            command = json.loads(raw)
+            op = command["op"]
+        except (TypeError, ValueError, KeyError):
+            return await self.reject(None, 400, "Invalid command")
+
+        if op == "ping":
+            return await self.send_json({"type": "pong"})
+        if op == "pong":
+            return
+
+        if op not in STREAM_COMMANDS and op not in ("credit", "cancel"):
+            return await self.reject(command.get("session_id"), 400, f"Unknown op: {op}")
+
+        self._last_command = time.monotonic()
+        session_id = command.get("session_id")
+        if not isinstance(session_id, str) or not session_id:
+            return await self.reject(None, 400, "session_id is required")
+
+        if op == "credit":
+            stream = self.streams.get(session_id)
+            try:
+                credits = int(command.get("credits") or 0)
+            except (TypeError, ValueError):
+                return await self.reject(session_id, 422, "credits must be an integer")
+            if stream:
+                stream.grant(credits)
+            return
+        if op == "cancel":
+            # 等同于关闭该会话的SSE连接：cancel 断开模式下最后一个读者离开后停止生成
+            await self._close_stream(session_id)
+            return await self.send_json({"type": "cancelled", "session_id": session_id})
+
+        if session_id in self.streams:
+            return await self.reject(session_id, 409, "Stream already open for this session")
+        if len(self.streams) >= WS_MAX_STREAMS:
+            return await self.reject(session_id, 429, f"At most {WS_MAX_STREAMS} streams per connection")
+        try:
+            opener = self._opener(op, session_id, command)
+            credits = int(command.get("credits") or WS_INITIAL_CREDITS)
+        except (ValidationError, TypeError, ValueError) as e:
+            return await self.reject(session_id, 422, str(e))
+
+        stream = MuxStream(self, session_id, credits)
+        self.streams[session_id] = stream
+        WS_STREAMS.inc()
+        stream.task = asyncio.create_task(stream.run(opener))
+        stream.task.add_done_callback(lambda task: self._stream_finished(stream, task))
+
+    def _opener(self, op: str, session_id: str, command: Dict) -> Callable[[], Awaitable]:
+        """按命令构造发起流的协程，参数与对应的SSE接口一致"""
+        if op == "start":
+            message = MessageCreate.model_validate(command)
+            idempotency_key = command.get("idempotency_key")
+        last_event_id = command.get("last_event_id")
+        if last_event_id is not None:
+            last_event_id = int(last_event_id)
+
+        async def open_stream():
+            # 每个流使用独立的数据库会话，发起后即归还连接
+            chat_service = ChatService(
+                AsyncSession(async_engine, expire_on_commit=False),
+                self.redis,
+                encoder=WebSocketFrameEncoder(session_id)
+            )
+            try:
+                if op == "start":
+                    return await chat_service.open_completion(session_id, message, idempotency_key)
+                if op == "continue":
+                    return await chat_service.open_continue(session_id, last_event_id)
+                return await chat_service.open_watch(session_id)
+            finally:
+                await chat_service.db.close()
+
+        return open_stream
+
+    def _stream_finished(self, stream: MuxStream, task: asyncio.Task):
+        if self.streams.get(stream.session_id) is stream:
+            del self.streams[stream.session_id]
+            WS_STREAMS.dec()
+            self._last_command = time.monotonic()
+        if not task.cancelled() and task.exception() is not None:
+            exception = task.exception()
+            if not isinstance(exception, (WebSocketDisconnect, RuntimeError)):
+                logger.error(f"Stream for session {stream.session_id} failed: {exception!r}")
+
+    async def _close_stream(self, session_id: str):
+        stream = self.streams.get(session_id)
+        if stream is None or stream.task is None:
+            return
+        stream.task.cancel()
+        try:
+            await stream.task
+        except asyncio.CancelledError:
+            # 流任务按预期被取消；当前任务自身被取消（此时流任务尚未结束）则继续传播
+            current = asyncio.current_task()
+            if not stream.task.done() or getattr(current, "cancelling", lambda: 0)():
+                raise
+        except Exception:
+            # 流的异常已由 _stream_finished 记录
+            pass
+
+    async def reject(self, session_id: Optional[str], status: int, error: str, headers: Optional[Dict] = None):
+        data = {"type": "command_error", "session_id": session_id, "status": status, "error": error}
+        retry_after = (headers or {}).get("Retry-After")
+        if retry_after is not None:
+            data["retry_after"] = int(retry_after)
+        await self.send_json(data)
+
+    async def send_json(self, data: Dict):
+        await self.send(json_dumps(data))
+
+    async def send(self, frame: bytes):
+        # 各会话流共用一个连接，逐帧发送；连接写满时所有流一起等待
+        async with self._send_lock:
+            await self.websocket.send_text(frame.decode("utf-8"))
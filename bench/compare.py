@@ -0,0 +1,65 @@
+"""比较两次压测结果
+
+    python -m bench.compare bench/results/before.json bench/results/after.json
+"""
+import argparse
+import json
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple
+
+# 数值越大越好的指标
+HIGHER_IS_BETTER = ("streams_per_second", "messages_completed")
+# 数值越小越好的指标，其余指标只显示变化不做评价
+LOWER_IS_BETTER = ("_ms.", "_per_token", "bytes_per_message")
+
+
+def flatten(results: Dict, prefix: str = "") -> Iterator[Tuple[str, float]]:
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from flatten(value, f"{name}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
+
+
+def change(before: float, after: float) -> Optional[float]:
+    if before == 0:
+        return None
+    return (after - before) / abs(before) * 100
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args()
+
+    before = json.loads(Path(args.before).read_text())
+    after = json.loads(Path(args.after).read_text())
+
+    def title(report: Dict) -> str:
+        meta = report["meta"]
+        return " ".join(part for part in [meta.get("commit", ""), meta.get("label", "")] if part) or "?"
+
+    before_metrics = dict(flatten(before["results"]))
+    after_metrics = dict(flatten(after["results"]))
+
+    width = max([len(name) for name in before_metrics] + [6])
+    print(f"{'metric':<{width}}  {title(before):>14}  {title(after):>14}  {'change':>9}")
+    for name, old in before_metrics.items():
+        if name not in after_metrics or name.endswith(".count"):
+            continue
+        new = after_metrics[name]
+        delta = change(old, new)
+        marker = ""
+        if delta is not None and abs(delta) >= 5:
+            if name.endswith(HIGHER_IS_BETTER):
+                marker = " +" if delta > 0 else " -"
+            elif any(part in name for part in LOWER_IS_BETTER):
+                marker = " +" if delta < 0 else " -"
+        delta_text = f"{delta:+.1f}%" if delta is not None else "n/a"
+        print(f"{name:<{width}}  {old:>14g}  {new:>14g}  {delta_text:>9}{marker}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""OpenAI 兼容的本地流式服务替身，用于压测时代替真实模型
+
+    python -m bench.fake_openai --port 9100 --tokens 200 --token-rate 50 --ttft-ms 300
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+WORDS = ["流式", "输出", "的", "内容", "token", "，", "测试", "回复", "。", "chat"]
+
+
+@dataclass
+class FakeConfig:
+    tokens: int = 200
+    token_rate: float = 50.0
+    ttft_ms: float = 300.0
+    jitter_ms: float = 5.0
+    error_429: float = 0.0
+    error_5xx: float = 0.0
+    rpm: int = 100000
+    tpm: int = 100000000
+
+
+config = FakeConfig()
+stats = {"requests": 0, "streams": 0, "tokens": 0, "errors_429": 0, "errors_5xx": 0}
+
+app = FastAPI(title="Fake OpenAI")
+
+
+def _jitter() -> float:
+    return random.uniform(-config.jitter_ms, config.jitter_ms) / 1000
+
+
+def _rate_limit_headers() -> dict:
+    return {
+        "x-ratelimit-limit-requests": str(config.rpm),
+        "x-ratelimit-limit-tokens": str(config.tpm),
+        "x-ratelimit-remaining-requests": str(config.rpm - 1),
+        "x-ratelimit-remaining-tokens": str(config.tpm - config.tokens),
+    }
+
+
+def _chunk(completion_id: str, model: str, content=None, finish_reason=None) -> str:
+    payload = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "delta": {"content": content} if content is not None else {},
+            "finish_reason": finish_reason
+        }]
+    }
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+async def _stream(completion_id: str, model: str, tokens: int):
+    await asyncio.sleep(max(config.ttft_ms / 1000 + _jitter(), 0))
+    interval = 1 / config.token_rate if config.token_rate > 0 else 0
+    for i in range(tokens):
+        if i and interval:
+            await asyncio.sleep(max(interval + _jitter(), 0))
+        stats["tokens"] += 1
+        yield _chunk(completion_id, model, WORDS[i % len(WORDS)])
+    yield _chunk(completion_id, model, finish_reason="stop")
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+
+    roll = random.random()
+    if roll < config.error_429:
+        stats["errors_429"] += 1
+        return JSONResponse(
+            status_code=429,
+            headers={"retry-after-ms": "200", **_rate_limit_headers()},
+            content={"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}
+        )
+    if roll < config.error_429 + config.error_5xx:
+        stats["errors_5xx"] += 1
+        return JSONResponse(
+            status_code=503,
+            content={"error": {"message": "Service unavailable", "type": "server_error", "code": None}}
+        )
+
+    model = body.get("model", "fake")
+    tokens = min(config.tokens, body.get("max_tokens") or config.tokens)
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+    if body.get("stream"):
+        stats["streams"] += 1
+        return StreamingResponse(
+            _stream(completion_id, model, tokens),
+            media_type="text/event-stream",
+            headers=_rate_limit_headers()
+        )
+
+    stats["tokens"] += tokens
+    content = "".join(WORDS[i % len(WORDS)] for i in range(tokens))
+    return JSONResponse(headers=_rate_limit_headers(), content={
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 0, "completion_tokens": tokens, "total_tokens": tokens}
+    })
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--tokens", type=int, default=config.tokens, help="每条回复的token数")
+    parser.add_argument("--token-rate", type=float, default=config.token_rate, help="每秒输出的token数，0为不限速")
+    parser.add_argument("--ttft-ms", type=float, default=config.ttft_ms, help="首个token前的延迟")
+    parser.add_argument("--jitter-ms", type=float, default=config.jitter_ms, help="每个token间隔的随机抖动")
+    parser.add_argument("--error-429", type=float, default=config.error_429, help="返回429的比例")
+    parser.add_argument("--error-5xx", type=float, default=config.error_5xx, help="返回503的比例")
+    args = parser.parse_args()
+
+    config.tokens = args.tokens
+    config.token_rate = args.token_rate
+    config.ttft_ms = args.ttft_ms
+    config.jitter_ms = args.jitter_ms
+    config.error_429 = args.error_429
+    config.error_5xx = args.error_5xx
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""压测负载：并发打开 /completions 流，部分流中途断开后用 /completions-continue 续传"""
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+
+@dataclass
+class StreamSample:
+    kind: str  # completion / continue
+    status: int = 0
+    outcome: str = ""  # done / error / disconnected / http_<status> / exception
+    message_id: Optional[str] = None
+    ttfb: Optional[float] = None  # 发出请求到收到首个字节
+    ttft: Optional[float] = None  # 发出请求到收到首个内容帧
+    gaps: List[float] = field(default_factory=list)  # 相邻内容帧的间隔
+    bytes: int = 0
+    content_frames: int = 0
+    duration: float = 0.0
+
+
+def parse_frame(frame: bytes) -> Tuple[Optional[str], Optional[Dict]]:
+    event_id, payload = None, ""
+    for line in frame.decode("utf-8").split("\n"):
+        if line.startswith("id: "):
+            event_id = line[4:]
+        elif line.startswith("data: "):
+            payload += line[6:]
+    return event_id, json.loads(payload) if payload else None
+
+
+async def read_stream(
+        response: httpx.Response,
+        started: float,
+        sample: StreamSample,
+        disconnect_after: Optional[int] = None
+) -> Optional[str]:
+    """读取SSE流并记录时延，读到 disconnect_after 个内容帧后主动断开；返回最后的事件ID"""
+    buffer = b""
+    last_event_id = None
+    last_content_at = None
+
+    async for raw in response.aiter_raw():
+        now = time.perf_counter()
+        if sample.ttfb is None:
+            sample.ttfb = now - started
+        sample.bytes += len(raw)
+        buffer += raw
+
+        while b"\n\n" in buffer:
+            frame, buffer = buffer.split(b"\n\n", 1)
+            event_id, data = parse_frame(frame)
+            if data is None:
+                continue
+            last_event_id = event_id or last_event_id
+            sample.message_id = data.get("message_id", sample.message_id)
+
+            has_content = data["type"] == "content" or (data["type"] == "resume" and data.get("existing_content"))
+            if has_content:
+                sample.content_frames += 1
+                if last_content_at is None:
+                    sample.ttft = now - started
+                else:
+                    sample.gaps.append(now - last_content_at)
+                last_content_at = now
+
+            if data["type"] in ("done", "error"):
+                sample.outcome = data["type"]
+                return last_event_id
+            if disconnect_after is not None and sample.content_frames >= disconnect_after:
+                sample.outcome = "disconnected"
+                return last_event_id
+
+    sample.outcome = sample.outcome or "eof"
+    return last_event_id
+
+
+async def _request_stream(
+        client: httpx.AsyncClient,
+        url: str,
+        sample: StreamSample,
+        disconnect_after: Optional[int] = None,
+        **kwargs
+) -> Optional[str]:
+    started = time.perf_counter()
+    last_event_id = None
+    try:
+        async with client.stream("POST", url, **kwargs) as response:
+            sample.status = response.status_code
+            if response.status_code != 200:
+                await response.aread()
+                sample.outcome = f"http_{response.status_code}"
+            else:
+                last_event_id = await read_stream(response, started, sample, disconnect_after)
+    except httpx.HTTPError as e:
+        sample.outcome = f"exception:{type(e).__name__}"
+    sample.duration = time.perf_counter() - started
+    return last_event_id
+
+
+async def run_conversation(
+        client: httpx.AsyncClient,
+        prompt: str,
+        resume: bool,
+        disconnect_after: int,
+        resume_delay: float
+) -> List[StreamSample]:
+    """一次对话：新建会话并请求回复；resume 为真时中途断开后续传"""
+    response = await client.post("/api/sessions/", json={"title": "bench"})
+    session_id = response.json()["id"]
+
+    first = StreamSample(kind="completion")
+    last_event_id = await _request_stream(
+        client, f"/api/chat/{session_id}/completions", first,
+        disconnect_after=disconnect_after if resume else None,
+        json={"content": prompt}
+    )
+    samples = [first]
+
+    if resume and first.outcome == "disconnected":
+        await asyncio.sleep(resume_delay)
+        second = StreamSample(kind="continue", message_id=first.message_id)
+        headers = {"Last-Event-ID": last_event_id} if last_event_id else {}
+        await _request_stream(client, f"/api/chat/{session_id}/completions-continue", second, headers=headers)
+        samples.append(second)
+    return samples
+
+
+async def run_load(
+        base_url: str,
+        conversations: int,
+        concurrency: int,
+        continue_ratio: float = 0.0,
+        disconnect_after: int = 5,
+        resume_delay: float = 0.2,
+        prompt: str = "请介绍一下流式输出"
+) -> Tuple[List[StreamSample], float]:
+    """以 concurrency 的并发跑完 conversations 次对话，返回 (样本, 总耗时)"""
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency * 2, max_keepalive_connections=concurrency * 2)
+    timeout = httpx.Timeout(300, connect=10)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout) as client:
+        async def one(index: int) -> List[StreamSample]:
+            async with semaphore:
+                resume = random.random() < continue_ratio
+                # 每次对话的提示不同，避免命中回复缓存
+                return await run_conversation(client, f"{prompt} #{index}", resume, disconnect_after, resume_delay)
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*[one(i) for i in range(conversations)])
+        wall = time.perf_counter() - started
+
+    return [sample for samples in results for sample in samples], wall
+
+
+def percentiles(values: List[float], scale: float = 1000.0) -> Optional[Dict[str, float]]:
+    """最近秩百分位，默认换算为毫秒"""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def pick(p: float) -> float:
+        index = min(max(int(round(p / 100 * len(ordered) + 0.5)) - 1, 0), len(ordered) - 1)
+        return round(ordered[index] * scale, 3)
+
+    return {
+        "p50": pick(50),
+        "p90": pick(90),
+        "p99": pick(99),
+        "max": round(ordered[-1] * scale, 3),
+        "mean": round(sum(ordered) / len(ordered) * scale, 3),
+        "count": len(ordered)
+    }
+
+
+def summarize(samples: List[StreamSample], wall: float) -> Dict:
+    completed_messages = {s.message_id for s in samples if s.outcome == "done" and s.message_id}
+    outcomes: Dict[str, int] = {}
+    for sample in samples:
+        outcomes[sample.outcome] = outcomes.get(sample.outcome, 0) + 1
+
+    bytes_by_message: Dict[str, int] = {}
+    for sample in samples:
+        if sample.message_id:
+            bytes_by_message[sample.message_id] = bytes_by_message.get(sample.message_id, 0) + sample.bytes
+
+    by_kind = {}
+    for kind in ("completion", "continue"):
+        kind_samples = [s for s in samples if s.kind == kind]
+        if not kind_samples:
+            continue
+        by_kind[kind] = {
+            "streams": len(kind_samples),
+            "ttfb_ms": percentiles([s.ttfb for s in kind_samples if s.ttfb is not None]),
+            "ttft_ms": percentiles([s.ttft for s in kind_samples if s.ttft is not None]),
+        }
+
+    return {
+        "wall_seconds": round(wall, 3),
+        "streams": len(samples),
+        "messages_completed": len(completed_messages),
+        "outcomes": outcomes,
+        "streams_per_second": round(len(completed_messages) / wall, 3) if wall else None,
+        "ttfb_ms": percentiles([s.ttfb for s in samples if s.ttfb is not None]),
+        "ttft_ms": percentiles([s.ttft for s in samples if s.ttft is not None]),
+        "inter_chunk_ms": percentiles([gap for s in samples for gap in s.gaps]),
+        "bytes_per_message": (
+            round(sum(bytes_by_message.values()) / len(bytes_by_message), 1) if bytes_by_message else None
+        ),
+        "by_kind": by_kind
+    }
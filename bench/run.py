@@ -0,0 +1,206 @@
+"""启动本地模型替身和应用，运行负载并把结果写成JSON，便于在不同提交之间比较
+
+    python -m bench.run --conversations 200 --concurrency 50 --continue-ratio 0.2
+    python -m bench.run --env STREAM_DISCONNECT_MODE=cancel --label cancel-mode
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+from .load import run_load, summarize
+
+ROOT = Path(__file__).resolve().parent.parent
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+
+def git_revision() -> Dict:
+    def git(*args) -> str:
+        try:
+            return subprocess.check_output(["git", *args], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return ""
+
+    return {"commit": git("rev-parse", "--short", "HEAD"), "dirty": bool(git("status", "--porcelain", "--", "backend"))}
+
+
+def start_process(module: str, args: List[str], env: Dict[str, str]) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, "-m", module, *args], cwd=ROOT, env=env)
+
+
+def stop_process(process: subprocess.Popen, timeout: float = 10):
+    """先正常终止，超时未退出则强制结束，不让收尾的异常覆盖压测结果"""
+    process.terminate()
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+async def wait_ready(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{url} not ready after {timeout}s")
+            await asyncio.sleep(0.2)
+
+
+async def fetch_json(url: str) -> Optional[Dict]:
+    try:
+        async with httpx.AsyncClient() as client:
+            response = await client.get(url)
+            return response.json() if response.status_code == 200 else None
+    except httpx.HTTPError:
+        return None
+
+
+async def benchmark(args, app_url: str, fake_url: Optional[str]) -> Dict:
+    counters_url = f"{app_url}/__bench__/counters"
+    counters_before = await fetch_json(counters_url)
+    upstream_before = await fetch_json(f"{fake_url}/stats") if fake_url else None
+
+    samples, wall = await run_load(
+        app_url,
+        conversations=args.conversations,
+        concurrency=args.concurrency,
+        continue_ratio=args.continue_ratio,
+        disconnect_after=args.disconnect_after,
+        resume_delay=args.resume_delay
+    )
+    # 等待断开后仍在后台运行的生成任务完成写入
+    await asyncio.sleep(args.settle)
+
+    results = summarize(samples, wall)
+    counters_after = await fetch_json(counters_url)
+    upstream_after = await fetch_json(f"{fake_url}/stats") if fake_url else None
+
+    if upstream_before and upstream_after:
+        tokens = upstream_after["tokens"] - upstream_before["tokens"]
+        results["upstream"] = {
+            key: upstream_after[key] - upstream_before[key] for key in upstream_after
+        }
+        if counters_before and counters_after and tokens:
+            redis_ops = counters_after["redis_commands"] - counters_before["redis_commands"]
+            db_ops = counters_after["db_statements"] - counters_before["db_statements"]
+            results["redis_ops"] = redis_ops
+            results["db_ops"] = db_ops
+            results["redis_ops_per_token"] = round(redis_ops / tokens, 4)
+            results["db_ops_per_token"] = round(db_ops / tokens, 4)
+    return results
+
+
+def parse_env(pairs: List[str]) -> Dict[str, str]:
+    env = {}
+    for pair in pairs:
+        key, _, value = pair.partition("=")
+        env[key] = value
+    return env
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=100, help="对话总数")
+    parser.add_argument("--concurrency", type=int, default=20, help="同时进行的对话数")
+    parser.add_argument("--continue-ratio", type=float, default=0.0, help="中途断开并续传的对话比例")
+    parser.add_argument("--disconnect-after", type=int, default=5, help="续传对话在收到多少个内容帧后断开")
+    parser.add_argument("--resume-delay", type=float, default=0.2, help="断开后多久发起续传（秒）")
+    parser.add_argument("--settle", type=float, default=1.0, help="负载结束后等待后台任务收尾的秒数")
+    parser.add_argument("--tokens", type=int, default=200, help="模型替身每条回复的token数")
+    parser.add_argument("--token-rate", type=float, default=50, help="模型替身每秒输出的token数")
+    parser.add_argument("--ttft-ms", type=float, default=300)
+    parser.add_argument("--jitter-ms", type=float, default=5)
+    parser.add_argument("--error-429", type=float, default=0.0)
+    parser.add_argument("--error-5xx", type=float, default=0.0)
+    parser.add_argument("--redis-url", default="fakeredis://", help="默认使用进程内替身，可指向真实Redis")
+    parser.add_argument("--database-url", default=None, help="默认使用临时SQLite文件")
+    parser.add_argument("--app-url", default=None, help="压测已运行的应用，不启动本地应用和模型替身")
+    parser.add_argument("--app-port", type=int, default=9000)
+    parser.add_argument("--fake-port", type=int, default=9100)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="传给应用的额外环境变量")
+    parser.add_argument("--label", default="", help="写入结果的标签")
+    parser.add_argument("--output", default=None, help="结果文件路径，默认写入 bench/results/")
+    args = parser.parse_args()
+
+    processes = []
+    fake_url = None
+    try:
+        if args.app_url:
+            app_url = args.app_url.rstrip("/")
+        else:
+            fake_url = f"http://127.0.0.1:{args.fake_port}"
+            app_url = f"http://127.0.0.1:{args.app_port}"
+            workdir = tempfile.mkdtemp(prefix="streamchat-bench-")
+
+            processes.append(start_process("bench.fake_openai", [
+                "--port", str(args.fake_port),
+                "--tokens", str(args.tokens),
+                "--token-rate", str(args.token_rate),
+                "--ttft-ms", str(args.ttft_ms),
+                "--jitter-ms", str(args.jitter_ms),
+                "--error-429", str(args.error_429),
+                "--error-5xx", str(args.error_5xx),
+            ], dict(os.environ)))
+
+            env = dict(os.environ)
+            env.update({
+                "OPENAI_API_KEY": "bench",
+                "OPENAI_API_BASE_URL": f"{fake_url}/v1",
+                "OPENAI_MAX_TOKENS": str(args.tokens),
+                "DATABASE_URL": args.database_url or f"sqlite:///{workdir}/bench.db",
+                "REDIS_URL": args.redis_url,
+            })
+            env.update(parse_env(args.env))
+            processes.append(start_process("bench.serve_app", ["--port", str(args.app_port)], env))
+
+            asyncio.run(wait_ready(f"{fake_url}/stats"))
+            asyncio.run(wait_ready(f"{app_url}/__bench__/counters"))
+
+        results = asyncio.run(benchmark(args, app_url, fake_url))
+    finally:
+        for process in processes:
+            stop_process(process)
+
+    revision = git_revision()
+    report = {
+        "meta": {
+            **revision,
+            "label": args.label,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+        },
+        "config": vars(args),
+        "results": results,
+    }
+
+    if args.output:
+        output = Path(args.output)
+    else:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        name = datetime.now().strftime("%Y%m%d-%H%M%S")
+        suffix = "-".join(part for part in [revision["commit"], args.label] if part)
+        output = RESULTS_DIR / f"{name}{'-' + suffix if suffix else ''}.json"
+    output.write_text(json.dumps(report, ensure_ascii=False, indent=2))
+
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
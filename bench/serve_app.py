@@ -0,0 +1,61 @@
+"""以压测模式启动应用：统计Redis命令数和SQL语句数，通过 /__bench__/counters 暴露
+
+    REDIS_URL=fakeredis:// DATABASE_URL=sqlite:///bench.db python -m bench.serve_app --port 9000
+"""
+import argparse
+
+from redis.asyncio.client import Pipeline, Redis
+from sqlalchemy import event
+
+counters = {"redis_commands": 0, "db_statements": 0}
+
+
+def install_counters():
+    original_execute_command = Redis.execute_command
+    original_pipeline_execute = Pipeline.execute
+
+    async def execute_command(self, *args, **options):
+        counters["redis_commands"] += 1
+        return await original_execute_command(self, *args, **options)
+
+    async def pipeline_execute(self, raise_on_error: bool = True):
+        counters["redis_commands"] += len(self.command_stack)
+        return await original_pipeline_execute(self, raise_on_error)
+
+    Redis.execute_command = execute_command
+    Pipeline.execute = pipeline_execute
+
+
+def create_app():
+    install_counters()
+
+    from backend.database import async_engine
+    from backend.main import app
+
+    # SQL日志会严重拖慢压测
+    async_engine.echo = False
+
+    @event.listens_for(async_engine.sync_engine, "before_cursor_execute")
+    def count_statement(*args):
+        counters["db_statements"] += 1
+
+    @app.get("/__bench__/counters")
+    async def get_counters():
+        return counters
+
+    return app
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    args = parser.parse_args()
+
+    uvicorn.run(create_app(), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
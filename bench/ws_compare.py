@@ -0,0 +1,261 @@
+"""比较 SSE 与 WebSocket 多路复用：同时打开大量流时的连接数和每个活动流的内存
+
+    python -m bench.ws_compare --streams 200 --streams-per-socket 50
+
+每种传输各启动一个新的应用进程（内存不会在两轮之间残留），先建好会话并记录应用的 RSS，
+再同时打开全部流直到结束，期间采样应用进程的 RSS 峰值和套接字数。需要 Linux（读取 /proc）和 websockets。
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+from .load import StreamSample, _request_stream, percentiles
+from .run import RESULTS_DIR, git_revision, start_process, stop_process, wait_ready
+
+
+def process_stats(pid: int) -> Dict[str, int]:
+    """进程的常驻内存（字节）和打开的套接字数"""
+    rss = 0
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1]) * 1024
+    sockets = 0
+    for fd in os.listdir(f"/proc/{pid}/fd"):
+        try:
+            if os.readlink(f"/proc/{pid}/fd/{fd}").startswith("socket:"):
+                sockets += 1
+        except OSError:
+            pass
+    return {"rss": rss, "sockets": sockets}
+
+
+class Sampler:
+    """负载期间周期性采样应用进程，记录峰值"""
+
+    def __init__(self, pid: int, interval: float = 0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = {"rss": 0, "sockets": 0}
+        self._task: Optional[asyncio.Task] = None
+
+    async def _loop(self):
+        while True:
+            stats = process_stats(self.pid)
+            for key, value in stats.items():
+                self.peak[key] = max(self.peak[key], value)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+async def create_sessions(client: httpx.AsyncClient, count: int) -> List[str]:
+    responses = await asyncio.gather(*[client.post("/api/sessions/", json={"title": "bench"}) for _ in range(count)])
+    return [response.json()["id"] for response in responses]
+
+
+async def run_sse(app_url: str, session_ids: List[str], prompt: str) -> List[StreamSample]:
+    """每个流一个HTTP连接"""
+    limits = httpx.Limits(max_connections=len(session_ids), max_keepalive_connections=len(session_ids))
+    async with httpx.AsyncClient(base_url=app_url, limits=limits, timeout=httpx.Timeout(300, connect=10)) as client:
+        samples = [StreamSample(kind="completion") for _ in session_ids]
+        await asyncio.gather(*[
+            _request_stream(client, f"/api/chat/{session_id}/completions", sample, json={"content": f"{prompt} #{i}"})
+            for i, (session_id, sample) in enumerate(zip(session_ids, samples))
+        ])
+    return samples
+
+
+async def run_ws_socket(ws_url: str, session_ids: List[str], prompt: str, credits: int) -> List[StreamSample]:
+    """一个WebSocket连接上同时打开多个会话流，每收到半数额度的帧就追加额度"""
+    import websockets
+
+    samples = {session_id: StreamSample(kind="completion") for session_id in session_ids}
+    received = {session_id: 0 for session_id in session_ids}
+    last_content_at: Dict[str, float] = {}
+    started = {}
+    async with websockets.connect(ws_url, max_size=None) as ws:
+        for i, session_id in enumerate(session_ids):
+            started[session_id] = time.perf_counter()
+            await ws.send(json.dumps({
+                "op": "start", "session_id": session_id, "content": f"{prompt} #{i}", "credits": credits
+            }))
+
+        pending = set(session_ids)
+        while pending:
+            raw = await ws.recv()
+            now = time.perf_counter()
+            data = json.loads(raw)
+            session_id = data.get("session_id")
+            if data["type"] == "ping":
+                await ws.send('{"op":"pong"}')
+                continue
+            if session_id not in samples:
+                continue
+            sample = samples[session_id]
+            if data["type"] == "command_error":
+                sample.outcome = f"http_{data['status']}"
+                pending.discard(session_id)
+                continue
+            if data["type"] == "end":
+                pending.discard(session_id)
+                sample.duration = now - started[session_id]
+                continue
+
+            if sample.ttfb is None:
+                sample.ttfb = now - started[session_id]
+            sample.status = 200
+            sample.bytes += len(raw.encode("utf-8"))
+            sample.message_id = data.get("message_id", sample.message_id)
+            if data["type"] == "content":
+                sample.content_frames += 1
+                if session_id not in last_content_at:
+                    sample.ttft = now - started[session_id]
+                else:
+                    sample.gaps.append(now - last_content_at[session_id])
+                last_content_at[session_id] = now
+            elif data["type"] in ("done", "error"):
+                sample.outcome = data["type"]
+
+            received[session_id] += 1
+            if received[session_id] % max(credits // 2, 1) == 0:
+                await ws.send(json.dumps({"op": "credit", "session_id": session_id, "credits": max(credits // 2, 1)}))
+    return list(samples.values())
+
+
+async def run_ws(app_url: str, session_ids: List[str], prompt: str, per_socket: int, credits: int) -> List[StreamSample]:
+    ws_url = app_url.replace("http", "ws", 1) + "/api/chat/ws"
+    groups = [session_ids[i:i + per_socket] for i in range(0, len(session_ids), per_socket)]
+    results = await asyncio.gather(*[run_ws_socket(ws_url, group, prompt, credits) for group in groups])
+    return [sample for samples in results for sample in samples]
+
+
+async def measure(args, transport: str, app_url: str, pid: int) -> Dict:
+    async with httpx.AsyncClient(base_url=app_url, timeout=30) as client:
+        session_ids = await create_sessions(client, args.streams)
+    # 建好会话后等待后写队列落库，再取基线
+    await asyncio.sleep(1)
+    baseline = process_stats(pid)
+
+    sampler = Sampler(pid)
+    sampler.start()
+    started = time.perf_counter()
+    if transport == "sse":
+        samples = await run_sse(app_url, session_ids, args.prompt)
+        client_connections = len(session_ids)
+    else:
+        samples = await run_ws(app_url, session_ids, args.prompt, args.streams_per_socket, args.credits)
+        client_connections = math.ceil(len(session_ids) / args.streams_per_socket)
+    wall = time.perf_counter() - started
+    await sampler.stop()
+
+    outcomes: Dict[str, int] = {}
+    for sample in samples:
+        outcomes[sample.outcome] = outcomes.get(sample.outcome, 0) + 1
+    rss_growth = max(sampler.peak["rss"] - baseline["rss"], 0)
+    return {
+        "streams": len(samples),
+        "outcomes": outcomes,
+        "wall_seconds": round(wall, 3),
+        "client_connections": client_connections,
+        "server_sockets_baseline": baseline["sockets"],
+        "server_sockets_peak": sampler.peak["sockets"],
+        "rss_baseline_mb": round(baseline["rss"] / 2 ** 20, 1),
+        "rss_peak_mb": round(sampler.peak["rss"] / 2 ** 20, 1),
+        "rss_per_stream_kb": round(rss_growth / len(samples) / 1024, 1) if samples else None,
+        "ttft_ms": percentiles([s.ttft for s in samples if s.ttft is not None]),
+        "inter_chunk_ms": percentiles([gap for s in samples for gap in s.gaps]),
+        "bytes_per_stream": round(sum(s.bytes for s in samples) / len(samples), 1) if samples else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", type=int, default=200, help="同时打开的流数")
+    parser.add_argument("--streams-per-socket", type=int, default=50, help="WebSocket 每个连接承载的流数")
+    parser.add_argument("--credits", type=int, default=64, help="WebSocket 每个流的额度（帧）")
+    parser.add_argument("--transports", default="sse,ws", help="依次测量的传输方式")
+    parser.add_argument("--tokens", type=int, default=200, help="模型替身每条回复的token数")
+    parser.add_argument("--token-rate", type=float, default=20, help="模型替身每秒输出的token数，越小流同时存活越久")
+    parser.add_argument("--ttft-ms", type=float, default=300)
+    parser.add_argument("--prompt", default="请介绍一下流式输出")
+    parser.add_argument("--app-port", type=int, default=9000)
+    parser.add_argument("--fake-port", type=int, default=9100)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="传给应用的额外环境变量")
+    parser.add_argument("--label", default="", help="写入结果的标签")
+    parser.add_argument("--output", default=None, help="结果文件路径，默认写入 bench/results/")
+    args = parser.parse_args()
+
+    fake_url = f"http://127.0.0.1:{args.fake_port}"
+    app_url = f"http://127.0.0.1:{args.app_port}"
+    fake = start_process("bench.fake_openai", [
+        "--port", str(args.fake_port),
+        "--tokens", str(args.tokens),
+        "--token-rate", str(args.token_rate),
+        "--ttft-ms", str(args.ttft_ms),
+    ], dict(os.environ))
+
+    results = {}
+    try:
+        asyncio.run(wait_ready(f"{fake_url}/stats"))
+        for transport in args.transports.split(","):
+            workdir = tempfile.mkdtemp(prefix="streamchat-bench-")
+            env = dict(os.environ)
+            env.update({
+                "OPENAI_API_KEY": "bench",
+                "OPENAI_API_BASE_URL": f"{fake_url}/v1",
+                "OPENAI_MAX_TOKENS": str(args.tokens),
+                "DATABASE_URL": f"sqlite:///{workdir}/bench.db",
+                "REDIS_URL": "fakeredis://",
+                # 所有流同时运行，不让准入控制排队
+                "ADMISSION_LOCAL_LIMIT": str(args.streams),
+                "ADMISSION_QUEUE_SIZE": str(args.streams),
+            })
+            env.update(dict(pair.partition("=")[::2] for pair in args.env))
+            app = start_process("bench.serve_app", ["--port", str(args.app_port)], env)
+            try:
+                asyncio.run(wait_ready(f"{app_url}/__bench__/counters"))
+                results[transport] = asyncio.run(measure(args, transport, app_url, app.pid))
+            finally:
+                stop_process(app)
+    finally:
+        stop_process(fake)
+
+    revision = git_revision()
+    report = {
+        "meta": {**revision, "label": args.label, "timestamp": datetime.now().isoformat(timespec="seconds")},
+        "config": vars(args),
+        "results": results,
+    }
+    if args.output:
+        output = Path(args.output)
+    else:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        name = datetime.now().strftime("%Y%m%d-%H%M%S")
+        suffix = "-".join(part for part in [revision["commit"], "ws-compare", args.label] if part)
+        output = RESULTS_DIR / f"{name}-{suffix}.json"
+    output.write_text(json.dumps(report, ensure_ascii=False, indent=2))
+
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -23,7 +23,7 @@ function App() {
   const loadSessions = async () => {
     try {
       const response = await sessionApi.getAll();
-      setSessions(response.data);
+      setSessions(response.data.items);
     } catch (error) {
       console.error('Failed to load sessions:', error);
     }
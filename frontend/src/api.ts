@@ -1,5 +1,5 @@
 import axios from 'axios';
-import { ChatSession, Message } from './types';
+import { ChatSession, Message, Page, SearchPage } from './types';
 
 const API_BASE = 'http://localhost:8000/api';
 
@@ -14,25 +14,36 @@ export const sessionApi = {
   get: (sessionId: string) => 
     api.get<ChatSession>(`/sessions/${sessionId}`),
   
-  getMessages: (sessionId: string) => 
-    api.get<Message[]>(`/sessions/${sessionId}/messages`),
+  getMessages: (sessionId: string, before?: string) => 
+    api.get<Page<Message>>(`/sessions/${sessionId}/messages`, { params: { before } }),
   
-  getAll: () => 
-    api.get<ChatSession[]>('/sessions/'),
+  getAll: (before?: string) => 
+    api.get<Page<ChatSession>>('/sessions/', { params: { before } }),
+};
+
+export const searchApi = {
+  search: (q: string, cursor?: string, sessionId?: string) =>
+    api.get<SearchPage>('/search', { params: { q, cursor, session_id: sessionId } }),
 };
 
 export const chatApi = {
-  startCompletion: (sessionId: string, content: string) =>
+  startCompletion: (sessionId: string, content: string, idempotencyKey?: string) =>
     fetch(`${API_BASE}/chat/${sessionId}/completions`, {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
+        ...(idempotencyKey ? { 'Idempotency-Key': idempotencyKey } : {}),
       },
       body: JSON.stringify({ content }),
     }),
   
-  continueCompletion: (sessionId: string) =>
+  continueCompletion: (sessionId: string, lastEventId?: string) =>
     fetch(`${API_BASE}/chat/${sessionId}/completions-continue`, {
       method: 'POST',
+      headers: lastEventId ? { 'Last-Event-ID': lastEventId } : undefined,
     }),
+
+  // 只读订阅会话：当前回复的快照 + 增量，之后跟随新的回复
+  watchSession: (sessionId: string) =>
+    fetch(`${API_BASE}/chat/${sessionId}/stream`),
 };
\ No newline at end of file
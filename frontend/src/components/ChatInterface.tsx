@@ -14,6 +14,8 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({ sessionId }) => {
   const [input, setInput] = useState('');
   const [currentStreamingMessage, setCurrentStreamingMessage] = useState<string>('');
   const [streamingMessageId, setStreamingMessageId] = useState<string | null>(null);
+  // 新协议只下发增量，由客户端累积完整内容
+  const streamingContentRef = useRef('');
   
   const { isStreaming, startStream, stopStream } = useSSE();
   const { 
@@ -60,7 +62,7 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({ sessionId }) => {
         sessionApi.getMessages(id)
       ]);
       setSession(sessionRes.data);
-      setMessages(messagesRes.data);
+      setMessages(messagesRes.data.items);
     } catch (error) {
       console.error('Failed to load session:', error);
     }
@@ -69,12 +71,15 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({ sessionId }) => {
   const handleSSEData = (data: SSEData) => {
     switch (data.type) {
       case 'content':
-        setCurrentStreamingMessage(data.accumulated || '');
+        streamingContentRef.current += data.content || '';
+        setCurrentStreamingMessage(streamingContentRef.current);
         setStreamingMessageId(data.message_id);
         break;
       
       case 'resume':
-        setCurrentStreamingMessage(data.existing_content || '');
+        streamingContentRef.current =
+          streamingContentRef.current.slice(0, data.offset || 0) + (data.existing_content || '');
+        setCurrentStreamingMessage(streamingContentRef.current);
         setStreamingMessageId(data.message_id);
         break;
       
@@ -90,11 +95,12 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({ sessionId }) => {
           id: data.message_id,
           session_id: sessionId!,
           role: 'assistant',
-          content: data.total_content || currentStreamingMessage,
+          content: streamingContentRef.current,
           is_streaming: false,
           created_at: new Date().toISOString(),
         };
         setMessages(prev => [...prev, newMessage]);
+        streamingContentRef.current = '';
         setCurrentStreamingMessage('');
         setStreamingMessageId(null);
         // 成功完成时清理状态（这个会被hook处理）
@@ -103,17 +109,18 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({ sessionId }) => {
       case 'error':
         console.error('Stream error:', data.error);
         // 如果有部分内容，保存它
-        if (data.partial_content) {
+        if (streamingContentRef.current) {
           const errorMessage: Message = {
             id: data.message_id,
             session_id: sessionId!,
             role: 'assistant',
-            content: data.partial_content + '\n\n[发生错误，回复可能不完整]',
+            content: streamingContentRef.current + '\n\n[发生错误，回复可能不完整]',
             is_streaming: false,
             created_at: new Date().toISOString(),
           };
           setMessages(prev => [...prev, errorMessage]);
         }
+        streamingContentRef.current = '';
         setCurrentStreamingMessage('');
         setStreamingMessageId(null);
         // 错误时不清理状态，保留用于重试（由hook处理）
@@ -138,8 +145,10 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({ sessionId }) => {
     setInput('');
 
     try {
-      const response = await chatApi.startCompletion(sessionId, messageContent);
+      // 同一次发送的重试携带相同的键，服务端不会重复生成
+      const response = await chatApi.startCompletion(sessionId, messageContent, crypto.randomUUID());
       if (response.ok) {
+        streamingContentRef.current = '';
         saveStreamingState(sessionId, true);
         startStream(response, handleSSEData);
       }
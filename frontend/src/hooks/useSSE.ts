@@ -1,9 +1,11 @@
-import { useState, useRef, useCallback } from 'react';
+import React, { useState, useRef, useCallback } from 'react';
 import { SSEData } from '../types';
 
 interface UseSSEReturn {
   isStreaming: boolean;
   error: string | null;
+  /** 最近收到的事件 id（字符偏移），续传时作为 Last-Event-ID 发送 */
+  lastEventId: React.MutableRefObject<string | null>;
   startStream: (response: Response, onData: (data: SSEData) => void) => void;
   stopStream: () => void;
 }
@@ -13,6 +15,7 @@ export const useSSE = (): UseSSEReturn => {
   const [error, setError] = useState<string | null>(null);
   const readerRef = useRef<ReadableStreamDefaultReader<Uint8Array> | null>(null);
   const abortControllerRef = useRef<AbortController | null>(null);
+  const lastEventId = useRef<string | null>(null);
 
   const stopStream = useCallback(() => {
     if (readerRef.current) {
@@ -52,23 +55,31 @@ export const useSSE = (): UseSSEReturn => {
           }
 
           buffer += decoder.decode(value, { stream: true });
-          const lines = buffer.split('\n');
-          buffer = lines.pop() || '';
+          const frames = buffer.split('\n\n');
+          buffer = frames.pop() || '';
 
-          for (const line of lines) {
-            if (line.startsWith('data: ')) {
-              try {
-                const data = JSON.parse(line.slice(6));
-                onData(data);
-                
-                if (data.type === 'done' || data.type === 'error') {
-                  setIsStreaming(false);
-                  return;
-                }
-              } catch (parseError) {
-                console.error('Failed to parse SSE data:', parseError);
+          for (const frame of frames) {
+            let payload = '';
+            for (const line of frame.split('\n')) {
+              if (line.startsWith('id: ')) {
+                lastEventId.current = line.slice(4);
+              } else if (line.startsWith('data: ')) {
+                payload += line.slice(6);
               }
             }
+            if (!payload) continue;
+
+            try {
+              const data = JSON.parse(payload);
+              onData(data);
+
+              if (data.type === 'done' || data.type === 'error') {
+                setIsStreaming(false);
+                return;
+              }
+            } catch (parseError) {
+              console.error('Failed to parse SSE data:', parseError);
+            }
           }
         }
       } catch (streamError) {
@@ -85,6 +96,7 @@ export const useSSE = (): UseSSEReturn => {
   return {
     isStreaming,
     error,
+    lastEventId,
     startStream,
     stopStream,
   };
@@ -5,6 +5,10 @@ export interface ChatSession {
   created_at: string;
   updated_at: string;
   last_message_id: string | null;
+  message_count: number;
+  last_message_preview: string | null;
+  last_role: 'user' | 'assistant' | null;
+  total_tokens: number;
 }
 
 export interface Message {
@@ -16,10 +20,38 @@ export interface Message {
   created_at: string;
 }
 
+export interface Page<T> {
+  items: T[];
+  /** 加载更早一页的游标，没有更多时为 null */
+  before_cursor: string | null;
+  /** 加载更新一页的游标，没有更多时为 null */
+  after_cursor: string | null;
+}
+
+export interface SearchHit {
+  message_id: string;
+  session_id: string;
+  session_title: string | null;
+  role: 'user' | 'assistant';
+  /** 命中位置附近的片段，已做 HTML 转义，命中词用 <mark> 标出 */
+  snippet: string;
+  score: number;
+  created_at: string;
+}
+
+export interface SearchPage {
+  items: SearchHit[];
+  /** 下一页的游标，没有更多结果时为 null */
+  next_cursor: string | null;
+  took_ms: number;
+}
+
 export interface SSEData {
   type: 'content' | 'done' | 'error' | 'resume' | 'retry';
   content?: string;
   message_id: string;
+  offset?: number;
+  /** 仅旧协议（protocol=1）携带 */
   accumulated?: string;
   existing_content?: string;
   total_content?: string;